@@ -1,6 +1,8 @@
 import os
 import json
+import threading
 
+import llm_shell.llm_stats as llm_stats
 
 
 def send_to_claude_instant1(context):
@@ -21,6 +23,116 @@ def send_to_claude3haiku(context):
 def send_to_claude3opus(context):
     return send_to_bedrock(context, 'anthropic.claude-3-opus-20240229-v1:0')
 
+def send_to_claude37sonnet(context):
+    return send_to_bedrock(context, 'us.anthropic.claude-3-7-sonnet-20250219-v1:0')
+
+def stream_to_claude_instant1(context):
+    return stream_bedrock(context, 'anthropic.claude-instant-v1')
+
+def stream_to_claude21(context):
+    return stream_bedrock(context, 'anthropic.claude-v2:1')
+
+def stream_to_claude3sonnet(context):
+    return stream_bedrock(context, 'anthropic.claude-3-sonnet-20240229-v1:0')
+
+def stream_to_claude35sonnet(context):
+    return stream_bedrock(context, 'anthropic.claude-3-5-sonnet-20240620-v1:0')
+
+def stream_to_claude3haiku(context):
+    return stream_bedrock(context, 'anthropic.claude-3-haiku-20240307-v1:0')
+
+def stream_to_claude3opus(context):
+    return stream_bedrock(context, 'anthropic.claude-3-opus-20240229-v1:0')
+
+def stream_to_claude37sonnet(context):
+    return stream_bedrock(context, 'us.anthropic.claude-3-7-sonnet-20250219-v1:0')
+
+# bedrock clients are expensive to build (credential resolution, service model loading),
+# so one client is kept per (region, profile, endpoint) and reused along with its connection pool
+bedrock_region = None
+bedrock_profile = None
+bedrock_endpoint_url = os.getenv('BEDROCK_ENDPOINT_URL')
+bedrock_max_pool_connections = 10
+bedrock_read_timeout = 300
+bedrock_clients = {}
+bedrock_clients_lock = threading.Lock()
+
+def get_bedrock_client(region=None, profile=None):
+    key = (region or bedrock_region, profile or bedrock_profile, bedrock_endpoint_url)
+    with bedrock_clients_lock:
+        if key not in bedrock_clients:
+            import boto3
+            from botocore.config import Config
+
+            session = boto3.session.Session(region_name=key[0], profile_name=key[1])
+            bedrock_clients[key] = session.client('bedrock-runtime', endpoint_url=key[2], config=Config(
+                max_pool_connections=bedrock_max_pool_connections,
+                read_timeout=bedrock_read_timeout,
+                tcp_keepalive=True,
+            ))
+        return bedrock_clients[key]
+
+def clear_bedrock_clients():
+    with bedrock_clients_lock:
+        bedrock_clients.clear()
+
+# builds the client in a background thread so the first request doesn't pay for it
+def prewarm_bedrock_client(region=None, profile=None):
+    def warm():
+        try:
+            get_bedrock_client(region, profile)
+        except Exception:
+            pass # the error will surface again on the first real request
+    thread = threading.Thread(target=warm, daemon=True)
+    thread.start()
+    return thread
+
+# when enabled, context entries marked with 'cache' are sent with cache-control breakpoints to the models which
+# support prompt caching, the others reject requests which contain them
+bedrock_prompt_caching = False
+prompt_caching_models = {
+    'us.anthropic.claude-3-7-sonnet-20250219-v1:0',
+}
+
+# prompt cache usage reported by the most recent response and over the session
+last_usage = {}
+total_cache_read_tokens = 0
+total_cache_write_tokens = 0
+
+# prices in dollars per million tokens
+model_prices = {
+    'anthropic.claude-instant-v1': { 'output': 2.4, 'input': 0.8 },
+    'anthropic.claude-v2:1': { 'output': 24, 'input': 8 },
+    'anthropic.claude-3-sonnet-20240229-v1:0': { 'output': 15, 'input': 3 },
+    'anthropic.claude-3-5-sonnet-20240620-v1:0': { 'output': 15, 'input': 3 },
+    'anthropic.claude-3-haiku-20240307-v1:0': { 'output': 1.25, 'input': 0.25 },
+    'anthropic.claude-3-opus-20240229-v1:0': { 'output': 75, 'input': 15 },
+    'us.anthropic.claude-3-7-sonnet-20250219-v1:0': { 'output': 15, 'input': 3 },
+}
+
+def clear_last_usage():
+    # called before every request, so a response from the response cache doesn't report the previous request's usage
+    global last_usage
+    last_usage = {}
+
+def record_usage(usage, model):
+    global last_usage, total_cache_read_tokens, total_cache_write_tokens
+    if model in prompt_caching_models:
+        last_usage = usage
+    cache_read_tokens = usage.get('cache_read_input_tokens', 0) or 0
+    cache_write_tokens = usage.get('cache_creation_input_tokens', 0) or 0
+    total_cache_read_tokens += cache_read_tokens
+    total_cache_write_tokens += cache_write_tokens
+
+    prices = model_prices.get(model)
+    cost = None
+    if prices:
+        # cache writes cost 25% more than regular input, cache reads 90% less
+        cost = (usage.get('input_tokens', 0) * prices['input'] + cache_write_tokens * prices['input'] * 1.25
+            + cache_read_tokens * prices['input'] * 0.1 + usage.get('output_tokens', 0) * prices['output']) / 1000000
+    llm_stats.report_usage(input_tokens=usage.get('input_tokens'), output_tokens=usage.get('output_tokens'), cost=cost,
+        cache_read_tokens=cache_read_tokens, cache_write_tokens=cache_write_tokens)
+
 role_mapping = {
     'user': 'Human',
     'assistant': 'Assistant',
@@ -46,22 +158,43 @@ def merge_sequential_messages(messages):
     return merged
 
 
-def send_to_bedrock(context, model):
-    import boto3
-
-    # Initialize the Bedrock AI client lazily
-    bedrock_runtime_client = boto3.client('bedrock-runtime')  
+# merges sequential messages into separate content blocks, placing a cache breakpoint
+# after the last message which was marked as part of the static prefix
+def merge_sequential_messages_to_blocks(messages):
+    last_cached = max([ index for index, msg in enumerate(messages) if msg.get('cache') ], default=-1)
+    merged = []
+    for index, msg in enumerate(messages):
+        block = { "type": "text", "text": msg['content'] }
+        if index == last_cached:
+            block['cache_control'] = { "type": "ephemeral" }
+        if merged and merged[-1]['role'] == msg['role']:
+            merged[-1]['content'].append(block)
+        else:
+            merged.append({ "role": msg['role'], "content": [block] })
+    return merged
 
-    system_prompt = next(step['content'] for step in context if step['role'] == 'system')
+def build_bedrock_body(context, model=None):
+    # bedrock takes a single system prompt, so every system entry goes into it in order
+    system_steps = [ step for step in context if step['role'] == 'system' ]
     context_prompts = [ step for step in context if step['role'] != 'system' ]
-    context_prompts = merge_sequential_messages(context_prompts)
 
-    # Prepare the body of the request
-    body = json.dumps({
-        "messages": [ { "role": step['role'], "content": [{
+    # Entries marked with 'cache' form a stable prefix which bedrock can reuse between requests
+    if bedrock_prompt_caching and model in prompt_caching_models and any(step.get('cache') for step in context):
+        system_prompt = [ { "type": "text", "text": step['content'] } for step in system_steps ]
+        last_cached = max([ index for index, step in enumerate(system_steps) if step.get('cache') ], default=-1)
+        if last_cached != -1:
+            system_prompt[last_cached]['cache_control'] = { "type": "ephemeral" }
+        messages = merge_sequential_messages_to_blocks(context_prompts)
+    else:
+        system_prompt = '\n\n'.join(step['content'] for step in system_steps)
+        messages = [ { "role": step['role'], "content": [{
                     "type": "text",
                     "text": step['content']
-                }] } for step in context_prompts ],
+                }] } for step in merge_sequential_messages(context_prompts) ]
+
+    # Prepare the body of the request
+    return json.dumps({
+        "messages": messages,
         "system": system_prompt,
         "max_tokens": 30000,
         "temperature": 0.5,
@@ -71,6 +204,11 @@ def send_to_bedrock(context, model):
         "anthropic_version": "bedrock-2023-05-31"
     })
 
+def send_to_bedrock(context, model):
+    bedrock_runtime_client = get_bedrock_client()
+
+    body = build_bedrock_body(context, model)
+
     # Call the Bedrock AI model
     response = bedrock_runtime_client.invoke_model(
         body=body,
@@ -83,7 +221,39 @@ def send_to_bedrock(context, model):
     if response['ResponseMetadata']['HTTPStatusCode'] == 200:
         response_body = json.loads(response['body'].read())
         # print(response_body)
+        record_usage(response_body.get('usage', {}), model)
         response_text = response_body['content'][0]['text']
         return response_text.strip()
     else:
         return f"Error: {response['ResponseMetadata']['HTTPStatusCode']}, {response}"
+
+# reads the bedrock event stream, yielding text deltas as the model generates them
+def stream_bedrock(context, model):
+    bedrock_runtime_client = get_bedrock_client()
+
+    body = build_bedrock_body(context, model)
+
+    response = bedrock_runtime_client.invoke_model_with_response_stream(
+        body=body,
+        modelId=model,
+        accept='*/*',
+        contentType='application/json'
+    )
+
+    if response['ResponseMetadata']['HTTPStatusCode'] != 200:
+        yield f"Error: {response['ResponseMetadata']['HTTPStatusCode']}, {response}"
+        return
+
+    usage = {}
+    for event in response['body']:
+        if 'chunk' not in event:
+            continue
+        chunk = json.loads(event['chunk']['bytes'])
+        if chunk['type'] == 'message_start':
+            usage = dict(chunk['message'].get('usage', {}))
+        elif chunk['type'] == 'message_delta':
+            # the final output token count arrives at the end of the stream
+            usage.update(chunk.get('usage', {}))
+            record_usage(usage, model)
+        elif chunk['type'] == 'content_block_delta' and chunk['delta'].get('type') == 'text_delta':
+            yield chunk['delta']['text']
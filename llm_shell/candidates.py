@@ -0,0 +1,215 @@
+import os
+import time
+import queue
+import codecs
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+
+from llm_shell.util import OutputCapture, parse_diff_string, apply_changes_batch
+
+
+
+# Tries several candidate edits side by side: every candidate is applied to its own scratch copy of the working tree,
+# the verifier command runs in each copy as soon as its candidate arrives, and the first candidate to pass wins while
+# the rest are cancelled
+workspace_prefix = 'llm_shell_candidate_'
+read_chunk_size = 64 * 1024
+# how long to wait for a killed verifier's output pipe to close
+kill_timeout = 5
+# every candidate gets a full copy of the working tree, larger trees are not raced
+max_workspace_bytes = 512 * 1024 * 1024
+
+class Candidate:
+    def __init__(self, index, response):
+        self.index = index
+        self.response = response
+        self.blocks = parse_diff_string(response)
+        self.workspace = None
+        self.results = []
+        # 'ready', 'no changes', 'not applied', 'passed', 'failed' or 'cancelled'
+        self.status = 'no changes' if not self.blocks else None
+        self.returncode = None
+        self.output = ''
+        self.seconds = None
+        self.cancelled = False
+
+    def describe(self):
+        if self.status == 'not applied':
+            failed = sum(1 for filepath, search_block, status in self.results if status not in ('applied', 'created'))
+            return f'not applied, {failed} of {len(self.blocks)} block(s) did not apply'
+        if self.status == 'failed':
+            return f'failed with exit code {self.returncode} after {self.seconds:.1f}s'
+        if self.status == 'passed':
+            return f'passed after {self.seconds:.1f}s'
+        if self.status == 'ready':
+            return f'{len(self.blocks)} block(s) applied'
+        return self.status
+
+def workspace_size(root):
+    # The total size of the files under root, ignored build output and dependency directories included since the
+    # verifier usually needs them
+    total_size = 0
+    for dirpath, dirs, names in os.walk(root):
+        for name in names:
+            try:
+                total_size += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total_size
+
+def copy_tree(source, destination):
+    # Copy-on-write where the filesystem supports it, so even a large tree is copied almost for free
+    try:
+        subprocess.run(['cp', '-a', '--reflink=auto', os.path.join(source, '.'), destination], check=True, capture_output=True)
+        return
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    try:
+        shutil.copytree(source, destination, symlinks=True, dirs_exist_ok=True)
+    except shutil.Error:
+        # files which can't be read are left out of the copy, as cp does
+        pass
+
+def relocate_path(filepath, root, workspace):
+    # the path of a block's file inside the workspace, or None when the file is outside the working tree
+    relative_path = os.path.relpath(os.path.abspath(os.path.join(root, filepath)), root)
+    if relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep):
+        return None
+    return os.path.join(workspace, relative_path)
+
+def workspace_parent(root):
+    # Workspaces go on root's own filesystem, so reflinks work and renames stay atomic, but never inside root itself
+    # where a workspace would copy the others
+    temp_dir = tempfile.gettempdir()
+    try:
+        same_filesystem = os.stat(temp_dir).st_dev == os.stat(root).st_dev
+    except OSError:
+        same_filesystem = False
+    if same_filesystem and relocate_path(temp_dir, root, root) is None:
+        return temp_dir
+    return os.path.dirname(root)
+
+def prepare_workspace(candidate, root):
+    try:
+        try:
+            candidate.workspace = tempfile.mkdtemp(prefix=workspace_prefix, dir=workspace_parent(root))
+        except OSError:
+            # root's parent isn't writable, a copy in the temporary directory still works
+            candidate.workspace = tempfile.mkdtemp(prefix=workspace_prefix)
+        copy_tree(root, candidate.workspace)
+    except OSError as e:
+        candidate.results = [ (root, '', f'error: {e}') ]
+        candidate.status = 'not applied'
+        return
+    blocks = []
+    for filepath, search_block, replace_block in candidate.blocks:
+        workspace_path = relocate_path(filepath, root, candidate.workspace)
+        if workspace_path is None:
+            candidate.results = [ (filepath, search_block, 'error: outside the working tree') ]
+            candidate.status = 'not applied'
+            return
+        blocks.append((workspace_path, search_block, replace_block))
+    candidate.results = apply_changes_batch(blocks)
+    if all(status in ('applied', 'created') for filepath, search_block, status in candidate.results):
+        candidate.status = 'ready'
+    else:
+        candidate.status = 'not applied'
+
+def remove_workspaces(candidates):
+    for candidate in candidates:
+        if candidate.workspace is not None:
+            shutil.rmtree(candidate.workspace, ignore_errors=True)
+            candidate.workspace = None
+
+def wait_for_verifier(candidate, process, start_time, events):
+    capture = OutputCapture()
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+        data = process.stdout.read1(read_chunk_size)
+        if not data:
+            break
+        capture.write(decoder.decode(data))
+    capture.write(decoder.decode(b'', final=True))
+    process.stdout.close()
+    candidate.returncode = process.wait()
+    candidate.seconds = time.time() - start_time
+    candidate.output = capture.getvalue()
+    if candidate.cancelled:
+        candidate.status = 'cancelled'
+    else:
+        candidate.status = 'passed' if candidate.returncode == 0 else 'failed'
+    events.put(('finished', candidate))
+
+def start_verifier(candidate, verifier_command, events):
+    process = subprocess.Popen(verifier_command, shell=True, cwd=candidate.workspace, stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+    thread = threading.Thread(target=wait_for_verifier, args=(candidate, process, time.time(), events), daemon=True)
+    thread.start()
+    return process, thread
+
+def kill_verifier(process):
+    # the verifier runs in its own session, so its whole process group goes with it
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def feed_responses(responses, events):
+    # responses may block until each one arrives, they are passed on from a thread of their own
+    try:
+        for response in responses:
+            events.put(('response', response))
+    except Exception as e:
+        events.put(('error', e))
+    events.put(('done', None))
+
+def run_candidates(responses, verifier_command=None, root=None, cancel_responses=None):
+    # Applies each diff response to a scratch copy of root as soon as it arrives and starts the verifier command in
+    # that copy right away, so a fast passing candidate never waits for slower ones to be generated. Returns
+    # (candidates, winner) with the candidates in the order they arrived. The winner is the first to pass the verifier,
+    # or without one the first whose blocks all apply. Once there is a winner cancel_responses is called for the
+    # responses still to come and the other verifiers are killed. root itself is never modified.
+    root = os.path.abspath(root or os.getcwd())
+    candidates = []
+    events = queue.Queue()
+    verifiers = []
+    running = 0
+    responses_done = False
+    threading.Thread(target=feed_responses, args=(responses, events), daemon=True).start()
+    try:
+        while not responses_done or running:
+            kind, value = events.get()
+            if kind == 'done':
+                responses_done = True
+            elif kind == 'error':
+                raise value
+            elif kind == 'finished':
+                running -= 1
+                if value.status == 'passed':
+                    return candidates, value
+            else:
+                candidate = Candidate(len(candidates), value)
+                candidates.append(candidate)
+                if candidate.status is not None:
+                    continue
+                prepare_workspace(candidate, root)
+                if candidate.status != 'ready':
+                    continue
+                if not verifier_command:
+                    return candidates, candidate
+                verifiers.append((candidate,) + start_verifier(candidate, verifier_command, events))
+                running += 1
+        return candidates, None
+    finally:
+        if not responses_done and cancel_responses:
+            cancel_responses()
+        for candidate, process, thread in verifiers:
+            if process.poll() is None:
+                candidate.cancelled = True
+                kill_verifier(process)
+        for candidate, process, thread in verifiers:
+            thread.join(kill_timeout)
+        remove_workspaces(candidates)
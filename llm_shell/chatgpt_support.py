@@ -1,9 +1,12 @@
 import os
-import requests
+import json
+import threading
 
+import llm_shell.llm_stats as llm_stats
 from llm_shell.util import bold_gold
 
 chatgpt_api_key = os.getenv('CHATGPT_API_KEY')
+chatgpt_base_url = os.getenv('CHATGPT_BASE_URL', 'https://api.openai.com/v1')
 
 def send_to_o1(context):
     return send_to_chatgpt_model(context, 'o1-preview')
@@ -26,6 +29,64 @@ def send_to_gpt4(context):
 def send_to_gpt35turbo(context):
     return send_to_chatgpt_model(context, 'gpt-3.5-turbo')
 
+def stream_to_gpt4o(context):
+    return stream_chatgpt_model(context, 'gpt-4o')
+
+def stream_to_gpt4omini(context):
+    return stream_chatgpt_model(context, 'gpt-4o-mini')
+
+def stream_to_gpt4turbo(context):
+    return stream_chatgpt_model(context, 'gpt-4-turbo')
+
+def stream_to_gpt4(context):
+    return stream_chatgpt_model(context, 'gpt-4')
+
+def stream_to_gpt35turbo(context):
+    return stream_chatgpt_model(context, 'gpt-3.5-turbo')
+
+
+# keep-alive connection pool shared by every request to the openai api
+http_session = None
+http_session_lock = threading.Lock()
+http_session_config = {
+    'pool_size': 10,
+    'max_retries': 2,
+    'timeout': 120,
+}
+
+def configure_http_session(pool_size=None, max_retries=None, timeout=None):
+    global http_session
+    with http_session_lock:
+        for key, value in (('pool_size', pool_size), ('max_retries', max_retries), ('timeout', timeout)):
+            if value is not None:
+                http_session_config[key] = value
+        # drop the old pool, the next request rebuilds it with the new settings
+        if http_session is not None:
+            http_session.close()
+            http_session = None
+
+def get_http_session():
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            # requests is only imported once an openai backend is actually used
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(total=http_session_config['max_retries'], backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET', 'POST'], raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=http_session_config['pool_size'],
+                pool_maxsize=http_session_config['pool_size'], max_retries=retry)
+            http_session = requests.Session()
+            http_session.mount('https://', adapter)
+            http_session.mount('http://', adapter)
+        return http_session
+
+# opens a keep-alive connection to the api so the first request skips the tcp and tls handshakes
+def warm_http_connection():
+    get_http_session().head(chatgpt_base_url, timeout=http_session_config['timeout'])
+
 
 total_estimated_cost = 0
 total_tokens_used = 0
@@ -42,7 +103,7 @@ model_prices = {
     # 'gpt-3.5-turbo-1106': { 'output': 2, 'input': 1 },
 }
 def send_to_chatgpt_model(context, model):
-    global total_estimated_cost, total_tokens_used, chatgpt_api_key
+    global chatgpt_api_key
 
     if not chatgpt_api_key:
         raise Exception("Can't execute chatgpt without 'CHATGPT_API_KEY' environment variable set.")
@@ -54,21 +115,18 @@ def send_to_chatgpt_model(context, model):
 
     data = {
         "model": model,
-        "messages": context,
+        "messages": [ { "role": step['role'], "content": step['content'] } for step in context ],
         "temperature": 0.5,
         "max_tokens": 4096
     }
 
-    response = requests.post("https://api.openai.com/v1/chat/completions", json=data, headers=headers)
+    response = get_http_session().post(f"{chatgpt_base_url}/chat/completions", json=data, headers=headers,
+        timeout=http_session_config['timeout'])
 
 
     if response.status_code == 200:
         response_data = response.json()
-        # Calculate the estimated cost based on input and output tokens
-        estimated_cost_input = response_data['usage']['prompt_tokens'] * model_prices[model]['input'] / 1000000
-        estimated_cost_output = response_data['usage']['completion_tokens'] * model_prices[model]['output'] / 1000000
-        total_estimated_cost += estimated_cost_input + estimated_cost_output
-        total_tokens_used += response_data['usage']['total_tokens']
+        update_usage_totals(response_data['usage'], model)
 
         # print(f"\t(Total tokens so far: {bold_gold(str(total_tokens_used))}, Total cost so far: {bold_gold(f'${total_estimated_cost:.2f}')} )")
 
@@ -77,6 +135,64 @@ def send_to_chatgpt_model(context, model):
     else:
         return f"Error: {response.status_code}, {response.text}"
 
+def update_usage_totals(usage, model):
+    global total_estimated_cost, total_tokens_used
+    # Calculate the estimated cost based on input and output tokens
+    estimated_cost_input = usage['prompt_tokens'] * model_prices[model]['input'] / 1000000
+    estimated_cost_output = usage['completion_tokens'] * model_prices[model]['output'] / 1000000
+    total_estimated_cost += estimated_cost_input + estimated_cost_output
+    total_tokens_used += usage['total_tokens']
+    llm_stats.report_usage(input_tokens=usage['prompt_tokens'], output_tokens=usage['completion_tokens'],
+        cost=estimated_cost_input + estimated_cost_output)
+
+# streams the completion as server-sent events, yielding content deltas as they arrive
+def stream_chatgpt_model(context, model):
+    global chatgpt_api_key
+
+    if not chatgpt_api_key:
+        raise Exception("Can't execute chatgpt without 'CHATGPT_API_KEY' environment variable set.")
+
+    headers = {
+        "Authorization": f"Bearer {chatgpt_api_key}",
+        "Content-Type": "application/json"
+    }
+
+    data = {
+        "model": model,
+        "messages": [ { "role": step['role'], "content": step['content'] } for step in context ],
+        "temperature": 0.5,
+        "max_tokens": 4096,
+        "stream": True,
+        "stream_options": { "include_usage": True },
+    }
+
+    response = get_http_session().post(f"{chatgpt_base_url}/chat/completions", json=data, headers=headers,
+        stream=True, timeout=http_session_config['timeout'])
+
+    if response.status_code != 200:
+        yield f"Error: {response.status_code}, {response.text}"
+        return
+
+    try:
+        # the event stream is always utf-8, but without a charset in its content type requests would decode it as latin-1
+        for line in response.iter_lines():
+            line = line.decode('utf-8')
+            if not line or not line.startswith('data:'):
+                continue
+            payload = line[len('data:'):].strip()
+            if payload == '[DONE]':
+                break
+            chunk = json.loads(payload)
+            # the final chunk carries the usage and has no choices
+            if chunk.get('usage'):
+                update_usage_totals(chunk['usage'], model)
+            for choice in chunk.get('choices', []):
+                content = choice.get('delta', {}).get('content')
+                if content:
+                    yield content
+    finally:
+        response.close()
+
 # loads a list of openai model ids from the API
 def get_openai_models():
     global chatgpt_api_key
@@ -89,7 +205,8 @@ def get_openai_models():
         "Content-Type": "application/json"
     }
 
-    response = requests.get("https://api.openai.com/v1/models",  headers=headers)
+    response = get_http_session().get(f"{chatgpt_base_url}/models", headers=headers,
+        timeout=http_session_config['timeout'])
 
     response_data = response.json()
     model_ids = list(map(lambda d: d['id'], response_data['data']))
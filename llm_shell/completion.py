@@ -0,0 +1,53 @@
+import os
+import bisect
+import threading
+
+
+
+# sorted index of the program names on $PATH, rebuilt only when $PATH or one of its directories changes
+class ExecutableIndex:
+    def __init__(self):
+        self.path = None
+        self.directory_mtimes = {}
+        self.names = []
+        self.lock = threading.Lock()
+
+    def directory_signature(self, path):
+        mtimes = {}
+        for directory in path.split(os.pathsep):
+            if directory and directory not in mtimes:
+                try:
+                    mtimes[directory] = os.stat(directory).st_mtime_ns
+                except OSError:
+                    mtimes[directory] = None
+        return mtimes
+
+    def refresh(self):
+        # returns True when the index had to be rebuilt
+        path = os.environ.get('PATH', '')
+        mtimes = self.directory_signature(path)
+        with self.lock:
+            if path == self.path and mtimes == self.directory_mtimes:
+                return False
+            names = set()
+            for directory, mtime in mtimes.items():
+                if mtime is None:
+                    continue
+                try:
+                    names.update(os.listdir(directory))
+                except OSError:
+                    pass
+            self.names = sorted(names)
+            self.path = path
+            self.directory_mtimes = mtimes
+            return True
+
+    def complete(self, prefix):
+        self.refresh()
+        with self.lock:
+            names = self.names
+        start = bisect.bisect_left(names, prefix)
+        end = bisect.bisect_left(names, prefix + '\U0010ffff', start)
+        return names[start:end]
+
+executable_index = ExecutableIndex()
@@ -0,0 +1,149 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+
+# in-memory cache of context and summary file contents, validated against each file's
+# (mtime, size, inode) so unchanged files are never re-read or re-summarized
+context_cache_max_bytes = 64 * 1024 * 1024
+
+cache_entries = OrderedDict()
+cache_size = 0
+cache_lock = threading.Lock()
+cache_hits = 0
+cache_misses = 0
+
+# optional inotify watcher, which lets watched files skip the stat call entirely
+inotify_watcher = None
+
+def file_signature(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def lookup(file_path, summarize):
+    # returns the cached contents (or None) and the signature to store a fresh read under
+    global cache_hits, cache_misses
+    key = (os.path.abspath(file_path), summarize)
+    with cache_lock:
+        entry = cache_entries.get(key)
+        if entry is not None and inotify_watcher is not None and inotify_watcher.is_watching(key[0]):
+            cache_entries.move_to_end(key)
+            cache_hits += 1
+            return entry[1], entry[0]
+
+    signature = file_signature(file_path)
+    with cache_lock:
+        entry = cache_entries.get(key)
+        if entry is not None and signature is not None and entry[0] == signature:
+            cache_entries.move_to_end(key)
+            cache_hits += 1
+            return entry[1], signature
+        cache_misses += 1
+    return None, signature
+
+def store(file_path, summarize, signature, contents):
+    global cache_size
+    if signature is None or contents is None or len(contents) > context_cache_max_bytes:
+        return
+    key = (os.path.abspath(file_path), summarize)
+    with cache_lock:
+        if key in cache_entries:
+            cache_size -= len(cache_entries.pop(key)[1])
+        cache_entries[key] = (signature, contents)
+        cache_size += len(contents)
+        # Evict the least recently used files to keep memory bounded for huge globs
+        while cache_size > context_cache_max_bytes:
+            evicted_key, (evicted_signature, evicted_contents) = cache_entries.popitem(last=False)
+            cache_size -= len(evicted_contents)
+    if inotify_watcher is not None:
+        inotify_watcher.watch(key[0])
+        # A write which landed before the watch was added would otherwise go unnoticed
+        if file_signature(key[0]) != signature:
+            invalidate(key[0])
+
+def invalidate(file_path):
+    global cache_size
+    absolute_path = os.path.abspath(file_path)
+    with cache_lock:
+        for summarize in (True, False):
+            entry = cache_entries.pop((absolute_path, summarize), None)
+            if entry is not None:
+                cache_size -= len(entry[1])
+
+def clear():
+    global cache_size
+    with cache_lock:
+        cache_entries.clear()
+        cache_size = 0
+
+def stats():
+    with cache_lock:
+        return {
+            'entries': len(cache_entries),
+            'size': cache_size,
+            'hits': cache_hits,
+            'misses': cache_misses,
+            'inotify': inotify_watcher is not None,
+        }
+
+class InotifyWatcher:
+    def __init__(self):
+        from inotify_simple import INotify, flags
+        self.inotify = INotify()
+        self.watch_flags = flags.MODIFY | flags.ATTRIB | flags.CLOSE_WRITE | flags.MOVE_SELF | flags.DELETE_SELF
+        self.watches = {}
+        self.watched_paths = {}
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def is_watching(self, file_path):
+        with self.lock:
+            return file_path in self.watched_paths
+
+    def watch(self, file_path):
+        with self.lock:
+            if file_path in self.watched_paths:
+                return
+            try:
+                wd = self.inotify.add_watch(file_path, self.watch_flags)
+            except OSError:
+                return
+            self.watches[wd] = file_path
+            self.watched_paths[file_path] = wd
+
+    def run(self):
+        while self.running:
+            for event in self.inotify.read(timeout=500):
+                with self.lock:
+                    file_path = self.watches.get(event.wd)
+                    # the watch is dropped, the next lookup falls back to stat and re-watches
+                    if file_path is not None and file_path in self.watched_paths:
+                        del self.watched_paths[file_path]
+                if file_path is not None:
+                    invalidate(file_path)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.inotify.close()
+
+def enable_inotify():
+    global inotify_watcher
+    if inotify_watcher is None:
+        try:
+            inotify_watcher = InotifyWatcher()
+        except (ImportError, OSError):
+            return False
+    return True
+
+def disable_inotify():
+    global inotify_watcher
+    if inotify_watcher is not None:
+        inotify_watcher.close()
+        inotify_watcher = None
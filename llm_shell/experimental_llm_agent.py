@@ -285,3 +285,28 @@ Always specify the file path to target before every search/replace block.
 '''
 
 
+
+# added to the main request in single-call mode, so the answer carries its own search/replace blocks
+# and the second request with llm_diff_instruction is only needed when it doesn't
+llm_single_call_instruction = '''When your answer creates or changes files, also write every change as search/replace blocks in the same answer.
+Each search-replace block must have a `<<<<<<< SEARCH` line, a `=======` divider line, and a `>>>>>>> REPLACE` line.
+The search-block must be wrapped in "```" markdown quotations, and must have the filepath specified on the line before the first quote.
+The search must repeat existing lines of the file exactly. To create a new file, leave the search empty.
+Always specify the file path to target before every search/replace block.
+
+# Example:
+
+webserver.py
+```
+<<<<<<< SEARCH
+def hello_world():
+    return 'Hello, World!'
+=======
+def hello_world():
+    return 'Hello, Flask!'
+>>>>>>> REPLACE
+```
+'''
+
+# the last turn of the diff request, after the assistant's answer which the blocks are written for
+llm_diff_request = '''Write the search/replace blocks for the changes in your answer.'''
@@ -1,19 +1,27 @@
 import sys
 import os
+import io
+import codecs
+import locale
 import subprocess
-import readline
 import glob
-import traceback
 import argparse
+import weakref
+import json
+import time
+import threading
 from functools import partial
 
-import llm_shell.experimental_llm_agent as experimental_llm_agent
 import llm_shell.chatgpt_support as chatgpt_support
 import llm_shell.bedrock_support as bedrock_support
-from llm_shell.util import read_file_contents, get_prompt, shorten_output, summarize_file, \
+import llm_shell.response_cache as response_cache
+import llm_shell.llm_stats as llm_stats
+import llm_shell.context_cache as context_cache
+import llm_shell.completion as completion
+from llm_shell.util import read_file_contents, get_prompt, OutputCapture, summarize_file, \
     apply_syntax_highlighting, start_spinner, slow_print, \
-    parse_bash_string, parse_diff_string, apply_changes, \
-    save_llm_config_to_file, load_llm_config_from_file, record_debug_history
+    parse_bash_string, parse_diff_string, apply_changes_batch, DiffStreamParser, ChangeSet, estimate_message_tokens, \
+    save_llm_config_to_file, load_llm_config_from_file, record_debug_history, warm_syntax_highlighting
 
 version = '0.5.1'
 history = []
@@ -22,13 +30,33 @@ llm_config = {
     'llm_instruction': "You are a programming assistant. Help the user build programs and resolve errors.",
     'llm_reindent_with_tabs': False,
     'llm_history_length': 5,
+    'llm_context_budget': None,
+    'llm_stream': True,
+    'llm_cache': False,
+    'llm_context_cache': True,
+    'llm_context_cache_inotify': False,
+    'llm_context_index': False,
+    'llm_context_index_top_k': 8,
+    'llm_context_index_budget': 4000,
+    'llm_prompt_caching': False,
+    'llm_concurrency': 4,
+    'http_pool_size': 10,
+    'http_max_retries': 2,
+    'http_timeout': 120,
     'experimental_llm_agent': False,
+    'experimental_llm_agent_single_call': False,
+    'experimental_llm_agent_candidates': 1,
     'experimental_verifier_command': None,
     'experimental_bash_agent': None,
     'context_file': [],
     'summary_file': [],
     'record_debug_history': False,  # Add a new config option for recording debug history
+    'shell_output_spill': False,
+    'shell_session': False,
+    'shell_warmup': True,
 }
+# bytes read from a command's output at a time
+shell_output_chunk_size = 64 * 1024
 
 support_llm_backends = {
     'openai-o1-preview': chatgpt_support.send_to_o1,
@@ -44,71 +72,448 @@ support_llm_backends = {
     'claude-3.5-sonnet': bedrock_support.send_to_claude35sonnet,
     'claude-3-haiku': bedrock_support.send_to_claude3haiku,
     'claude-3-opus': bedrock_support.send_to_claude3opus,
+    'claude-3.7-sonnet': bedrock_support.send_to_claude37sonnet,
     'hello-world': lambda msg: [ print('llm context:', msg), '''hello world!''' ][1],
 }
 
+# default prompt token budgets, used when llm_context_budget is left on auto
+default_context_budgets = {
+    'openai-o1-preview': 32000,
+    'openai-o1-mini': 32000,
+    'openai-gpt-4o': 32000,
+    'openai-gpt-4o-mini': 32000,
+    'openai-gpt-4-turbo': 32000,
+    'openai-gpt-4': 3500,
+    'openai-gpt-3.5-turbo': 11000,
+    'claude-instant-v1': 32000,
+    'claude-2.1': 32000,
+    'claude-3-sonnet': 32000,
+    'claude-3.5-sonnet': 32000,
+    'claude-3-haiku': 32000,
+    'claude-3-opus': 32000,
+    'claude-3.7-sonnet': 32000,
+    'hello-world': 32000,
+}
+# history is kept beyond llm_history_length for the requests which are sent a longer history
+max_history_length = 100
+
+# backends which can yield their response incrementally as it is generated
+support_llm_stream_backends = {
+    'openai-gpt-4o': chatgpt_support.stream_to_gpt4o,
+    'openai-gpt-4o-mini': chatgpt_support.stream_to_gpt4omini,
+    'openai-gpt-4-turbo': chatgpt_support.stream_to_gpt4turbo,
+    'openai-gpt-4': chatgpt_support.stream_to_gpt4,
+    'openai-gpt-3.5-turbo': chatgpt_support.stream_to_gpt35turbo,
+    'claude-instant-v1': bedrock_support.stream_to_claude_instant1,
+    'claude-2.1': bedrock_support.stream_to_claude21,
+    'claude-3-sonnet': bedrock_support.stream_to_claude3sonnet,
+    'claude-3.5-sonnet': bedrock_support.stream_to_claude35sonnet,
+    'claude-3-haiku': bedrock_support.stream_to_claude3haiku,
+    'claude-3-opus': bedrock_support.stream_to_claude3opus,
+    'claude-3.7-sonnet': bedrock_support.stream_to_claude37sonnet,
+}
+
 def execute_shell_command(cmd):
-    output = []
+    # Output is read in large chunks, written straight through to the terminal and captured in constant memory
+    capture = OutputCapture(spill=llm_config['shell_output_spill'])
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors='replace'), translate=True)
+    def write_output(data):
+        text = decoder.decode(data, final=not data)
+        if text:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            capture.write(text)
+
+    if llm_config['shell_session']:
+        import llm_shell.shell_session as shell_session
+        try:
+            returncode = shell_session.run_command(cmd, write_output)
+            write_output(b'')
+        except KeyboardInterrupt:
+            # The session can't tell how much of the command ran, so it is replaced with a fresh one
+            shell_session.reset_session()
+            returncode = 130
+            print("^C")
+            print('\t(shell session restarted, its variables and functions were reset)')
+        finally:
+            capture.close()
+        if returncode != 0:
+            print('process exited with code: ', returncode)
+        return capture, returncode
+
     process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT, text=True, env=os.environ)
+                               stderr=subprocess.STDOUT, env=os.environ)
     try:
-        for line in iter(process.stdout.readline, ''):
-            if line:
-                print(line, end='')
-                output.append(line)
+        fd = process.stdout.fileno()
+        while True:
+            data = os.read(fd, shell_output_chunk_size)
+            write_output(data)
+            if not data:
+                break
         process.wait()
     except KeyboardInterrupt:
         process.kill()
+        process.wait()
         print("^C")
+    finally:
+        process.stdout.close()
+        capture.close()
     if process.returncode != 0:
         print('process exited with code: ', process.returncode)
-    return ''.join(output), process.returncode
-
-def send_to_llm(context, show_spinner=True):
-    if llm_config['llm_backend'] not in support_llm_backends:
-        raise Exception(f"LLM backend '{llm_config['llm_backend']}' is not supported yet.")
-    backend_fun = support_llm_backends[llm_config['llm_backend']]
-    if show_spinner:
-        with start_spinner():
-            return backend_fun(context)
-    else:
-        return backend_fun(context)
+    return capture, process.returncode
+
+def send_to_llm(context, show_spinner=True, backend=None, use_cache=True):
+    backend = backend or llm_config['llm_backend']
+    if backend not in support_llm_backends:
+        raise Exception(f"LLM backend '{backend}' is not supported yet.")
+    backend_fun = support_llm_backends[backend]
+    bedrock_support.clear_last_usage()
+
+    cache_key = None
+    if llm_config['llm_cache'] and use_cache:
+        cache_key = response_cache.cache_key(backend, context)
+        cached_response = response_cache.get_cached_response(cache_key)
+        if cached_response is not None:
+            llm_stats.record_cache_hit(backend, context)
+            return cached_response
+
+    with llm_stats.CallTimer(backend, context, cache_status='miss' if cache_key else 'off') as timer:
+        if show_spinner:
+            with start_spinner():
+                response = backend_fun(context)
+        else:
+            response = backend_fun(context)
+        timer.set_response(response)
+
+    if cache_key and not response.startswith('Error:'):
+        response_cache.store_cached_response(cache_key, backend, response)
+    return response
+
+# one semaphore per event loop, shared by every concurrent llm request on that loop
+llm_semaphores = weakref.WeakKeyDictionary()
+
+def get_llm_semaphore():
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if loop not in llm_semaphores:
+        llm_semaphores[loop] = asyncio.Semaphore(llm_config['llm_concurrency'])
+    return llm_semaphores[loop]
+
+# The backends are blocking http calls, they run in a thread pool of their own with a thread for every concurrent
+# request, the default executor has only min(32, cpu + 4) threads and would cap llm_concurrency on small machines
+llm_executor = None
+
+def get_llm_executor():
+    global llm_executor
+    from concurrent.futures import ThreadPoolExecutor
+    if llm_executor is None or llm_executor._max_workers != llm_config['llm_concurrency']:
+        if llm_executor is not None:
+            llm_executor.shutdown(wait=False)
+        llm_executor = ThreadPoolExecutor(max_workers=llm_config['llm_concurrency'], thread_name_prefix='llm_request')
+    return llm_executor
+
+def to_async_backend(backend_fun):
+    import asyncio
+    async def async_backend_fun(context):
+        return await asyncio.get_running_loop().run_in_executor(get_llm_executor(), backend_fun, context)
+    return async_backend_fun
+
+async def send_to_llm_async(context, backend=None, use_cache=True, rate_limiter=None):
+    async with get_llm_semaphore():
+        # the rate limit is waited on only once a slot is free, so requests queued behind the semaphore don't
+        # spend their turn while waiting and then start in a burst
+        if rate_limiter:
+            await rate_limiter.wait()
+        return await to_async_backend(partial(send_to_llm, show_spinner=False, backend=backend, use_cache=use_cache))(context)
+
+async def gather_llm_requests(contexts, backend=None, use_cache=True):
+    import asyncio
+    return await asyncio.gather(*[ send_to_llm_async(context, backend=backend, use_cache=use_cache) for context in contexts ])
+
+def send_to_llm_concurrently(contexts, backend=None, use_cache=True):
+    # asyncio is only imported by the commands which send requests concurrently
+    import asyncio
+    return asyncio.run(gather_llm_requests(contexts, backend=backend, use_cache=use_cache))
+
+# sends requests concurrently on an event loop in a thread of its own, iterating yields the responses in the order
+# they arrive so the caller can act on the first ones while the rest are still being generated
+class ConcurrentLLMRequests:
+    def __init__(self, contexts, backend=None, use_cache=True):
+        import queue
+        import asyncio
+        self.remaining = len(contexts)
+        self.results = queue.Queue()
+        self.cancelled = False
+        self.tasks = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, args=(contexts, backend, use_cache), daemon=True)
+        self.thread.start()
+
+    def run(self, contexts, backend, use_cache):
+        import asyncio
+        async def send(context):
+            if self.cancelled:
+                return
+            try:
+                self.results.put((None, await send_to_llm_async(context, backend=backend, use_cache=use_cache)))
+            except Exception as e:
+                self.results.put((e, None))
+        async def send_all():
+            self.tasks = [ asyncio.ensure_future(send(context)) for context in contexts ]
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        try:
+            self.loop.run_until_complete(send_all())
+        finally:
+            self.loop.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.remaining == 0 or self.cancelled:
+            raise StopIteration
+        self.remaining -= 1
+        error, response = self.results.get()
+        if self.cancelled:
+            raise StopIteration
+        if error is not None:
+            raise error
+        return response
+
+    def cancel(self):
+        # requests still waiting for a concurrency slot are never sent, those in flight are no longer waited for
+        self.cancelled = True
+        try:
+            self.loop.call_soon_threadsafe(lambda: [ task.cancel() for task in self.tasks ])
+        except RuntimeError:
+            pass # every request has already finished
+        self.results.put((None, None))
+
+def can_stream_llm():
+    return llm_config['llm_stream'] and llm_config['llm_backend'] in support_llm_stream_backends
+
+def stream_llm(context):
+    backend = llm_config['llm_backend']
+    if backend not in support_llm_stream_backends:
+        raise Exception(f"LLM backend '{backend}' does not support streaming.")
+    backend_fun = support_llm_stream_backends[backend]
+    bedrock_support.clear_last_usage()
+
+    cache_key = None
+    if llm_config['llm_cache']:
+        cache_key = response_cache.cache_key(backend, context)
+        cached_response = response_cache.get_cached_response(cache_key)
+        if cached_response is not None:
+            llm_stats.record_cache_hit(backend, context)
+            yield cached_response
+            return
+
+    chunks = []
+    with llm_stats.CallTimer(backend, context, cache_status='miss' if cache_key else 'off', stream=True) as timer:
+        for chunk in backend_fun(context):
+            timer.first_token()
+            chunks.append(chunk)
+            yield chunk
+        response = ''.join(chunks).strip()
+        timer.set_response(response)
+
+    if cache_key and not response.startswith('Error:'):
+        response_cache.store_cached_response(cache_key, backend, response)
+
+def print_llm_stream(context):
+    # Print the response tokens as they arrive and return the full text for history
+    chunks = []
+    for chunk in stream_llm(context):
+        print(chunk, end='', flush=True)
+        chunks.append(chunk)
+    print('')
+    return ''.join(chunks).strip()
+
+def print_llm_diff_stream(context):
+    # Prints a diff response as it streams, applying each block to its file in memory as soon as its REPLACE line
+    # arrives, then writes the files once the response ends. Returns the response and the results of the blocks.
+    parser = DiffStreamParser()
+    change_set = ChangeSet()
+    chunks = []
+    for chunk in stream_llm(context):
+        print(chunk, end='', flush=True)
+        chunks.append(chunk)
+        for filepath, search_block, replace_block in parser.feed(chunk):
+            change_set.apply(filepath, search_block, replace_block)
+    for filepath, search_block, replace_block in parser.close():
+        change_set.apply(filepath, search_block, replace_block)
+    print('')
+    return ''.join(chunks).strip(), change_set.commit()
 
 def update_history(role, content):
     global history
     history.append({"role": role, "content": content})
-    history = history[-llm_config['llm_history_length']:]
+    history = history[-max(llm_config['llm_history_length'], max_history_length):]
+
+def get_context_budget():
+    if llm_config['llm_context_budget'] is None:
+        return default_context_budgets.get(llm_config['llm_backend'])
+    return llm_config['llm_context_budget']
+
+def order_llm_context(history_entries, context_file_entries, required_entries):
+    # Instructions and context files go first so that they form a stable prefix which backends can cache
+    system_entries = [ dict(entry, cache=True) for entry in required_entries if entry['role'] == 'system' ]
+    request_entries = [ entry for entry in required_entries if entry['role'] != 'system' ]
+    return system_entries + context_file_entries + history_entries + request_entries
+
+def build_llm_context(required_entries, context_file_entries=[], history_length=None):
+    history_length = history_length or llm_config['llm_history_length']
+    budget = get_context_budget()
+    if not budget:
+        # Without a budget, fall back to sending the last N messages of history
+        return order_llm_context(history[-history_length:], context_file_entries, required_entries)
+
+    # The instruction and the request itself are always sent, files come next, then as much of the last
+    # history_length messages as fits: the budget only ever trims the prompt further
+    remaining = budget - sum(estimate_message_tokens(entry) for entry in required_entries)
+    included_files = []
+    dropped_files = []
+    for entry in context_file_entries:
+        entry_tokens = estimate_message_tokens(entry)
+        if entry_tokens <= remaining:
+            included_files.append(entry)
+            remaining -= entry_tokens
+        else:
+            dropped_files.append(entry['content'].split('\n', 1)[0])
+
+    recent_history = history[-history_length:]
+    included_history = []
+    for message in reversed(recent_history):
+        message_tokens = estimate_message_tokens(message)
+        if message_tokens > remaining:
+            break
+        included_history.insert(0, message)
+        remaining -= message_tokens
+
+    dropped_history = len(recent_history) - len(included_history)
+    if dropped_files or dropped_history:
+        print(f"\t(context budget of {budget} tokens: dropped {dropped_history} history message(s){', ' if dropped_files else ''}{', '.join(dropped_files)})")
+    return order_llm_context(included_history, included_files, required_entries)
+
+def report_prompt_cache_usage():
+    # last_usage is only set by models which support prompt caching, and not by cached responses
+    usage = bedrock_support.last_usage
+    if llm_config['llm_prompt_caching'] and usage:
+        print(f"\t(prompt cache: read {usage.get('cache_read_input_tokens', 0)} tokens, wrote {usage.get('cache_creation_input_tokens', 0)} tokens)")
+
+def run_candidate_edits(diff_context, count):
+    # Generates several diffs at once and applies each to its own scratch copy of the working tree as soon as it
+    # arrives. The verifier starts in each copy right away and the first candidate to pass is applied to the real tree,
+    # the other verifiers are killed and the requests still running are cancelled.
+    # Returns the results of the promoted blocks, an empty list when no candidate made it, or None when the working
+    # tree is too large to copy for every candidate.
+    import llm_shell.candidates as candidates
+    root = os.getcwd()
+    total_size = candidates.workspace_size(root)
+    if total_size > candidates.max_workspace_bytes:
+        print(f"The working tree is {total_size // (1024 * 1024)} MB, over the {candidates.max_workspace_bytes // (1024 * 1024)} MB "
+            "limit for candidate workspaces, asking for a single edit instead.")
+        return None
+    print('')
+    print(f'[[generating {count} candidate edits:]]')
+    verifier_command = llm_config['experimental_verifier_command']
+    if verifier_command:
+        print(f"Racing verifier command in each candidate's workspace: {verifier_command}")
+    # the response cache would hand back the same diff for every candidate
+    requests = ConcurrentLLMRequests([ diff_context ] * count, use_cache=False)
+    with start_spinner():
+        all_candidates, winner = candidates.run_candidates(requests, verifier_command, root=root, cancel_responses=requests.cancel)
+    report_prompt_cache_usage()
+
+    for candidate in all_candidates:
+        print(f"Candidate {candidate.index + 1}: {candidate.describe()}")
+    if len(all_candidates) < count:
+        print(f"{count - len(all_candidates)} candidate request(s) cancelled")
+    if winner is None:
+        failed = [ candidate for candidate in all_candidates if candidate.status == 'failed' ]
+        if failed:
+            print(failed[0].output)
+        print('No candidate edit passed, no changes were made.')
+        return []
+
+    print('')
+    print(f'[[edit response (candidate {winner.index + 1}):]]')
+    print(apply_syntax_highlighting(winner.response, reindent_with_tabs=False))
+    if winner.output:
+        print(winner.output)
+    return apply_changes_batch(winner.blocks)
 
 def execute_verifier_command(verifier_command):
     if verifier_command:
         print(f"Executing verifier command: {verifier_command}")
         process_standard_command(verifier_command)
 
-def handle_llm_command(command, do_slow_print=False, **kwargs):
-    # Prepare the context
-    context = history[-llm_config['llm_history_length']:]
+def load_context_file(file_path, summarize):
+    signature = None
+    if llm_config['llm_context_cache']:
+        cached_contents, signature = context_cache.lookup(file_path, summarize)
+        if cached_contents is not None:
+            return cached_contents
+
+    file_contents = read_file_contents(file_path)
+    if file_contents and summarize:
+        file_contents = summarize_file(file_contents, file_path)
+    if llm_config['llm_context_cache']:
+        context_cache.store(file_path, summarize, signature, file_contents)
+    return file_contents
 
+def load_context_file_entries(summary_files, context_files):
     # Add file contents to context with summarization or as is
     context_file_entries = []
-    for file_var, summarize in (('summary_file', True), ('context_file', False)):
-        for file_path in llm_config[file_var]:
-            file_contents = read_file_contents(file_path)
+    for file_paths, summarize in ((summary_files, True), (context_files, False)):
+        for file_path in file_paths:
+            file_contents = load_context_file(file_path, summarize)
             if file_contents:
-                if summarize:
-                    file_contents = summarize_file(file_contents)
-                context_file_entries.append({"role": "user", "content": f'$ cat {file_path}{" | summarize" if summarize else ""}\n{file_contents}'})
-    context.extend(context_file_entries)
+                context_file_entries.append({"role": "user", "content": f'$ cat {file_path}{" | summarize" if summarize else ""}\n{file_contents}', "cache": True})
+    return context_file_entries
+
+def load_retrieved_context_entries(query):
+    # The most relevant chunks of the working tree for this request, from the repository index
+    if not llm_config['llm_context_index']:
+        return []
+    import llm_shell.repo_index as repo_index
+    # files which are already sent whole or summarized are skipped
+    chunks = repo_index.retrieve_chunks(query, llm_config['llm_context_index_top_k'], llm_config['llm_context_index_budget'],
+        exclude_paths=llm_config['context_file'] + llm_config['summary_file'])
+    return [ {"role": "user", "content": f"$ sed -n '{start_line},{end_line}p' {path}\n{text}"} for path, start_line, end_line, text in chunks ]
 
-    context.append({"role": "system", "content": llm_config['llm_instruction']})
-    context.append({"role": "user", "content": command})
+def handle_llm_command(command, do_slow_print=False, **kwargs):
+    # Prepare the context
+    context_file_entries = load_context_file_entries(llm_config['summary_file'], llm_config['context_file'])
+    context_file_entries += load_retrieved_context_entries(command)
+    required_entries = [{"role": "system", "content": llm_config['llm_instruction']}]
+    # In single-call agent mode the answer writes its own search/replace blocks, saving the second diff request
+    single_call = llm_config['experimental_llm_agent'] and llm_config['experimental_llm_agent_single_call']
+    if single_call:
+        import llm_shell.experimental_llm_agent as experimental_llm_agent
+        required_entries.append({"role": "system", "content": experimental_llm_agent.llm_single_call_instruction})
+    required_entries.append({"role": "user", "content": command})
+    context = build_llm_context(required_entries, context_file_entries)
+    context_file_entries = [ entry for entry in context_file_entries if entry in context ]
 
     # Send to LLM and process response
-    response = send_to_llm(context, **kwargs)
-    highlighted_response = apply_syntax_highlighting(response, reindent_with_tabs=llm_config['llm_reindent_with_tabs'])
-    if do_slow_print:
-        slow_print(highlighted_response)
+    change_results = []
+    if can_stream_llm():
+        if single_call:
+            response, change_results = print_llm_diff_stream(context)
+        else:
+            response = print_llm_stream(context)
     else:
-        print(highlighted_response)
+        response = send_to_llm(context, **kwargs)
+        highlighted_response = apply_syntax_highlighting(response, reindent_with_tabs=llm_config['llm_reindent_with_tabs'])
+        if do_slow_print:
+            slow_print(highlighted_response)
+        else:
+            print(highlighted_response)
+        if single_call:
+            change_results = apply_changes_batch(parse_diff_string(response))
+
+    report_prompt_cache_usage()
 
     # Record the debug history if the option is enabled
     if llm_config['record_debug_history']:
@@ -116,25 +521,124 @@ def handle_llm_command(command, do_slow_print=False, **kwargs):
 
     update_history("user", command)
     update_history("assistant", response)
-    if llm_config['experimental_llm_agent']:
+    verified = False
+    if llm_config['experimental_llm_agent'] and not change_results:
+        # Ask for the search/replace blocks in a second request, when the answer didn't include any
+        import llm_shell.experimental_llm_agent as experimental_llm_agent
         diff_context = []
+        diff_context.append({"role": "system", "content": experimental_llm_agent.llm_diff_instruction, "cache": True})
         diff_context.extend(context_file_entries)
         diff_context.append({"role": "user", "content": command})
         diff_context.append({"role": "assistant", "content": response})
-        diff_context.append({"role": "system", "content": experimental_llm_agent.llm_diff_instruction})
-        diff_response = send_to_llm(diff_context)
-        print('')
-        print('[[edit response:]]')
-        print(apply_syntax_highlighting(diff_response, reindent_with_tabs=False))
+        # the request ends on a user turn, an assistant turn at the end would be taken as a prefill to continue
+        diff_context.append({"role": "user", "content": experimental_llm_agent.llm_diff_request})
+        change_results = None
+        if llm_config['experimental_llm_agent_candidates'] > 1:
+            change_results = run_candidate_edits(diff_context, llm_config['experimental_llm_agent_candidates'])
+            # the promoted candidate already passed the verifier in its workspace
+            verified = change_results is not None
+        if change_results is None and can_stream_llm():
+            print('')
+            print('[[edit response:]]')
+            diff_response, change_results = print_llm_diff_stream(diff_context)
+            report_prompt_cache_usage()
+        elif change_results is None:
+            diff_response = send_to_llm(diff_context)
+            report_prompt_cache_usage()
+            print('')
+            print('[[edit response:]]')
+            print(apply_syntax_highlighting(diff_response, reindent_with_tabs=False))
+            change_results = apply_changes_batch(parse_diff_string(diff_response))
 
-        for filepath, search_block, replace_block in parse_diff_string(diff_response):
-            print(f"Applying changes to {filepath}...")
-            apply_changes(filepath, search_block, replace_block)
+    if llm_config['experimental_llm_agent']:
+        # Every file is written once with all of its blocks, or left untouched if one of them doesn't match
+        for filepath, search_block, status in change_results:
+            print(f"Applying changes to {filepath}... {status}")
 
         # Execute the verifier command after applying changes
-        if llm_config['experimental_verifier_command']:
+        if llm_config['experimental_verifier_command'] and not verified:
             exit_code = execute_verifier_command(llm_config['experimental_verifier_command'])
 
+# spaces out requests to a single backend so they never exceed the given rate
+class RateLimiter:
+    def __init__(self, requests_per_second):
+        import asyncio
+        self.interval = 1 / requests_per_second
+        self.next_time = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        import asyncio
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+def read_batch_prompts(batch_file):
+    prompts = []
+    for line in batch_file:
+        if line.strip():
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                # reported in the line's result, the rest of the batch still runs
+                item = { 'invalid': f'invalid JSON: {e}' }
+            prompts.append(item if type(item) is dict else { 'prompt': item })
+    return prompts
+
+async def run_llm_batch(prompts, output, order='input', rate_limit=None):
+    import asyncio
+    rate_limiters = {}
+    file_entries = {}
+    pending_results = {}
+    next_index = 0
+
+    def write_result(result):
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+
+    async def run_prompt(index, item):
+        backend = item.get('backend') or llm_config['llm_backend']
+        result = { 'index': index, 'id': item.get('id', index), 'backend': backend }
+        if rate_limit and backend not in rate_limiters:
+            rate_limiters[backend] = RateLimiter(rate_limit)
+        # A bad line or a missing file fails only its own prompt, and is reported in its result rather than printed
+        # into the results
+        try:
+            if 'invalid' in item:
+                raise Exception(item['invalid'])
+            if 'prompt' not in item:
+                raise Exception("missing 'prompt'")
+            context_files = llm_config['context_file'] + item.get('context', [])
+            for file_path in llm_config['summary_file'] + context_files:
+                if not os.path.isfile(file_path):
+                    raise Exception(f"File '{file_path}' not found")
+            # Context files are shared by many prompts, so only read each set once
+            files_key = tuple(context_files)
+            if files_key not in file_entries:
+                file_entries[files_key] = load_context_file_entries(llm_config['summary_file'], context_files)
+            context = list(file_entries[files_key])
+            context.append({"role": "system", "content": item.get('instruction', llm_config['llm_instruction'])})
+            context.append({"role": "user", "content": item['prompt']})
+            result['response'] = await send_to_llm_async(context, backend=backend, rate_limiter=rate_limiters.get(backend))
+        except Exception as e:
+            result['error'] = str(e)
+        return result
+
+    tasks = [ asyncio.create_task(run_prompt(index, item)) for index, item in enumerate(prompts) ]
+    for task in asyncio.as_completed(tasks):
+        result = await task
+        if order == 'completion':
+            write_result(result)
+        else:
+            # Hold results back until every earlier prompt has been written
+            pending_results[result['index']] = result
+            while next_index in pending_results:
+                write_result(pending_results.pop(next_index))
+                next_index += 1
+
 def handle_llm_bash_agent_loop(command):
     next_command = command
     while handle_llm_bash_agent_command(next_command) > 0:
@@ -145,9 +649,6 @@ def handle_llm_bash_agent_loop(command):
     print("no commands executed, bash agent complete!")
 
 def handle_llm_bash_agent_command(command):
-    # Prepare the context
-    context = history[-llm_config['llm_history_length']*2:]
-
     instruction = '''You are a bash agent.
 Plan and write the bash commands to be executed in this shell to implement the user's requests.
 Anything outside of triple markdown quotes will be ignored.
@@ -171,8 +672,11 @@ Make sure to add verification commands to check that our executions were success
 When the user's task is completed, output no commands to indicate a completed job.
 '''
 
-    context.append({"role": "system", "content": instruction})
-    context.append({"role": "user", "content": command})
+    # Prepare the context
+    context = build_llm_context([
+        {"role": "system", "content": instruction},
+        {"role": "user", "content": command},
+    ], history_length=llm_config['llm_history_length']*2)
 
     # Send to LLM and process response
     response = send_to_llm(context)
@@ -192,9 +696,6 @@ When the user's task is completed, output no commands to indicate a completed jo
     return commands_executed
 
 def handle_llm_bash_agent_analysis():
-    # Prepare the context
-    context = history[-llm_config['llm_history_length']*2:]
-
     instruction = '''You are an analysis tool.
 Analyze whether the assistant correct implemented the user's request.
 If the request is complete, state it as such. Emphasis that no additional commands should be executed.
@@ -205,7 +706,10 @@ Explain what went wrong, explain what went right.
 Restate the user's request, and state the next steps to the bash agent.
 '''
 
-    context.append({"role": "system", "content": instruction})
+    # Prepare the context
+    context = build_llm_context([
+        {"role": "system", "content": instruction},
+    ], history_length=llm_config['llm_history_length']*2)
 
     # Send to LLM and process response
     response = send_to_llm(context)
@@ -245,6 +749,113 @@ def set_config_arg(module, option, *value, custom_parser=None, censor_value=Fals
         else:
             print(option + ':', getattr(module, option) if not censor_value else '[...]')
 
+def handle_cache_command(*args):
+    action = args[0].lower() if args else ''
+    if action in ('on', 'off'):
+        set_config_arg(llm_config, 'llm_cache', action, custom_parser=lambda s: s == 'on')
+    elif action == 'clear':
+        print(f"cleared {response_cache.clear_cache()} cached response(s)")
+    elif action == 'stats':
+        stats = response_cache.cache_stats()
+        print(f"llm_cache: {'on' if llm_config['llm_cache'] else 'off'}, {stats['entries']} entries ({stats['size']} bytes) in {response_cache.cache_dir}")
+        print(f"session hits: {stats['hits']}, misses: {stats['misses']}")
+    else:
+        print('llm_cache:', 'on' if llm_config['llm_cache'] else 'off')
+
+def parse_context_budget(value):
+    if value.lower() == 'auto':
+        return None
+    elif value.lower() == 'off':
+        return 0
+    else:
+        return int(value)
+
+def apply_bedrock_config():
+    bedrock_support.bedrock_prompt_caching = llm_config['llm_prompt_caching']
+
+def set_bedrock_config_arg(option, *value, custom_parser=None):
+    set_config_arg(llm_config, option, *value, custom_parser=custom_parser)
+    if len(value) > 0:
+        apply_bedrock_config()
+
+def apply_context_cache_config():
+    if llm_config['llm_context_cache'] and llm_config['llm_context_cache_inotify']:
+        if not context_cache.enable_inotify():
+            print('\t warning: inotify invalidation needs the inotify_simple package, falling back to stat checks')
+    else:
+        context_cache.disable_inotify()
+
+def handle_context_cache_command(*args):
+    action = args[0].lower() if args else ''
+    if action in ('on', 'off'):
+        set_config_arg(llm_config, 'llm_context_cache', action, custom_parser=lambda s: s == 'on')
+        if action == 'off':
+            context_cache.clear()
+    elif action == 'inotify':
+        set_config_arg(llm_config, 'llm_context_cache_inotify', *args[1:2], custom_parser=lambda s: s.lower() in ('on', 'true'))
+    elif action == 'clear':
+        context_cache.clear()
+        print('cleared the context file cache')
+    else:
+        stats = context_cache.stats()
+        print(f"llm_context_cache: {'on' if llm_config['llm_context_cache'] else 'off'}, {stats['entries']} file(s) ({stats['size']} chars) cached, inotify: {'on' if stats['inotify'] else 'off'}")
+        print(f"session hits: {stats['hits']}, misses: {stats['misses']}")
+    apply_context_cache_config()
+
+def handle_context_index_command(*args):
+    import llm_shell.repo_index as repo_index
+    action = args[0].lower() if args else 'status'
+    if action in ('on', 'off'):
+        set_config_arg(llm_config, 'llm_context_index', action, custom_parser=lambda s: s == 'on')
+    elif action == 'build':
+        index, updated = repo_index.build_index()
+        print(f"indexed {len(index.files)} file(s) into {len(index.chunks)} chunk(s), {updated} file(s) updated")
+    elif action == 'clear':
+        repo_index.clear_index()
+        print('cleared the context index for this directory')
+    elif action == 'top-k':
+        set_config_arg(llm_config, 'llm_context_index_top_k', *args[1:2], custom_parser=lambda s: int(s))
+    elif action == 'budget':
+        set_config_arg(llm_config, 'llm_context_index_budget', *args[1:2], custom_parser=lambda s: int(s))
+    else:
+        stats = repo_index.index_stats()
+        print(f"llm_context_index: {'on' if llm_config['llm_context_index'] else 'off'}, top-k: {llm_config['llm_context_index_top_k']}, budget: {llm_config['llm_context_index_budget']} tokens")
+        if stats['built']:
+            print(f"index of {stats['root']}: {stats['files']} file(s), {stats['chunks']} chunk(s), {stats['terms']} term(s)")
+        else:
+            print(f"no index built for {stats['root']} yet, run 'context-index build'")
+
+def handle_stats_command(*args):
+    if len(args) >= 2 and args[0].lower() == 'export':
+        print(f"exported {llm_stats.export_call_records(args[1])} request record(s) to {args[1]}")
+    elif args and args[0].lower() == 'clear':
+        llm_stats.clear_call_records()
+        print('cleared llm request stats')
+    else:
+        print(llm_stats.format_stats(llm_stats.get_call_records()))
+        print(llm_stats.format_warmup_stats())
+
+def set_llm_backend(*value):
+    set_config_arg(llm_config, 'llm_backend', *value)
+    # build the bedrock client in the background while the user types their request
+    if len(value) > 0 and llm_config['llm_backend'].startswith('claude'):
+        bedrock_support.prewarm_bedrock_client()
+
+def apply_http_config():
+    chatgpt_support.configure_http_session(pool_size=llm_config['http_pool_size'],
+        max_retries=llm_config['http_max_retries'], timeout=llm_config['http_timeout'])
+
+def set_shell_session_arg(*value):
+    set_config_arg(llm_config, 'shell_session', *value, custom_parser=lambda s: s.lower() == 'true')
+    if not llm_config['shell_session']:
+        import llm_shell.shell_session as shell_session
+        shell_session.reset_session()
+
+def set_http_config_arg(option, *value, custom_parser=None):
+    set_config_arg(llm_config, option, *value, custom_parser=custom_parser)
+    if len(value) > 0:
+        apply_http_config()
+
 commands = {
     'help': lambda: print(f"""LLM Shell v{version}:
 help - Show this help message.
@@ -252,35 +863,77 @@ exit - Exit the shell.
 llm-backend [backend] - Set the language model backend (e.g., gpt-4-turbo, gpt-4, gpt-3.5-turbo).
 llm-instruction [instruction] - Set the instruction for the language model (use 'none' to clear).
 llm-reindent-with-tabs [true/false] - Set the llm_reindent_with_tabs mode (defaults to 'true').
-llm-history-length [5] - Set the length of history to send to llms. More history == more cost.
+llm-history-length [5] - Set the length of history to send to llms when llm-context-budget is off. More history == more cost.
+llm-context-budget [auto/off/tokens] - Set the token budget for history and context files sent to llms (defaults to 'auto', a per-backend budget).
 llm-chatgpt-apikey [apikey] - Set API key for OpenAI's models.
+llm-chatgpt-base-url [url] - Set the base url of the OpenAI compatible api (e.g. a local mock server).
+llm-bedrock-endpoint-url [url] - Set a custom endpoint url for Bedrock (e.g. a local mock server).
+llm-bedrock-region [region] - Set the AWS region used for Bedrock models.
+llm-bedrock-profile [profile] - Set the AWS profile used for Bedrock models.
+llm-prompt-caching [true/false] - Mark instructions and context files as a cacheable prefix for Bedrock prompt caching.
+llm-http-pool-size [10] - Set the number of keep-alive connections kept open to the llm api.
+llm-http-retries [2] - Set how many times a failed llm api request is retried.
+llm-http-timeout [120] - Set the timeout in seconds for llm api requests.
+llm-context-cache [on/off/inotify on|off/clear/stats] - Reuse context and summary file contents until the files change.
+llm-cache [on/off/clear/stats] - Cache llm responses on disk and reuse them for identical requests.
+llm-concurrency [4] - Set how many llm requests may run at once when requests are sent concurrently.
+llm-stats [export file.jsonl/clear] - Show latency percentiles, token usage and cost per backend for this session.
+llm-shell-session [true/false] - Run shell commands in one persistent bash session, keeping exported variables, functions and virtualenvs between commands.
+llm-shell-warmup [true/false] - Build caches and open the llm api connection in the background when the shell starts (defaults to 'true').
+llm-shell-output-spill [true/false] - Save the full output of long shell commands to a temporary file, only its head and tail are kept in history.
+llm-stream [true/false] - Print the response as it is generated, for backends which support streaming (defaults to 'true').
 llm-experimental-agent [true/false] - Allows the llm to write/edit files on its own. Beware: highly experimental.
+llm-experimental-agent-single-call [true/false] - Has the agent write its search/replace blocks in the answer itself, skipping the second edit request unless the answer has none.
+llm-experimental-agent-candidates [1] - Has the agent write this many candidate edits at once and keep the first to pass the verifier, each tested in its own copy of the working tree.
 llm-experimental-verifier [./run_unittest.py] - Gives a command to run your unit tests and verify after the llm-agent has completed. Beware: highly experimental.
 llm-experimental-bash-agent [true/false] - Runs a looping bash agent with your request. Beware: highly experimental.
 context [filename] - Set a file to use as context for the language model (use 'none' to clear).
 summary [filename] - Set a summary file to use as context for the language model (use 'none' to clear).
+context-index [build/status/on/off/clear/top-k 8/budget 4000] - Send the chunks of the working tree most relevant to each request, from a local search index.
 # [command] - Use the hash sign to prefix any shell command for the language model to process.
 cd [directory] - Change the current working directory.
 [shell command] - Execute any standard shell command.
 Use the tab key to autocomplete commands and file names."""),
     'exit': sys.exit,
     'cd': lambda path: os.chdir(path.strip()),
-    'llm-backend': partial(set_config_arg, llm_config, 'llm_backend'),
+    'llm-backend': set_llm_backend,
     'llm-instruction': partial(set_config_arg, llm_config, 'llm_instruction'),
     'llm-reindent-with-tabs': partial(set_config_arg, llm_config, 'llm_reindent_with_tabs', custom_parser=lambda s: s.lower() == 'true'),
     'llm-experimental-agent': partial(set_config_arg, llm_config, 'experimental_llm_agent', custom_parser=lambda s: s.lower() == 'true'),
+    'llm-experimental-agent-single-call': partial(set_config_arg, llm_config, 'experimental_llm_agent_single_call', custom_parser=lambda s: s.lower() == 'true'),
+    'llm-experimental-agent-candidates': partial(set_config_arg, llm_config, 'experimental_llm_agent_candidates', custom_parser=lambda s: int(s)),
     'llm-experimental-bash-agent': partial(set_config_arg, llm_config, 'experimental_bash_agent', custom_parser=lambda s: s.lower() == 'true'),
     'llm-experimental-verifier': partial(set_config_arg, llm_config, 'experimental_verifier_command'),
     'llm-record-debug-history': partial(set_config_arg, llm_config, 'record_debug_history', custom_parser=lambda s: s.lower() == 'true'),
     'llm-history-length': partial(set_config_arg, llm_config, 'llm_history_length', custom_parser=lambda s: int(s)),
+    'llm-prompt-caching': partial(set_bedrock_config_arg, 'llm_prompt_caching', custom_parser=lambda s: s.lower() == 'true'),
+    'llm-http-pool-size': partial(set_http_config_arg, 'http_pool_size', custom_parser=lambda s: int(s)),
+    'llm-http-retries': partial(set_http_config_arg, 'http_max_retries', custom_parser=lambda s: int(s)),
+    'llm-http-timeout': partial(set_http_config_arg, 'http_timeout', custom_parser=lambda s: float(s)),
+    'llm-context-cache': handle_context_cache_command,
+    'llm-cache': handle_cache_command,
+    'llm-concurrency': partial(set_config_arg, llm_config, 'llm_concurrency', custom_parser=lambda s: int(s)),
+    'llm-context-budget': partial(set_config_arg, llm_config, 'llm_context_budget', custom_parser=parse_context_budget),
+    'llm-stats': handle_stats_command,
+    'llm-shell-session': set_shell_session_arg,
+    'llm-shell-warmup': partial(set_config_arg, llm_config, 'shell_warmup', custom_parser=lambda s: s.lower() == 'true'),
+    'llm-shell-output-spill': partial(set_config_arg, llm_config, 'shell_output_spill', custom_parser=lambda s: s.lower() == 'true'),
+    'llm-stream': partial(set_config_arg, llm_config, 'llm_stream', custom_parser=lambda s: s.lower() == 'true'),
     'llm-chatgpt-apikey': partial(set_config_arg, chatgpt_support, 'chatgpt_api_key', censor_value=True),
+    'llm-chatgpt-base-url': partial(set_config_arg, chatgpt_support, 'chatgpt_base_url'),
+    'llm-bedrock-endpoint-url': partial(set_config_arg, bedrock_support, 'bedrock_endpoint_url'),
+    'llm-bedrock-region': partial(set_config_arg, bedrock_support, 'bedrock_region'),
+    'llm-bedrock-profile': partial(set_config_arg, bedrock_support, 'bedrock_profile'),
     'context': partial(set_file_arg, 'context_file'),
     'summary': partial(set_file_arg, 'summary_file'),
+    'context-index': handle_context_index_command,
 }
 
 def process_standard_command(command):
-    output, exit_code = execute_shell_command(command)
-    shortened_output = shorten_output(output)
+    capture, exit_code = execute_shell_command(command)
+    shortened_output = capture.getvalue()
+    if capture.spill_path:
+        shortened_output += f'\n(full output saved to {capture.spill_path})'
     if exit_code == 0:
         update_history('user', f'$ {command}\n{shortened_output}')
     else:
@@ -302,8 +955,22 @@ def handle_command(command):
     else:
         process_standard_command(command)
 
+# completions of the current tab press, readline asks for them one state at a time
+last_completion_key = None
+last_completions = []
+
 def autocomplete_string(text, state):
+    global last_completion_key, last_completions
+    import readline
     full_input = readline.get_line_buffer()
+    # Only compute the completions once per tab press and reuse them for every following state
+    if state > 0 and last_completion_key == (full_input, text):
+        return last_completions[state] if state < len(last_completions) else None
+    last_completion_key = (full_input, text)
+    last_completions = list_completions(full_input, text)
+    return last_completions[state] if state < len(last_completions) else None
+
+def list_completions(full_input, text):
     split_input = full_input.split()
 
     # Custom commands for autocompletion
@@ -333,15 +1000,42 @@ def autocomplete_string(text, state):
         completions = [c for c in custom_commands if c.startswith(text)]
     else:
         # Autocomplete program names from PATH
-        path_completions = []
-        for path_dir in os.environ['PATH'].split(os.pathsep):
-            path_completions.extend(glob.glob(os.path.join(path_dir, text) + '*'))
-        completions = [os.path.basename(p) for p in path_completions]  # Use basename for commands
+        completions = completion.executable_index.complete(text)
+
+    return sorted(set(completions))  # Remove duplicates and sort
 
-    completions = sorted(list(set(completions)))  # Remove duplicates and sort
-    return completions[state]
+def warm_up_shell():
+    # Pays the cold start costs of the first tab press and request while the user is still typing
+    steps = [
+        ('executable_index', completion.executable_index.refresh),
+        ('syntax_highlighting', warm_syntax_highlighting),
+    ]
+    if llm_config['llm_context_cache']:
+        # missing files are skipped rather than reported in the middle of the prompt, the request reports them
+        existing = lambda file_paths: [ file_path for file_path in file_paths if os.path.isfile(file_path) ]
+        steps.append(('context_files', lambda: load_context_file_entries(existing(llm_config['summary_file']), existing(llm_config['context_file']))))
+    if llm_config['llm_backend'].startswith('openai') and chatgpt_support.chatgpt_api_key:
+        steps.append(('http_connection', chatgpt_support.warm_http_connection))
+    elif llm_config['llm_backend'].startswith('claude'):
+        steps.append(('bedrock_client', bedrock_support.get_bedrock_client))
+
+    for step, warm in steps:
+        start = time.perf_counter()
+        try:
+            warm()
+        except Exception:
+            continue # the error will surface again on first real use
+        llm_stats.record_warmup(step, time.perf_counter() - start)
+
+def start_warmup():
+    thread = threading.Thread(target=warm_up_shell, daemon=True)
+    thread.start()
+    return thread
 
 def run_llm_shell():
+    # readline is only needed by the interactive shell, not by llm-shell-ask
+    import readline
+    import traceback
     # Set the tab completion function
     readline.set_completer_delims(' \t\n;')
     readline.set_completer(autocomplete_string)
@@ -377,6 +1071,11 @@ def main():
 
     # Load the LLM config from file
     load_llm_config_from_file(config_path=os.path.join(os.path.expanduser('~'), '.llm_shell_config'), llm_config=llm_config)
+    apply_http_config()
+    apply_bedrock_config()
+    apply_context_cache_config()
+    if llm_config['shell_warmup']:
+        start_warmup()
 
     # Start the LLM shell
     run_llm_shell()
@@ -388,11 +1087,19 @@ def ask_llm():
     parser.add_argument('-v', '--version', action='version', version='LLM Shell v' + version)
     parser.add_argument('-in', '--stdin', action='store_true', help='Read input from stdin.')
     parser.add_argument('-c', '--context', action='append', default=[], help='Set a file to use as context for the language model.')
+    parser.add_argument('-b', '--batch', help='Run every prompt in a JSONL file and write the responses as JSONL.')
+    parser.add_argument('-o', '--output', help='Write batch results to this file instead of stdout.')
+    parser.add_argument('--order', choices=['input', 'completion'], default='input', help='Write batch results in input order or as soon as each completes.')
+    parser.add_argument('-j', '--concurrency', type=int, help='Maximum number of batch requests to run at once.')
+    parser.add_argument('--rate-limit', type=float, help='Maximum requests per second to send to each backend in batch mode.')
     parser.add_argument('topic', nargs='?', default='', help='The topic or question to ask the LLM.')
 
     # Parse the arguments
     args = parser.parse_args()
 
+    if args.batch:
+        return ask_llm_batch(args)
+
     # Read available stdin if --stdin is provided
     if args.stdin:
         stdin_content = sys.stdin.read()
@@ -412,6 +1119,9 @@ def ask_llm():
 
     # Load the LLM config from file
     load_llm_config_from_file(config_path=os.path.join(os.path.expanduser('~'), '.llm_shell_config'), llm_config=llm_config)
+    apply_http_config()
+    apply_bedrock_config()
+    apply_context_cache_config()
 
     # Set the context_file from the -c/--context arguments
     llm_config['context_file'] = args.context
@@ -419,3 +1129,25 @@ def ask_llm():
     response = handle_llm_command(query, show_spinner=False)
     print(response)
 
+def ask_llm_batch(args):
+    # Load the LLM config from file
+    load_llm_config_from_file(config_path=os.path.join(os.path.expanduser('~'), '.llm_shell_config'), llm_config=llm_config)
+    apply_http_config()
+    apply_bedrock_config()
+    apply_context_cache_config()
+
+    llm_config['context_file'] = args.context
+    if args.concurrency:
+        llm_config['llm_concurrency'] = args.concurrency
+
+    with (sys.stdin if args.batch == '-' else open(args.batch, 'r')) as batch_file:
+        prompts = read_batch_prompts(batch_file)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    import asyncio
+    try:
+        asyncio.run(run_llm_batch(prompts, output, order=args.order, rate_limit=args.rate_limit))
+    finally:
+        if args.output:
+            output.close()
+
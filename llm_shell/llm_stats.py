@@ -0,0 +1,140 @@
+import json
+import math
+import time
+import threading
+
+
+
+# per-request instrumentation of every backend call made during the session
+call_records = []
+call_records_lock = threading.Lock()
+
+# the record of the call currently running on this thread, so backends can attach their token usage to it
+current_call = threading.local()
+
+def report_usage(input_tokens=None, output_tokens=None, cost=None, cache_read_tokens=None, cache_write_tokens=None):
+    record = getattr(current_call, 'record', None)
+    if record is None:
+        return
+    for key, value in (('input_tokens', input_tokens), ('output_tokens', output_tokens), ('cost', cost),
+            ('cache_read_tokens', cache_read_tokens), ('cache_write_tokens', cache_write_tokens)):
+        if value is not None:
+            record[key] = value
+
+class CallTimer:
+    def __init__(self, backend, context, cache_status='off', stream=False):
+        self.record = {
+            'timestamp': time.time(),
+            'backend': backend,
+            'stream': stream,
+            'cache': cache_status,
+            'context_messages': len(context),
+            'context_chars': sum(len(step['content']) for step in context),
+            'latency': None,
+            'time_to_first_token': None,
+            'input_tokens': None,
+            'output_tokens': None,
+            'cost': None,
+            'cache_read_tokens': None,
+            'cache_write_tokens': None,
+            'error': False,
+        }
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        current_call.record = self.record
+        return self
+
+    def first_token(self):
+        if self.record['time_to_first_token'] is None:
+            self.record['time_to_first_token'] = time.perf_counter() - self.start
+
+    def set_response(self, response):
+        if response.startswith('Error:'):
+            self.record['error'] = True
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.record['latency'] = time.perf_counter() - self.start
+        # A blocking call delivers its first token along with the rest of the response
+        if self.record['time_to_first_token'] is None:
+            self.record['time_to_first_token'] = self.record['latency']
+        if exception_type is not None:
+            self.record['error'] = True
+        current_call.record = None
+        with call_records_lock:
+            call_records.append(self.record)
+
+def record_cache_hit(backend, context):
+    with CallTimer(backend, context, cache_status='hit'):
+        pass
+
+def percentile(values, percent):
+    # nearest-rank percentile
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = math.ceil(percent / 100 * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+def summarize_records(records):
+    summaries = {}
+    for backend in sorted(set(record['backend'] for record in records)):
+        backend_records = [ record for record in records if record['backend'] == backend ]
+        summary = {
+            'calls': len(backend_records),
+            'errors': sum(1 for record in backend_records if record['error']),
+            'cache_hits': sum(1 for record in backend_records if record['cache'] == 'hit'),
+        }
+        for field in ('latency', 'time_to_first_token'):
+            values = [ record[field] for record in backend_records if record[field] is not None and record['cache'] != 'hit' ]
+            for percent in (50, 95, 99):
+                summary[f'{field}_p{percent}'] = percentile(values, percent)
+        for field in ('input_tokens', 'output_tokens', 'cost', 'cache_read_tokens', 'cache_write_tokens', 'context_chars'):
+            summary[field] = sum(record[field] or 0 for record in backend_records)
+        summaries[backend] = summary
+    return summaries
+
+def format_seconds(value):
+    return '-' if value is None else f'{value * 1000:.0f}ms'
+
+def format_stats(records):
+    if not records:
+        return 'no llm requests recorded in this session'
+    lines = []
+    for backend, summary in summarize_records(records).items():
+        lines.append(f"{backend}: {summary['calls']} call(s), {summary['errors']} error(s), {summary['cache_hits']} cache hit(s)")
+        lines.append(f"\tlatency p50/p95/p99: {format_seconds(summary['latency_p50'])} / {format_seconds(summary['latency_p95'])} / {format_seconds(summary['latency_p99'])}")
+        lines.append(f"\ttime to first token p50/p95/p99: {format_seconds(summary['time_to_first_token_p50'])} / {format_seconds(summary['time_to_first_token_p95'])} / {format_seconds(summary['time_to_first_token_p99'])}")
+        lines.append(f"\ttokens in/out: {summary['input_tokens']} / {summary['output_tokens']}, prompt cache read/write: {summary['cache_read_tokens']} / {summary['cache_write_tokens']}")
+        lines.append(f"\tcontext sent: {summary['context_chars']} chars, estimated cost: ${summary['cost']:.4f}")
+    return '\n'.join(lines)
+
+# seconds spent on each background warm-up step at startup, work the first tab press or request would otherwise pay for
+warmup_timings = {}
+
+def record_warmup(step, seconds):
+    with call_records_lock:
+        warmup_timings[step] = seconds
+
+def format_warmup_stats():
+    with call_records_lock:
+        timings = dict(warmup_timings)
+    if not timings:
+        return 'no startup warm-up recorded in this session'
+    steps = ', '.join(f'{step} {format_seconds(seconds)}' for step, seconds in timings.items())
+    return f'startup warm-up: {format_seconds(sum(timings.values()))} moved off the prompt in the background ({steps})'
+
+def get_call_records():
+    with call_records_lock:
+        return list(call_records)
+
+def clear_call_records():
+    with call_records_lock:
+        call_records.clear()
+
+def export_call_records(path):
+    records = get_call_records()
+    with open(path, 'w') as export_file:
+        for record in records:
+            export_file.write(json.dumps(record) + '\n')
+    return len(records)
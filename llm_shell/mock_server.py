@@ -0,0 +1,267 @@
+import re
+import sys
+import json
+import time
+import zlib
+import base64
+import random
+import struct
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from llm_shell.util import estimate_tokens
+
+
+
+# a local stand-in for the openai chat completions api and the bedrock invoke api,
+# used to benchmark and load-test the shell without a network
+
+token_split_regex = re.compile(r'\S+\s*|\s+')
+
+def split_response_tokens(text):
+    return token_split_regex.findall(text)
+
+# encodes one message of the aws event stream format used by invoke-with-response-stream
+def encode_event_stream_message(headers, payload):
+    encoded_headers = b''
+    for name, value in headers.items():
+        name_bytes = name.encode('utf-8')
+        value_bytes = value.encode('utf-8')
+        # header value type 7 is a utf-8 string
+        encoded_headers += struct.pack('>B', len(name_bytes)) + name_bytes + struct.pack('>BH', 7, len(value_bytes)) + value_bytes
+    total_length = 12 + len(encoded_headers) + len(payload) + 4
+    prelude = struct.pack('>II', total_length, len(encoded_headers))
+    prelude += struct.pack('>I', zlib.crc32(prelude))
+    message = prelude + encoded_headers + payload
+    return message + struct.pack('>I', zlib.crc32(message))
+
+def encode_bedrock_chunk(event):
+    payload = json.dumps({ 'bytes': base64.b64encode(json.dumps(event).encode('utf-8')).decode('ascii') }).encode('utf-8')
+    return encode_event_stream_message({
+        ':event-type': 'chunk',
+        ':content-type': 'application/json',
+        ':message-type': 'event',
+    }, payload)
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, responses=None, token_latency=0.0, first_token_latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        super().__init__(server_address, MockLLMRequestHandler)
+        self.responses = responses or []
+        self.token_latency = token_latency
+        self.first_token_latency = first_token_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def handle_error(self, request, client_address):
+        # clients which hang up mid-stream (cancelled requests, timeouts in load tests) are expected, not errors
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+    def next_response(self, messages):
+        with self.lock:
+            index = self.request_count
+            self.request_count += 1
+        if self.responses:
+            return self.responses[index % len(self.responses)]
+        # Without canned responses, echo the last user message back
+        last_message = next((message for message in reversed(messages) if message['role'] == 'user'), { 'content': '' })
+        content = last_message['content']
+        if type(content) is list:
+            content = ''.join(block.get('text', '') for block in content)
+        return f'mock response to: {content[-200:]}'
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def delay(self, latency):
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0
+        if latency + jitter > 0:
+            time.sleep(latency + jitter)
+
+class MockLLMRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def end_chunked(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def do_HEAD(self):
+        # used by clients to open a connection ahead of the first request
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.endswith('/models'):
+            self.send_json(200, { 'object': 'list', 'data': [ { 'id': 'mock-model', 'object': 'model' } ] })
+        else:
+            self.send_json(404, { 'error': { 'message': f'unknown path {self.path}' } })
+
+    def do_POST(self):
+        data = self.read_json_body()
+        if self.path.endswith('/chat/completions'):
+            self.handle_chat_completions(data)
+        elif re.match(r'^/model/[^/]+/invoke$', self.path):
+            self.handle_bedrock_invoke(data, stream=False)
+        elif re.match(r'^/model/[^/]+/invoke-with-response-stream$', self.path):
+            self.handle_bedrock_invoke(data, stream=True)
+        else:
+            self.send_json(404, { 'error': { 'message': f'unknown path {self.path}' } })
+
+    def handle_chat_completions(self, data):
+        server = self.server
+        if server.should_fail():
+            self.send_json(500, { 'error': { 'message': 'mock server error', 'type': 'server_error' } })
+            return
+
+        tokens = split_response_tokens(server.next_response(data.get('messages', [])))
+        usage = {
+            'prompt_tokens': sum(estimate_tokens(message['content']) for message in data.get('messages', [])),
+            'completion_tokens': len(tokens),
+        }
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        model = data.get('model', 'mock-model')
+
+        server.delay(server.first_token_latency)
+        if not data.get('stream'):
+            server.delay(server.token_latency * len(tokens))
+            self.send_json(200, {
+                'id': 'chatcmpl-mock', 'object': 'chat.completion', 'model': model,
+                'choices': [ { 'index': 0, 'message': { 'role': 'assistant', 'content': ''.join(tokens) }, 'finish_reason': 'stop' } ],
+                'usage': usage,
+            })
+            return
+
+        self.start_chunked('text/event-stream')
+        def write_event(event):
+            self.write_chunk(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+        write_event({ 'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'model': model,
+            'choices': [ { 'index': 0, 'delta': { 'role': 'assistant', 'content': '' } } ] })
+        for token in tokens:
+            server.delay(server.token_latency)
+            write_event({ 'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'model': model,
+                'choices': [ { 'index': 0, 'delta': { 'content': token } } ] })
+        write_event({ 'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'model': model,
+            'choices': [ { 'index': 0, 'delta': {}, 'finish_reason': 'stop' } ] })
+        if data.get('stream_options', {}).get('include_usage'):
+            write_event({ 'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'model': model, 'choices': [], 'usage': usage })
+        self.write_chunk(b'data: [DONE]\n\n')
+        self.end_chunked()
+
+    def handle_bedrock_invoke(self, data, stream):
+        server = self.server
+        if server.should_fail():
+            self.send_response(500)
+            body = json.dumps({ 'message': 'mock server error' }).encode('utf-8')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('x-amzn-ErrorType', 'InternalServerException')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        messages = data.get('messages', [])
+        system = data.get('system', '')
+        system_text = system if type(system) is str else ''.join(block.get('text', '') for block in system)
+        tokens = split_response_tokens(server.next_response(messages))
+        input_tokens = estimate_tokens(system_text) + sum(estimate_tokens(block.get('text', ''))
+            for message in messages for block in message['content'])
+        usage = { 'input_tokens': input_tokens, 'output_tokens': len(tokens), 'cache_read_input_tokens': 0, 'cache_creation_input_tokens': 0 }
+
+        server.delay(server.first_token_latency)
+        if not stream:
+            server.delay(server.token_latency * len(tokens))
+            self.send_json(200, {
+                'id': 'msg_mock', 'type': 'message', 'role': 'assistant',
+                'content': [ { 'type': 'text', 'text': ''.join(tokens) } ],
+                'stop_reason': 'end_turn', 'usage': usage,
+            })
+            return
+
+        self.start_chunked('application/vnd.amazon.eventstream')
+        self.write_chunk(encode_bedrock_chunk({ 'type': 'message_start', 'message': {
+            'id': 'msg_mock', 'type': 'message', 'role': 'assistant', 'content': [], 'usage': dict(usage, output_tokens=0) } }))
+        self.write_chunk(encode_bedrock_chunk({ 'type': 'content_block_start', 'index': 0, 'content_block': { 'type': 'text', 'text': '' } }))
+        for token in tokens:
+            server.delay(server.token_latency)
+            self.write_chunk(encode_bedrock_chunk({ 'type': 'content_block_delta', 'index': 0, 'delta': { 'type': 'text_delta', 'text': token } }))
+        self.write_chunk(encode_bedrock_chunk({ 'type': 'content_block_stop', 'index': 0 }))
+        self.write_chunk(encode_bedrock_chunk({ 'type': 'message_delta', 'delta': { 'stop_reason': 'end_turn' }, 'usage': { 'output_tokens': len(tokens) } }))
+        self.write_chunk(encode_bedrock_chunk({ 'type': 'message_stop' }))
+        self.end_chunked()
+
+def start_mock_server(host='127.0.0.1', port=0, **options):
+    server = MockLLMServer((host, port), **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock OpenAI and Bedrock compatible server for benchmarking LLM Shell.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('-p', '--port', type=int, default=8080, help='Port to listen on.')
+    parser.add_argument('--token-latency', type=float, default=0.0, help='Seconds to wait before each generated token.')
+    parser.add_argument('--first-token-latency', type=float, default=0.0, help='Seconds to wait before the first token.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random +/- seconds added to every wait.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests which fail with a 500 error.')
+    parser.add_argument('--response', action='append', default=[], help='A canned response, repeat to cycle through several.')
+    parser.add_argument('--response-file', action='append', default=[], help='A file whose contents are used as a canned response.')
+    parser.add_argument('--seed', type=int, help='Seed for jitter and errors, for reproducible runs.')
+    args = parser.parse_args()
+
+    responses = list(args.response)
+    for path in args.response_file:
+        with open(path, 'r') as f:
+            responses.append(f.read())
+
+    server = MockLLMServer((args.host, args.port), responses=responses, token_latency=args.token_latency,
+        first_token_latency=args.first_token_latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    print(f'mock llm server listening on {server.url}')
+    print(f'\tCHATGPT_BASE_URL={server.url}/v1 BEDROCK_ENDPOINT_URL={server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,279 @@
+import os
+import re
+import json
+import math
+import hashlib
+import subprocess
+from collections import Counter
+
+from llm_shell.util import estimate_tokens
+
+
+
+# bm25 index over line chunks of the working tree, persisted to disk and updated incrementally
+# as files change, used to send only the chunks relevant to a request instead of whole files
+index_dir = os.path.join(os.path.expanduser('~'), '.llm_shell_index')
+index_version = 1
+chunk_lines = 40
+max_indexed_file_size = 1024 * 1024
+bm25_k1 = 1.2
+bm25_b = 0.75
+
+skipped_directories = { '.git', '.hg', '.svn', 'node_modules', '__pycache__', '.venv', 'venv', '.tox', 'dist', 'build' }
+
+term_regex = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|[0-9]+')
+camel_case_regex = re.compile(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[0-9]+')
+
+# indexes loaded in this session, by root directory
+loaded_indexes = {}
+
+def tokenize(text):
+    # identifiers are indexed whole and split into their snake_case and camelCase parts
+    terms = []
+    for identifier in term_regex.findall(text):
+        lowered = identifier.lower()
+        terms.append(lowered)
+        parts = [ part.lower() for word in identifier.split('_') for part in camel_case_regex.findall(word) ]
+        if len(parts) > 1:
+            terms.extend(part for part in parts if len(part) > 1)
+    return terms
+
+def index_path(root):
+    return os.path.join(index_dir, hashlib.sha256(root.encode('utf-8')).hexdigest()[:32] + '.json')
+
+class RepoIndex:
+    def __init__(self, root):
+        self.root = root
+        # path -> [mtime_ns, size, [chunk_id, ...]]
+        self.files = {}
+        # chunk_id -> [path, start_line, end_line, length, { term: frequency }]
+        self.chunks = {}
+        self.next_chunk_id = 0
+        # term -> { chunk_id: frequency }, rebuilt in memory from the chunks on load
+        self.postings = {}
+        self.total_length = 0
+        # the paths git lists only change when HEAD moves or git's index is written, they are listed again only then
+        self.git_dir = None
+        self.listed_paths = None
+        self.listing_signature = None
+
+    def add_chunk(self, path, start_line, end_line, terms):
+        chunk_id = str(self.next_chunk_id)
+        self.next_chunk_id += 1
+        frequencies = dict(Counter(terms))
+        self.chunks[chunk_id] = [path, start_line, end_line, len(terms), frequencies]
+        self.post_chunk(chunk_id)
+        return chunk_id
+
+    def post_chunk(self, chunk_id):
+        path, start_line, end_line, length, frequencies = self.chunks[chunk_id]
+        for term, frequency in frequencies.items():
+            self.postings.setdefault(term, {})[chunk_id] = frequency
+        self.total_length += length
+
+    def remove_file(self, path):
+        for chunk_id in self.files.pop(path, [0, 0, []])[2]:
+            path, start_line, end_line, length, frequencies = self.chunks.pop(chunk_id)
+            for term in frequencies:
+                term_postings = self.postings[term]
+                del term_postings[chunk_id]
+                if not term_postings:
+                    del self.postings[term]
+            self.total_length -= length
+
+    def index_file(self, path, signature):
+        self.remove_file(path)
+        try:
+            with open(os.path.join(self.root, path), 'r') as f:
+                text = f.read()
+        except (OSError, UnicodeDecodeError):
+            text = ''
+        # binary files are remembered with no chunks so they are not read again until they change
+        lines = text.split('\n') if '\0' not in text else []
+        chunk_ids = []
+        for start in range(0, len(lines), chunk_lines):
+            chunk_text = '\n'.join(lines[start:start + chunk_lines])
+            # the path is part of every chunk so that requests naming a file find it
+            terms = tokenize(path) + tokenize(chunk_text)
+            if chunk_text.strip():
+                chunk_ids.append(self.add_chunk(path, start + 1, min(start + chunk_lines, len(lines)), terms))
+        self.files[path] = [signature[0], signature[1], chunk_ids]
+
+    def update(self):
+        # re-indexes new and changed files and drops deleted ones, returns the number of files updated
+        current_files = stat_repo_files(self.root, self.list_paths())
+        updated = 0
+        for path in set(self.files) - set(current_files):
+            self.remove_file(path)
+            updated += 1
+        for path, signature in current_files.items():
+            entry = self.files.get(path)
+            if entry is None or (entry[0], entry[1]) != signature:
+                self.index_file(path, signature)
+                updated += 1
+        return updated
+
+    def list_paths(self):
+        if self.listed_paths is None:
+            self.git_dir = find_git_dir(self.root)
+        elif self.git_dir is not None and git_listing_signature(self.git_dir) == self.listing_signature:
+            return self.listed_paths
+        if self.git_dir is not None:
+            self.listing_signature = git_listing_signature(self.git_dir)
+        self.listed_paths = list_repo_paths(self.root)
+        return self.listed_paths
+
+    def search(self, query, top_k=None):
+        # scores chunks against the query terms with bm25, returns (score, chunk_id) best first, all of them without top_k
+        if not self.chunks:
+            return []
+        chunk_count = len(self.chunks)
+        average_length = self.total_length / chunk_count or 1
+        scores = {}
+        for term in set(tokenize(query)):
+            term_postings = self.postings.get(term)
+            if not term_postings:
+                continue
+            idf = math.log(1 + (chunk_count - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+            for chunk_id, frequency in term_postings.items():
+                length = self.chunks[chunk_id][3]
+                score = idf * frequency * (bm25_k1 + 1) / (frequency + bm25_k1 * (1 - bm25_b + bm25_b * length / average_length))
+                scores[chunk_id] = scores.get(chunk_id, 0) + score
+        return sorted(((score, chunk_id) for chunk_id, score in scores.items()), key=lambda item: (-item[0], int(item[1])))[:top_k]
+
+    def read_chunk(self, chunk_id):
+        path, start_line, end_line, length, frequencies = self.chunks[chunk_id]
+        try:
+            with open(os.path.join(self.root, path), 'r') as f:
+                lines = f.read().split('\n')
+        except (OSError, UnicodeDecodeError):
+            return None
+        return '\n'.join(lines[start_line - 1:end_line])
+
+    def save(self):
+        path = index_path(self.root)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so a crash never leaves a partial index behind
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as index_file:
+            json.dump({ 'version': index_version, 'root': self.root, 'chunk_lines': chunk_lines,
+                'next_chunk_id': self.next_chunk_id, 'files': self.files, 'chunks': self.chunks }, index_file)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, root):
+        index = cls(root)
+        try:
+            with open(index_path(root), 'r') as index_file:
+                data = json.load(index_file)
+        except (OSError, ValueError):
+            return index
+        # An index built with different settings is rebuilt from scratch
+        if data.get('version') != index_version or data.get('root') != root or data.get('chunk_lines') != chunk_lines:
+            return index
+        index.files = data['files']
+        index.chunks = data['chunks']
+        index.next_chunk_id = data['next_chunk_id']
+        for chunk_id in index.chunks:
+            index.post_chunk(chunk_id)
+        return index
+
+def find_git_dir(root):
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--absolute-git-dir'], cwd=root, capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return os.fsdecode(result.stdout).strip()
+
+def git_listing_signature(git_dir):
+    signature = []
+    for name in ('HEAD', 'index'):
+        try:
+            stat = os.stat(os.path.join(git_dir, name))
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append(None)
+    return signature
+
+def list_repo_paths(root):
+    # returns the relative paths of the files under root which git doesn't ignore
+    try:
+        result = subprocess.run(['git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard'],
+            cwd=root, capture_output=True, check=True)
+        paths = [ path for path in result.stdout.decode('utf-8', 'replace').split('\0') if path ]
+    except (OSError, subprocess.CalledProcessError):
+        paths = []
+        for directory, dirs, files in os.walk(root):
+            dirs[:] = [ name for name in dirs if name not in skipped_directories and not name.startswith('.') ]
+            paths.extend(os.path.relpath(os.path.join(directory, name), root) for name in files)
+    return paths
+
+def stat_repo_files(root, paths):
+    # returns { relative path: (mtime_ns, size) } for the indexable text files among paths
+    repo_files = {}
+    for path in paths:
+        try:
+            stat = os.stat(os.path.join(root, path))
+        except OSError:
+            continue
+        if stat.st_size <= max_indexed_file_size:
+            repo_files[path] = (stat.st_mtime_ns, stat.st_size)
+    return repo_files
+
+def get_index(root=None):
+    root = os.path.abspath(root or os.getcwd())
+    if root not in loaded_indexes:
+        loaded_indexes[root] = RepoIndex.load(root)
+    return loaded_indexes[root]
+
+def build_index(root=None):
+    index = get_index(root)
+    updated = index.update()
+    index.save()
+    return index, updated
+
+def clear_index(root=None):
+    root = os.path.abspath(root or os.getcwd())
+    loaded_indexes.pop(root, None)
+    try:
+        os.remove(index_path(root))
+        return True
+    except OSError:
+        return False
+
+def index_stats(root=None):
+    root = os.path.abspath(root or os.getcwd())
+    index = get_index(root)
+    return {
+        'root': root,
+        'path': index_path(root),
+        'built': os.path.isfile(index_path(root)),
+        'files': len(index.files),
+        'chunks': len(index.chunks),
+        'terms': len(index.postings),
+    }
+
+def retrieve_chunks(query, top_k, token_budget, root=None, exclude_paths=()):
+    # brings the index up to date, then returns the best (path, start_line, end_line, text) chunks which fit the budget
+    index = get_index(root)
+    if index.update():
+        index.save()
+    excluded = set(os.path.abspath(path) for path in exclude_paths)
+    chunks = []
+    remaining = token_budget
+    # the whole ranking is walked, excluded files may hold any number of the best chunks
+    for score, chunk_id in index.search(query):
+        if len(chunks) >= top_k:
+            break
+        if os.path.join(index.root, index.chunks[chunk_id][0]) in excluded:
+            continue
+        text = index.read_chunk(chunk_id)
+        if text is None:
+            continue
+        tokens = estimate_tokens(text)
+        if tokens > remaining:
+            continue
+        remaining -= tokens
+        path, start_line, end_line = index.chunks[chunk_id][:3]
+        chunks.append((path, start_line, end_line, text))
+    return chunks
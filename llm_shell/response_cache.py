@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+
+
+# content-addressed cache of llm responses, stored as one json file per entry
+cache_dir = os.path.join(os.path.expanduser('~'), '.llm_shell_cache')
+cache_max_bytes = 100 * 1024 * 1024
+cache_max_age = 7 * 24 * 60 * 60
+
+cache_hits = 0
+cache_misses = 0
+
+# Eviction walks the whole cache, so it only runs once the estimated size passes the limit, or every
+# eviction_interval stores to drop expired entries. The estimate is kept per cache directory.
+eviction_interval = 100
+cache_size_estimates = {}
+stores_since_eviction = 0
+
+def cache_key(backend, context):
+    # Normalize the context so insignificant whitespace doesn't cause a cache miss
+    normalized_context = [ { 'role': step['role'], 'content': step['content'].strip() } for step in context ]
+    serialized = json.dumps({ 'backend': backend, 'context': normalized_context }, sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def cache_entry_path(key):
+    return os.path.join(cache_dir, key[:2], key + '.json')
+
+def get_cached_response(key):
+    global cache_hits, cache_misses
+    path = cache_entry_path(key)
+    try:
+        if time.time() - os.path.getmtime(path) > cache_max_age:
+            os.remove(path)
+            raise FileNotFoundError(path)
+        with open(path, 'r') as cache_file:
+            entry = json.load(cache_file)
+        # Touch the entry so eviction treats it as recently used
+        os.utime(path)
+    except (OSError, ValueError):
+        cache_misses += 1
+        return None
+    cache_hits += 1
+    return entry['response']
+
+def store_cached_response(key, backend, response):
+    # The cache is best-effort, a response which can't be stored is simply not cached
+    global stores_since_eviction
+    path = cache_entry_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a unique temporary file first so readers and concurrent writers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump({ 'backend': backend, 'created': time.time(), 'response': response }, cache_file)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            remove_cache_file(temp_path)
+            raise
+    except (OSError, TypeError, ValueError):
+        return
+    stores_since_eviction += 1
+    if cache_dir not in cache_size_estimates or stores_since_eviction >= eviction_interval:
+        evict_cache_entries()
+        return
+    cache_size_estimates[cache_dir] += size
+    if cache_size_estimates[cache_dir] > cache_max_bytes:
+        evict_cache_entries()
+
+def list_cache_entries():
+    entries = []
+    for root, dirs, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith('.json'):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+def evict_cache_entries():
+    # Drop expired entries, then the least recently used ones until the cache fits its size limit
+    global stores_since_eviction
+    stores_since_eviction = 0
+    now = time.time()
+    entries = []
+    for mtime, size, path in list_cache_entries():
+        if now - mtime > cache_max_age:
+            remove_cache_file(path)
+        else:
+            entries.append((mtime, size, path))
+
+    total_size = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total_size <= cache_max_bytes:
+            break
+        remove_cache_file(path)
+        total_size -= size
+    cache_size_estimates[cache_dir] = total_size
+
+def remove_cache_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def clear_cache():
+    entries = list_cache_entries()
+    for mtime, size, path in entries:
+        remove_cache_file(path)
+    cache_size_estimates[cache_dir] = 0
+    return len(entries)
+
+def cache_stats():
+    entries = list_cache_entries()
+    return {
+        'entries': len(entries),
+        'size': sum(size for mtime, size, path in entries),
+        'hits': cache_hits,
+        'misses': cache_misses,
+    }
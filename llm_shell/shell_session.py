@@ -0,0 +1,121 @@
+import os
+import sys
+import shlex
+import secrets
+import threading
+import subprocess
+
+
+
+# a long-lived bash process which runs every shell command, so exported variables, functions
+# and activated virtualenvs carry over between commands and no shell is forked per command
+session_shell = '/bin/bash'
+read_chunk_size = 64 * 1024
+
+session = None
+session_lock = threading.Lock()
+
+class ShellSessionError(Exception):
+    pass
+
+class ShellSession:
+    def __init__(self, shell=None):
+        # every command ends by printing this marker on its own line, followed by the exit code and working directory
+        self.marker = f'__llm_shell_done_{secrets.token_hex(8)}__'.encode('ascii')
+        self.process = subprocess.Popen([shell or session_shell, '--noprofile', '--norc'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=os.environ, cwd=os.getcwd())
+        self.cwd = os.getcwd()
+        # ctrl-c reaches the running command directly, the idle session itself ignores it
+        self.send(b'trap : INT\n')
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def send(self, script):
+        try:
+            self.process.stdin.write(script)
+            self.process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            raise ShellSessionError('shell session has exited')
+
+    def run(self, command, on_output):
+        # runs the command, passing its output bytes to on_output as they arrive, and returns its exit code
+        script = ''
+        if os.getcwd() != self.cwd:
+            script += f'cd -- {shlex.quote(os.getcwd())}\n'
+        # commands read the terminal rather than the pipe the session reads its script from
+        stdin = '/dev/tty' if sys.stdin.isatty() else '/dev/null'
+        script += f'eval {shlex.quote(command)} < {stdin}\n'
+        script += f'printf \'\\n%s %s %s\\n\' {self.marker.decode("ascii")} "$?" "$PWD"\n'
+        self.send(script.encode('utf-8'))
+
+        marker = b'\n' + self.marker + b' '
+        fd = self.process.stdout.fileno()
+        buffer = b''
+        while True:
+            data = os.read(fd, read_chunk_size)
+            if not data:
+                # the command exited the shell itself
+                if buffer:
+                    on_output(buffer)
+                return self.process.wait()
+            buffer += data
+            index = buffer.find(marker)
+            if index >= 0:
+                if index > 0:
+                    on_output(buffer[:index])
+                trailer = buffer[index + len(marker):]
+                while b'\n' not in trailer:
+                    data = os.read(fd, read_chunk_size)
+                    if not data:
+                        return self.process.wait()
+                    trailer += data
+                exit_code, cwd = trailer.split(b'\n', 1)[0].decode('utf-8', 'replace').split(' ', 1)
+                self.cwd = cwd
+                # follow cd commands so the prompt and file paths stay in sync with the session
+                if cwd != os.getcwd():
+                    try:
+                        os.chdir(cwd)
+                    except OSError:
+                        pass
+                return int(exit_code)
+
+            # Hold back only what could be the start of a marker split across reads
+            hold = buffer.rfind(b'\n', max(0, len(buffer) - len(marker) + 1))
+            if hold >= 0 and marker.startswith(buffer[hold:]):
+                output, buffer = buffer[:hold], buffer[hold:]
+            else:
+                output, buffer = buffer, b''
+            if output:
+                on_output(output)
+
+    def close(self):
+        if self.is_alive():
+            self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+def get_session():
+    global session
+    with session_lock:
+        if session is None or not session.is_alive():
+            if session is not None:
+                session.close()
+            session = ShellSession()
+        return session
+
+def run_command(command, on_output):
+    try:
+        return get_session().run(command, on_output)
+    except ShellSessionError:
+        # the session died between commands, start a fresh one and try once more
+        reset_session()
+        return get_session().run(command, on_output)
+
+def reset_session():
+    global session
+    with session_lock:
+        if session is not None:
+            session.close()
+            session = None
@@ -0,0 +1,146 @@
+import os
+import re
+
+
+
+# single-pass file summarizers, picked by file extension, which reduce a source file to its outline
+
+def summarize_generic_lines(lines):
+    # Keeps unindented code lines, collapsing every run of indented lines into one '\t# ...' marker
+    in_elision = False
+    for line in lines:
+        stripped = line.lstrip()
+        if not stripped or stripped.startswith(('#', '//')):
+            continue
+        if line[0].isspace():
+            if not in_elision:
+                in_elision = True
+                yield '\t# ...'
+        else:
+            # a kept line which itself ends in the marker absorbs the elided lines after it
+            in_elision = line.endswith('\t# ...')
+            yield line
+
+def join_summary_lines(summary_lines):
+    summary = '\n'.join(summary_lines)
+    if summary.endswith('\t# ...'):
+        summary += '\n'
+    return summary
+
+def summarize_generic(text):
+    return join_summary_lines(summarize_generic_lines(text.split('\n')))
+
+brace_string_regex = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|`[^`]*`')
+
+def summarize_braces_lines(lines):
+    # For brace languages, keeps top level lines and block openers one level deep (class methods, namespace members)
+    depth = 0
+    in_block_comment = False
+    in_elision = False
+    for line in lines:
+        stripped = line.strip()
+        if in_block_comment:
+            if '*/' in stripped:
+                in_block_comment = False
+            continue
+        if stripped.startswith('/*'):
+            in_block_comment = '*/' not in stripped
+            continue
+        if not stripped or stripped.startswith('//'):
+            continue
+
+        code = brace_string_regex.sub('""', stripped.split('//', 1)[0])
+        line_depth = depth
+        depth = max(0, depth + code.count('{') - code.count('}'))
+        if line_depth == 0 or depth == 0 or (line_depth == 1 and code.endswith('{')) or (depth == 1 and code.startswith('}')):
+            in_elision = False
+            yield line.rstrip()
+        elif not in_elision:
+            in_elision = True
+            yield '\t// ...'
+
+def summarize_braces(text):
+    return '\n'.join(summarize_braces_lines(text.split('\n')))
+
+python_definition_prefixes = ('def ', 'class ', 'async def ', '@')
+python_docstring_prefixes = ('"""', "'''", 'r"""', "r'''")
+triple_quote_regex = re.compile(r'"""|\'\'\'')
+
+def summarize_python_lines(lines):
+    # Keeps top level code plus every decorator, def and class signature and docstring,
+    # collapsing the rest of each body into one indented '...' marker
+    in_elision = False
+    bracket_depth = 0
+    expect_docstring = False
+    string_quote = None
+    keep_string = False
+    for line in lines:
+        stripped = line.lstrip()
+        if string_quote is not None:
+            # inside a triple quoted string, kept or elided along with the line which opened it
+            if keep_string:
+                yield line
+            if stripped.count(string_quote) % 2 == 1:
+                string_quote = None
+            continue
+        if not stripped or stripped[0] == '#':
+            continue
+
+        is_definition = False
+        if bracket_depth > 0:
+            # continuation of a multi-line signature
+            keep = True
+            bracket_depth += stripped.count('(') + stripped.count('[') - stripped.count(')') - stripped.count(']')
+            expect_docstring = bracket_depth <= 0
+        elif stripped.startswith(python_definition_prefixes):
+            keep = True
+            is_definition = True
+            bracket_depth = stripped.count('(') + stripped.count('[') - stripped.count(')') - stripped.count(']')
+            expect_docstring = bracket_depth <= 0 and stripped[0] != '@'
+        elif not line[0].isspace():
+            keep = True
+            expect_docstring = False
+        else:
+            keep = expect_docstring and stripped.startswith(python_docstring_prefixes)
+            expect_docstring = False
+
+        if keep:
+            in_elision = False
+            yield line
+        elif not in_elision:
+            in_elision = True
+            yield line[:len(line) - len(stripped)] + '...'
+
+        if not is_definition and ('"""' in stripped or "'''" in stripped):
+            quotes = triple_quote_regex.findall(stripped)
+            if len(quotes) % 2 == 1:
+                string_quote = quotes[-1]
+                keep_string = keep
+
+def summarize_python(text):
+    return '\n'.join(summarize_python_lines(text.split('\n')))
+
+brace_language_extensions = { '.js', '.jsx', '.mjs', '.ts', '.tsx', '.java', '.c', '.h', '.cc', '.cpp', '.hpp',
+    '.cs', '.go', '.rs', '.php', '.swift', '.kt', '.scala' }
+
+def get_summarizer(file_path):
+    extension = os.path.splitext(file_path or '')[1].lower()
+    if extension in ('.py', '.pyw'):
+        return summarize_python_lines
+    elif extension in brace_language_extensions:
+        return summarize_braces_lines
+    return summarize_generic_lines
+
+def summarize_lines(lines, file_path=None):
+    summarizer = get_summarizer(file_path)
+    if summarizer is summarize_generic_lines:
+        return join_summary_lines(summarizer(lines))
+    return '\n'.join(summarizer(lines))
+
+def summarize(text, file_path=None):
+    return summarize_lines(text.split('\n'), file_path)
+
+def summarize_file_path(file_path):
+    # streams the file line by line instead of loading it whole
+    with open(file_path, 'r') as file:
+        return summarize_lines((line.rstrip('\n') for line in file), file_path)
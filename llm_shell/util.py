@@ -2,12 +2,14 @@ import os
 import os.path
 import re
 import getpass
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import TerminalFormatter
 import threading
 import time
 import json
+import collections
+import tempfile
+import stat
+
+import llm_shell.summarizer as summarizer
 
 
 
@@ -43,16 +45,73 @@ def get_prompt(llm_backend, llm_agent):
         return f"{user}:{cwd} {bold_red_and_black_background(f'<<{llm_backend}>>')}$ "
 
 
+shorten_output_head = 1000
+shorten_output_tail = 1000
+
 def shorten_output(output):
-    if len(output) > 2000:
-        return output[:1000] + '\n...\n' + output[-1000:]
+    if len(output) > shorten_output_head + shorten_output_tail:
+        return output[:shorten_output_head] + '\n...\n' + output[-shorten_output_tail:]
     else:
         return output
 
-def summarize_file(text):
-    return re.sub(r'(\t# \.\.\.\n?)+', '\t# ...\n', '\n'.join(line if not re.match(r'^\s+', line) else '\t# ...' for line in text.split('\n') if not re.match(r'^(\s*$|\s*#.*|\s*//.*)', line)))
+# captures command output in constant memory: only the parts that shorten_output keeps are held,
+# and the full output can optionally be spilled to a temporary file
+class OutputCapture:
+    def __init__(self, spill=False):
+        self.head = ''
+        self.tail = ''
+        self.length = 0
+        self.spill = spill
+        self.spill_file = None
+        self.spill_path = None
+
+    def write(self, text):
+        self.length += len(text)
+        # the head holds everything until the output is too long to be kept whole
+        if len(self.head) < shorten_output_head + shorten_output_tail:
+            self.head += text[:shorten_output_head + shorten_output_tail - len(self.head)]
+        self.tail = (self.tail + text[-shorten_output_tail:])[-shorten_output_tail:]
+        if self.spill:
+            if self.spill_file is None and self.length > shorten_output_head + shorten_output_tail:
+                self.spill_file = tempfile.NamedTemporaryFile('w', prefix='llm_shell_output_', suffix='.log', delete=False)
+                self.spill_path = self.spill_file.name
+                # the head is still complete at this point, minus the text just written
+                self.spill_file.write(self.head[:self.length - len(text)])
+            if self.spill_file is not None:
+                self.spill_file.write(text)
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+
+    def getvalue(self):
+        if self.length > shorten_output_head + shorten_output_tail:
+            return self.head[:shorten_output_head] + '\n...\n' + self.tail
+        return self.head
+
+# rough local token estimate: every run of up to four word characters or single symbol counts as a token
+token_estimate_regex = re.compile(r'\w{1,4}|[^\w\s]')
+
+def estimate_tokens(text):
+    return len(token_estimate_regex.findall(text))
+
+def estimate_message_tokens(message):
+    # Each message carries a few tokens of role and formatting overhead
+    return estimate_tokens(message['content']) + 4
+
+def summarize_file(text, file_path=None):
+    return summarizer.summarize(text, file_path)
+
+def warm_syntax_highlighting():
+    # loads the pygments lexer and formatter modules ahead of the first response
+    apply_syntax_highlighting('```python\npass\n```')
 
 def apply_syntax_highlighting(response, reindent_with_tabs=False):
+    # pygments is only imported once a response needs highlighting
+    from pygments import highlight
+    from pygments.lexers import get_lexer_by_name
+    from pygments.formatters import TerminalFormatter
+
     # Regex to find code blocks with optional language specification
     code_block_regex = r"```(\w+)?\n(.*?)\n```"
     matches = re.finditer(code_block_regex, response, re.DOTALL)
@@ -112,40 +171,186 @@ def slow_print(msg, over_time=2):
             time.sleep(delay_per_char)
         print('')
 
-def parse_diff_string(diff_string):
-    # Define a regex pattern to match the whole block of text for each file
-    pattern = re.compile(
-        r'(?:(`?)([^\n]*?)\1\n)?'  # Match the file path (optional)
-        r'```(?:[^\n]*?)\n?'   # Match the start fence (optional code type such as "py")
-        r'(?:(`?)([^\n]*?)\3\n)?'   # Match the start fence (optional code type such as "py")
-        r'<<<<<<<[ ]*SEARCH\n'  # Match the start of the search block (optional SEARCH)
-        r'(.*?)\n?'             # Capture the search content
-        r'=======\n'         # Match the divider (optional)
-        r'(.*?)\n?'             # Capture the replace content
-        r'>>>>>>>[ ]*REPLACE\n', # Match the end of the replace block (optional REPLACE)
-        # r'```',                 # Match the end fence
-        re.DOTALL)
-
-
-    # Find all matches in the input string
-    matches = pattern.findall(diff_string)
-
-    # Extract the file path, search string, and replace string from each match
-    diff_data = []
-    last_filepath = None  # Keep track of the last known filepath
-    for match in matches:
-        # Check if a filepath is specified in the current match; if not, use the last known filepath
-        filepath = match[3].strip() or match[1].strip() or last_filepath
-        if '.' not in filepath and '/' not in filepath and match[1].strip():
-            filepath = match[1].strip()
-        search_string = match[4].strip()
-        replace_string = match[5].strip()
+search_marker_regex = re.compile(r'<<<<<<<[ ]*SEARCH')
+search_marker_end_regex = re.compile(r'<<<<<<<[ ]*SEARCH$')
+replace_marker_end_regex = re.compile(r'>>>>>>>[ ]*REPLACE$')
+
+def strip_backticks(text):
+    # a path may be wrapped in single backticks
+    if len(text) >= 2 and text[0] == '`' and text[-1] == '`':
+        return text[1:-1]
+    return text
+
+# Incremental parser for the search/replace blocks of a diff response, fed chunk by chunk as a response streams in.
+# Works a line at a time with at most three lines of lookahead after a fence, so a response is parsed in linear time,
+# and each (filepath, search_block, replace_block) is returned as soon as its '>>>>>>> REPLACE' line arrives.
+# The file path is picked the same way as always: a path line right after the fence, else the line right before it,
+# else the path of the previous block.
+class DiffStreamParser:
+    def __init__(self):
+        self.partial_line = []
+        self.lines = collections.deque()
+        # the number of lines taken off the front of self.lines so far
+        self.line_number = 0
+        self.closed = False
+        self.state = 'scan'
+        # whether the next line is the first one after a block, which has no line before it to take a path from
+        self.at_block_start = True
+        # once closed, the last line a block's search content may start on and still reach a divider and a REPLACE
+        self.last_content_start = None
+        self.block_paths = None
+        self.block_start = None
+        self.search_lines = []
+        self.replace_lines = []
+        self.last_filepath = None
+
+    def feed(self, chunk):
+        # returns the blocks completed by this chunk
+        if '\n' not in chunk:
+            self.partial_line.append(chunk)
+            return []
+        lines = chunk.split('\n')
+        self.partial_line.append(lines[0])
+        self.lines.append(''.join(self.partial_line))
+        self.lines.extend(lines[1:-1])
+        self.partial_line = [lines[-1]]
+        return self.parse_lines()
+
+    def close(self):
+        # returns the blocks still waiting on lookahead, an unfinished last line can't end a block
+        self.closed = True
+        blocks = self.parse_lines()
+        if self.state != 'scan':
+            # the response ended inside a block, so its start was a false one: scan again from there,
+            # this time only starting blocks which can still be finished
+            block_start, at_block_start, block_lines = self.block_start
+            self.lines.extendleft(reversed(block_lines))
+            self.line_number = block_start
+            self.at_block_start = at_block_start
+            self.state = 'scan'
+            self.last_content_start = -1
+            seen_replace = False
+            for i, line in zip(range(len(self.lines) - 1, -1, -1), reversed(self.lines)):
+                if seen_replace and line.endswith('======='):
+                    self.last_content_start = block_start + i
+                    break
+                seen_replace = seen_replace or replace_marker_end_regex.search(line) is not None
+            blocks += self.parse_lines()
+        return blocks
+
+    def lookahead(self, i):
+        return self.lines[i] if i < len(self.lines) else None
+
+    def has_lookahead(self, count):
+        return self.closed or len(self.lines) >= count
+
+    def pop_line(self):
+        self.line_number += 1
+        line = self.lines.popleft()
+        if self.block_start is not None:
+            self.block_start[2].append(line)
+        return line
+
+    def match_header(self, fence_rest, fence_line_number, next_line, line_after):
+        # given the text after a ``` fence and the two lines after it, returns (inline path, header lines to skip)
+        # when a search block starts there, or None
+        next_is_search = next_line is not None and search_marker_regex.fullmatch(next_line)
+        after_is_search = next_line is not None and line_after is not None and search_marker_regex.fullmatch(line_after)
+        if not fence_rest:
+            headers = [ (next_line, 2, after_is_search), ('', 1, next_is_search) ]
+        else:
+            headers = [ (fence_rest, 1, next_is_search), ('', 0, search_marker_end_regex.search(fence_rest)),
+                (next_line, 2, after_is_search) ]
+        for inline_path, header_lines, matched in headers:
+            content_start = fence_line_number + 1 + header_lines
+            if matched and (self.last_content_start is None or content_start <= self.last_content_start):
+                return inline_path, header_lines
+        return None
 
-        last_filepath = filepath
-        diff_data.append((filepath, search_string, replace_string))
+    def parse_lines(self):
+        blocks = []
+        while self.lines:
+            if self.state == 'scan':
+                if not self.scan_line():
+                    break
+            elif self.state == 'search':
+                line = self.pop_line()
+                if line.endswith('======='):
+                    self.search_lines.append(line[:-len('=======')])
+                    self.state = 'replace'
+                else:
+                    self.search_lines.append(line)
+            else:
+                line = self.pop_line()
+                match = replace_marker_end_regex.search(line)
+                if match:
+                    self.replace_lines.append(line[:match.start()])
+                    block = self.finish_block()
+                    if block is not None:
+                        blocks.append(block)
+                else:
+                    self.replace_lines.append(line)
+        return blocks
+
+    def scan_line(self):
+        # looks for a block starting at the first pending line, returns False while more lines are needed to decide
+        if not self.has_lookahead(2):
+            return False
+        line = self.lines[0]
+        next_line = self.lookahead(1)
+        # a fence starting the next line, with this line as its path
+        if next_line is not None and next_line.startswith('```'):
+            if not self.has_lookahead(4):
+                return False
+            header = self.match_header(next_line[3:], self.line_number + 1, self.lookahead(2), self.lookahead(3))
+            if header is not None:
+                self.start_block(strip_backticks(line), header, 2)
+                return True
+
+        # a fence inside this line, which has no path line before it
+        # (one at the start of the line was tried above with the line before as its path)
+        # only the first fence in the line needs trying, any later one would see the same lines after it
+        position = line.find('```', 0 if self.at_block_start else 1)
+        if position != -1:
+            if not self.has_lookahead(3):
+                return False
+            header = self.match_header(line[position + 3:], self.line_number, next_line, self.lookahead(2))
+            if header is not None:
+                self.start_block('', header, 1)
+                return True
+
+        self.pop_line()
+        self.at_block_start = False
+        return True
 
+    def start_block(self, path, header, fence_lines):
+        inline_path, header_lines = header
+        # the lines of the block are kept until it is finished, in case the response ends before it is
+        self.block_start = (self.line_number, self.at_block_start, [])
+        for i in range(fence_lines + header_lines):
+            self.pop_line()
+        self.block_paths = (strip_backticks(inline_path).strip(), path.strip())
+        self.search_lines = []
+        self.replace_lines = []
+        self.state = 'search'
+
+    def finish_block(self):
+        self.state = 'scan'
+        self.at_block_start = True
+        self.block_start = None
+        inline_path, path = self.block_paths
+        filepath = inline_path or path or self.last_filepath
+        if filepath is None:
+            # a block before any file path has nowhere to go
+            return None
+        if '.' not in filepath and '/' not in filepath and path:
+            filepath = path
+        self.last_filepath = filepath
+        return filepath, '\n'.join(self.search_lines).strip(), '\n'.join(self.replace_lines).strip()
 
-    return diff_data
+def parse_diff_string(diff_string):
+    parser = DiffStreamParser()
+    return parser.feed(diff_string) + parser.close()
 
 def parse_bash_string(diff_string):
     # Define a regex pattern to match the whole block of text for each file
@@ -165,85 +370,181 @@ def parse_bash_string(diff_string):
 
     return bash_commands
 
+# the largest indentation offset a search block may be shifted by to match the file
+max_search_indentation = 40
+
+def match_search_lines(file_lines, search_lines, start, indentation):
+    # returns the end of the match when the non-blank lines from start match the search lines shifted by indentation
+    search_index = 1
+    for j in range(start + 1, len(file_lines)):
+        if search_index == len(search_lines):
+            return j
+        line = file_lines[j]
+        if not line.strip():
+            continue
+        if line[:indentation] != ' ' * indentation or line[indentation:] != search_lines[search_index]:
+            return -1
+        search_index += 1
+    return len(file_lines) if search_index == len(search_lines) else -1
+
 def search_change_lines(file_lines, raw_search_lines, indentation_count=0):
-    search_lines = [' ' * indentation_count + line for line in raw_search_lines]
-    # Find the start index and end index of the search block within the file contents
-    match_index = -1
-    end_match_index = -1
-    for i in range(len(file_lines)):
-        # Only iterate through non-empty lines for matching the search block
-        if file_lines[i].strip() == '':
+    # Anchors on the lines matching the first search line, each anchor implies the indentation the block was shifted by.
+    # The anchors are found with one linear scan per block: an index of the lines would have to be shifted after every
+    # block replaces lines in the file, which costs as much as the scan itself.
+    if not raw_search_lines:
+        return -1, -1, 0
+    first_line = raw_search_lines[0]
+    first_content = first_line.lstrip(' ')
+    first_indentation = len(first_line) - len(first_content)
+    anchors = [ i for i, line in enumerate(file_lines) if line.endswith(first_content) and line.lstrip(' ') == first_content ]
+
+    best_match = None
+    for i in anchors:
+        indentation = len(file_lines[i]) - len(file_lines[i].lstrip(' ')) - first_indentation
+        # Only even shifts within the limit count, as with re-indenting the block by two spaces at a time
+        if indentation < indentation_count or indentation > max_search_indentation or (indentation - indentation_count) % 2:
             continue
-        # Match the first non-empty line of the search block
-        # print("loop enter:", i, '->', file_lines, ",", search_lines)
-        if file_lines[i] == search_lines[0]:
-            match_index = i
-            search_index = 1
-            last_j = i+1
-            # Check if the following non-empty lines match the rest of the search block
-            for j in range(i + 1, len(file_lines)):
-                last_j = j+1
-                if search_index == len(search_lines):
-                    break
-                elif file_lines[j].strip() == '':
-                    continue
-                elif file_lines[j] == search_lines[search_index]:
-                    search_index += 1
-                    if search_index == len(search_lines):
-                        break
-                else:
-                    break
-            if search_index == len(search_lines):
-                end_match_index = last_j
+        if best_match is not None and indentation >= best_match[2]:
+            continue
+        end_match_index = match_search_lines(file_lines, raw_search_lines, i, indentation)
+        if end_match_index != -1:
+            best_match = (i, end_match_index, indentation)
+            if indentation == indentation_count:
                 break
 
-    if match_index != -1 and end_match_index != -1:
-        return match_index, end_match_index, indentation_count
-    elif indentation_count < 40:
-        # Indent the search lines by two spaces and try again
-        return search_change_lines(file_lines, raw_search_lines, indentation_count + 2)
-    else:
-        # Maximum attempts reached, no match found
+    if best_match is None:
         return -1, -1, 0
+    return best_match
 
-
-def apply_changes(filepath, search_block, replace_block):
-    # Read the current contents of the file
-    if os.path.isfile(filepath):
-        with open(filepath, 'r') as file:
-            file_contents = file.read()
-    else:
-        # Write the new contents back to the file
-        with open(filepath, 'w') as file:
-            file.write(replace_block)
-        return True
-
-    # Replace tabs and split the blocks
-    file_contents = file_contents.replace('\t', '    ')
-    search_block = search_block.replace('\t', '    ')
-    replace_block = replace_block.replace('\t', '    ')
-    file_lines = file_contents.splitlines()
-    search_lines = [line for line in search_block.splitlines() if line.strip()]
-    replace_lines = replace_block.splitlines()
+def replace_search_block(file_lines, search_block, replace_block):
+    # Applies one block to the file lines in place, returns False when its search block isn't found
+    search_lines = [line for line in search_block.replace('\t', '    ').splitlines() if line.strip()]
+    replace_lines = replace_block.replace('\t', '    ').splitlines()
 
     match_index, end_match_index, indentation_count = search_change_lines(file_lines, search_lines)
+    if match_index == -1 or end_match_index == -1:
+        return False
+    # Replace the matched lines with the replace block lines
+    file_lines[match_index:end_match_index] = [' ' * indentation_count + line for line in replace_lines]
+    return True
 
-    # print(f'match result: [{match_index}:{end_match_index}]')
-    if match_index != -1 and end_match_index != -1:
-        # Replace the matched lines with the replace block lines
-        indented_replace_lines = [' ' * indentation_count + line for line in replace_lines]
-        file_lines[match_index:end_match_index] = indented_replace_lines
-        # Join the lines back into a single string
-        new_file_contents = '\n'.join(file_lines)
-
-        # Write the modified contents back to the file
+def write_file_atomically(filepath, contents):
+    if not os.path.isfile(filepath):
         with open(filepath, 'w') as file:
-            file.write(new_file_contents)
-        print(f"Changes applied to '{filepath}'.")
-        return True
+            file.write(contents)
+        return
+    # Write next to the file and rename over it, so the file is never seen half-written
+    file_mode = stat.S_IMODE(os.stat(filepath).st_mode)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)), prefix=f'.{os.path.basename(filepath)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(contents)
+        os.chmod(temp_path, file_mode)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+# The blocks for one file, applied to it in memory as they come in and written to disk once with commit().
+# A block's status is 'created', 'applied', 'not found', 'rolled back' or 'error: ...'
+# If any block isn't found the file is left untouched and its other blocks are rolled back.
+class FileChanges:
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.statuses = []
+        self.file_lines = None
+        self.error = None
+        try:
+            if os.path.isfile(filepath):
+                with open(filepath, 'r') as file:
+                    self.file_contents = file.read()
+            else:
+                self.file_contents = None
+        except (OSError, UnicodeDecodeError) as e:
+            self.error = f'error: {e}'
+
+    def apply(self, search_block, replace_block):
+        # returns the status of the block so far, before the file is written
+        if self.error is not None:
+            status = self.error
+        elif self.file_contents is None and self.file_lines is None:
+            # A block for a file which doesn't exist yet creates it with the replace block
+            self.file_contents = replace_block
+            status = 'created'
+        else:
+            if self.file_lines is None:
+                self.file_lines = self.file_contents.replace('\t', '    ').splitlines()
+            elif self.file_lines and self.file_lines[-1] == '':
+                # a trailing empty line would be lost writing the file and reading it back between blocks
+                self.file_lines.pop()
+            status = 'applied' if replace_search_block(self.file_lines, search_block, replace_block) else 'not found'
+        self.statuses.append(status)
+        return status
+
+    def commit(self):
+        # writes the file unless a block wasn't found, returns the final status of every block
+        if self.error is not None:
+            return self.statuses
+        if 'not found' in self.statuses:
+            return [ 'not found' if status == 'not found' else 'rolled back' for status in self.statuses ]
+        try:
+            write_file_atomically(self.filepath, self.file_contents if self.file_lines is None else '\n'.join(self.file_lines))
+        except OSError as e:
+            return [ f'error: {e}' for status in self.statuses ]
+        return self.statuses
+
+def apply_file_changes(filepath, blocks):
+    # Applies every (search_block, replace_block) to one file in memory, in order, and writes the file once.
+    file_changes = FileChanges(filepath)
+    for search_block, replace_block in blocks:
+        file_changes.apply(search_block, replace_block)
+    return file_changes.commit()
+
+# Collects (filepath, search_block, replace_block) blocks one at a time, such as from a DiffStreamParser while the
+# response is still streaming, applying each to its file in memory right away. commit() writes every file once.
+class ChangeSet:
+    def __init__(self):
+        self.files = {}
+        self.blocks = []
+
+    def apply(self, filepath, search_block, replace_block):
+        if filepath not in self.files:
+            self.files[filepath] = FileChanges(filepath)
+        self.blocks.append((filepath, search_block))
+        return self.files[filepath].apply(search_block, replace_block)
+
+    def commit(self):
+        # returns (filepath, search_block, status) in the order of the blocks, like apply_changes_batch
+        statuses_by_file = { filepath: iter(file_changes.commit()) for filepath, file_changes in self.files.items() }
+        return [ (filepath, search_block, next(statuses_by_file[filepath])) for filepath, search_block in self.blocks ]
+
+def apply_changes_batch(diff_blocks, max_workers=8):
+    # Groups (filepath, search_block, replace_block) blocks by file and applies each file's blocks in one pass,
+    # with independent files in parallel. Returns (filepath, search_block, status) in the order of the blocks.
+    blocks_by_file = {}
+    for filepath, search_block, replace_block in diff_blocks:
+        blocks_by_file.setdefault(filepath, []).append((search_block, replace_block))
+
+    # a thread pool only pays off once a few files are written
+    if len(blocks_by_file) >= 4 and max_workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(blocks_by_file))) as executor:
+            statuses_by_file = dict(zip(blocks_by_file, executor.map(apply_file_changes, blocks_by_file, blocks_by_file.values())))
     else:
+        statuses_by_file = { filepath: apply_file_changes(filepath, blocks) for filepath, blocks in blocks_by_file.items() }
+
+    statuses_by_file = { filepath: iter(statuses) for filepath, statuses in statuses_by_file.items() }
+    return [ (filepath, search_block, next(statuses_by_file[filepath])) for filepath, search_block, replace_block in diff_blocks ]
+
+def apply_changes(filepath, search_block, replace_block):
+    status = apply_file_changes(filepath, [(search_block, replace_block)])[0]
+    if status == 'applied':
+        print(f"Changes applied to '{filepath}'.")
+    elif status == 'not found':
         print(f"Search block not found in '{filepath}'. No changes made.")
-        return False
+    elif status.startswith('error'):
+        raise OSError(status)
+    return status in ('applied', 'created')
 
 
 def save_llm_config_to_file(config_path, llm_config):
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+import sys
+import os
+import io
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import contextlib
+from unittest.mock import patch
+
+import llm_shell.chatgpt_support as chatgpt_support
+import llm_shell.bedrock_support as bedrock_support
+from llm_shell.mock_server import start_mock_server
+from llm_shell.summarizer import summarize_generic, summarize_python, summarize_braces
+from llm_shell.util import search_change_lines, read_file_contents, summarize_file, apply_syntax_highlighting, parse_diff_string, apply_changes, apply_changes_batch
+
+# Times each stage of a '#' request against synthetic repositories and responses of increasing size.
+# Results are written as json and compared against a stored baseline so that regressions show up.
+
+default_baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+benchmark_sizes = {
+	'small': { 'files': 5, 'functions': 10, 'blocks': 2 },
+	'medium': { 'files': 20, 'functions': 50, 'blocks': 8 },
+	'large': { 'files': 50, 'functions': 200, 'blocks': 20 },
+}
+
+def make_synthetic_source(file_index, function_count):
+	lines = [f'# synthetic module {file_index}', 'import os', 'import sys', '', '']
+	lines.append(f'class Module{file_index}:')
+	lines.append(f'    """Synthetic class number {file_index}."""')
+	for i in range(function_count):
+		lines.extend([
+			f'    def function_{i}(self, value):',
+			f'        # compute the result for step {i}',
+			f'        result = value * {i} + {file_index}',
+			f'        if result > {i * 10}:',
+			f'            return result - {i}',
+			'        return result',
+			'',
+		])
+	return '\n'.join(lines) + '\n'
+
+def make_synthetic_repo(root, file_count, function_count):
+	file_paths = []
+	for i in range(file_count):
+		file_path = os.path.join(root, f'module_{i}.py')
+		with open(file_path, 'w') as f:
+			f.write(make_synthetic_source(i, function_count))
+		file_paths.append(file_path)
+	return file_paths
+
+def make_synthetic_response(file_paths, function_count, block_count):
+	parts = ['Here are the changes you asked for:\n']
+	for block in range(block_count):
+		file_index = block % len(file_paths)
+		function_index = (block * 7) % function_count
+		parts.append(f'''{file_paths[file_index]}
+```python
+<<<<<<< SEARCH
+    def function_{function_index}(self, value):
+        # compute the result for step {function_index}
+        result = value * {function_index} + {file_index}
+=======
+    def function_{function_index}(self, value):
+        # compute the updated result for step {function_index}
+        result = value * {function_index} + {file_index} + 1
+>>>>>>> REPLACE
+```
+''')
+		parts.append(f'This changes function_{function_index} to add one.\n')
+	return '\n'.join(parts)
+
+def time_stage(fun, repeat, setup=None):
+	timings = []
+	for _ in range(repeat):
+		if setup:
+			setup()
+		start = time.perf_counter()
+		fun()
+		timings.append(time.perf_counter() - start)
+	return statistics.median(timings)
+
+def benchmark_size(size, repeat, server):
+	results = {}
+	with tempfile.TemporaryDirectory() as temp_dir:
+		source_dir = os.path.join(temp_dir, 'source')
+		work_dir = os.path.join(temp_dir, 'work')
+		os.makedirs(source_dir)
+		file_paths = make_synthetic_repo(source_dir, size['files'], size['functions'])
+		work_paths = [ os.path.join(work_dir, os.path.basename(file_path)) for file_path in file_paths ]
+		response = make_synthetic_response(work_paths, size['functions'], size['blocks'])
+		file_contents = [ read_file_contents(file_path) for file_path in file_paths ]
+		context = [ { 'role': 'user', 'content': f'$ cat {file_path}\n{contents}' } for file_path, contents in zip(file_paths, file_contents) ]
+		context.append({ 'role': 'system', 'content': 'You are a programming assistant.' })
+		context.append({ 'role': 'user', 'content': 'add one to a few functions' })
+
+		results['read_context_files'] = time_stage(lambda: [ read_file_contents(file_path) for file_path in file_paths ], repeat)
+		results['summarize_file'] = time_stage(lambda: [ summarize_file(contents) for contents in file_contents ], repeat)
+		results['summarize_python'] = time_stage(lambda: [ summarize_file(contents, file_path) for file_path, contents in zip(file_paths, file_contents) ], repeat)
+		results['serialize_request'] = time_stage(lambda: (
+			json.dumps({ 'model': 'gpt-4o', 'messages': [ { 'role': step['role'], 'content': step['content'] } for step in context ] }),
+			bedrock_support.build_bedrock_body(context),
+		), repeat)
+
+		server.responses[:] = [response]
+		with patch('llm_shell.chatgpt_support.chatgpt_api_key', 'mock-key'), \
+				patch('llm_shell.chatgpt_support.chatgpt_base_url', server.url + '/v1'):
+			results['backend_round_trip'] = time_stage(lambda: chatgpt_support.send_to_gpt4o(context), repeat)
+
+		results['apply_syntax_highlighting'] = time_stage(lambda: apply_syntax_highlighting(response), repeat)
+		results['parse_diff_string'] = time_stage(lambda: parse_diff_string(response), repeat)
+
+		diff_blocks = parse_diff_string(response)
+		def reset_work_dir():
+			shutil.rmtree(work_dir, ignore_errors=True)
+			shutil.copytree(source_dir, work_dir)
+		def apply_all_changes():
+			with contextlib.redirect_stdout(io.StringIO()):
+				for filepath, search_block, replace_block in diff_blocks:
+					apply_changes(filepath, search_block, replace_block)
+		results['apply_changes'] = time_stage(apply_all_changes, repeat, setup=reset_work_dir)
+		results['apply_changes_batch'] = time_stage(lambda: apply_changes_batch(diff_blocks), repeat, setup=reset_work_dir)
+
+		# Every block against the same file, where the batch reads and writes the file only once
+		one_file_blocks = parse_diff_string(make_synthetic_response(work_paths[:1], size['functions'], size['blocks']))
+		def apply_one_file_changes():
+			with contextlib.redirect_stdout(io.StringIO()):
+				for filepath, search_block, replace_block in one_file_blocks:
+					apply_changes(filepath, search_block, replace_block)
+		results['apply_changes_one_file'] = time_stage(apply_one_file_changes, repeat, setup=reset_work_dir)
+		results['apply_changes_batch_one_file'] = time_stage(lambda: apply_changes_batch(one_file_blocks), repeat, setup=reset_work_dir)
+	return results
+
+def make_synthetic_braces_source(function_count):
+	lines = ['// synthetic module', 'import { helper } from "./helper";', '', 'export class Module {']
+	for i in range(function_count):
+		lines.extend([
+			f'  function_{i}(value) {{',
+			f'    // compute the result for step {i}',
+			f'    const result = value * {i};',
+			f'    if (result > {i * 10}) {{',
+			f'      return result - {i};',
+			'    }',
+			'    return result;',
+			'  }',
+			'',
+		])
+	lines.append('}')
+	return '\n'.join(lines) + '\n'
+
+def benchmark_summarizer(function_count, repeat):
+	# Seconds to summarize one large file with each strategy, returns { strategy: line count } and { strategy: seconds }
+	python_source = make_synthetic_source(0, function_count)
+	braces_source = make_synthetic_braces_source(function_count)
+	line_counts = {}
+	timings = {}
+	for name, summarizer, source in (('generic', summarize_generic, python_source),
+			('python', summarize_python, python_source), ('braces', summarize_braces, braces_source)):
+		line_counts[name] = source.count('\n')
+		timings[name] = time_stage(lambda: summarizer(source), repeat)
+	return line_counts, timings
+
+def benchmark_search(function_count, repeat):
+	# Milliseconds per search block lookup in one large file, for a few kinds of block
+	file_lines = make_synthetic_source(0, function_count).splitlines()
+	step = max(1, function_count // 20)
+	searches = {
+		'exact': [ [f'    def function_{i}(self, value):', f'        # compute the result for step {i}'] for i in range(0, function_count, step) ],
+		# blocks the llm sent without the file's indentation
+		'shifted': [ [f'def function_{i}(self, value):', f'    # compute the result for step {i}'] for i in range(0, function_count, step) ],
+		'missing': [ ['def missing_function(self):', '    pass'] ] * 20,
+	}
+	timings = {}
+	for name, blocks in searches.items():
+		seconds = time_stage(lambda: [ search_change_lines(file_lines, block) for block in blocks ], repeat)
+		timings[name] = seconds / len(blocks)
+	return len(file_lines), timings
+
+def benchmark_agent_turn(size, repeat, latency):
+	# One agent turn through handle_llm_command against the mock server, answering with the two-request flow and in
+	# single-call mode, with each request taking at least the given latency. Returns { mode: seconds } and
+	# { mode: (requests, input tokens) }
+	import llm_shell.llm_shell as llm_shell
+	import llm_shell.llm_stats as llm_stats
+	server = start_mock_server(first_token_latency=latency)
+	results = {}
+	counts = {}
+	try:
+		with tempfile.TemporaryDirectory() as temp_dir:
+			source_dir = os.path.join(temp_dir, 'source')
+			work_dir = os.path.join(temp_dir, 'work')
+			os.makedirs(source_dir)
+			file_paths = make_synthetic_repo(source_dir, size['files'], size['functions'])
+			work_paths = [ os.path.join(work_dir, os.path.basename(file_path)) for file_path in file_paths ]
+			diff_response = make_synthetic_response(work_paths, size['functions'], size['blocks'])
+			answer = 'To do that, add one to the result of a few of the functions.'
+			for mode, single_call, responses in (('two_pass', False, [answer, diff_response]), ('single_call', True, [diff_response])):
+				def reset_turn():
+					shutil.rmtree(work_dir, ignore_errors=True)
+					shutil.copytree(source_dir, work_dir)
+					llm_shell.history = []
+					server.responses[:] = responses
+					server.request_count = 0
+					llm_stats.clear_call_records()
+				def run_turn():
+					with contextlib.redirect_stdout(io.StringIO()):
+						llm_shell.handle_llm_command('add one to a few functions')
+				with patch.dict(llm_shell.llm_config, { 'llm_backend': 'openai-gpt-4o', 'llm_stream': True, 'llm_cache': False,
+							'experimental_llm_agent': True, 'experimental_llm_agent_single_call': single_call, 'context_file': work_paths }), \
+						patch('llm_shell.chatgpt_support.chatgpt_api_key', 'mock-key'), \
+						patch('llm_shell.chatgpt_support.chatgpt_base_url', server.url + '/v1'):
+					seconds = time_stage(run_turn, repeat, setup=reset_turn)
+				records = llm_stats.get_call_records()
+				results[mode] = seconds
+				counts[mode] = (len(records), sum(record['input_tokens'] or 0 for record in records))
+	finally:
+		server.shutdown()
+		server.server_close()
+	return results, counts
+
+def run_benchmarks(sizes, repeat):
+	server = start_mock_server()
+	try:
+		return { name: benchmark_size(benchmark_sizes[name], repeat, server) for name in sizes }
+	finally:
+		server.shutdown()
+		server.server_close()
+
+def compare_to_baseline(results, baseline, threshold):
+	# A stage regresses when it is slower than the baseline by more than the threshold factor
+	regressions = []
+	for size, stages in results.items():
+		for stage, seconds in stages.items():
+			baseline_seconds = baseline.get(size, {}).get(stage)
+			# Ignore sub-millisecond stages, their timings are mostly noise
+			if baseline_seconds and seconds > 0.001 and seconds > baseline_seconds * threshold:
+				regressions.append((size, stage, baseline_seconds, seconds))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark each stage of an LLM Shell request offline.')
+	parser.add_argument('-s', '--size', action='append', choices=list(benchmark_sizes.keys()), help='Sizes to benchmark (defaults to all).')
+	parser.add_argument('-r', '--repeat', type=int, default=5, help='Number of timed runs per stage, the median is reported.')
+	parser.add_argument('-o', '--output', help='Write the results as json to this file.')
+	parser.add_argument('-b', '--baseline', default=default_baseline_path, help='Baseline results to compare against.')
+	parser.add_argument('-t', '--threshold', type=float, default=2.0, help='Slowdown factor over the baseline counted as a regression.')
+	parser.add_argument('--summarizer-functions', type=int, default=20000, help='Number of functions in the file used for the summarizer throughput benchmark.')
+	parser.add_argument('--search-functions', type=int, default=2000, help='Number of functions in the file used for the search block matching benchmark.')
+	parser.add_argument('--agent-latency', type=float, default=0.05, help='Seconds each request takes in the agent turn benchmark.')
+	parser.add_argument('--update-baseline', action='store_true', help='Store these results as the new baseline.')
+	args = parser.parse_args()
+
+	sizes = args.size or list(benchmark_sizes.keys())
+	results = run_benchmarks(sizes, args.repeat)
+
+	for size, stages in results.items():
+		print(f'{size}:')
+		for stage, seconds in stages.items():
+			print(f'\t{stage:<28} {seconds * 1000:10.3f} ms')
+
+	# The other benchmarks are stored next to the sizes, as their own groups of stages in seconds
+	line_counts, results['summarizer'] = benchmark_summarizer(args.summarizer_functions, args.repeat)
+	print('summarizer throughput:')
+	for name, seconds in results['summarizer'].items():
+		print(f'\t{name:<28} {line_counts[name] / seconds:10.0f} lines/s')
+
+	line_count, results['search'] = benchmark_search(args.search_functions, args.repeat)
+	print(f'search block matching ({line_count} lines):')
+	for name, seconds in results['search'].items():
+		print(f'\t{name:<28} {seconds * 1000:10.3f} ms')
+
+	for size in sizes:
+		print(f'agent turn ({size}, {args.agent_latency * 1000:.0f} ms per request):')
+		results[f'agent_turn_{size}'], counts = benchmark_agent_turn(benchmark_sizes[size], args.repeat, args.agent_latency)
+		for mode, seconds in results[f'agent_turn_{size}'].items():
+			requests, input_tokens = counts[mode]
+			print(f'\t{mode:<28} {seconds * 1000:10.3f} ms {requests:4} request(s) {input_tokens:8} input tokens')
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=4)
+
+	if args.update_baseline:
+		with open(args.baseline, 'w') as f:
+			json.dump(results, f, indent=4)
+		print(f'baseline written to {args.baseline}')
+		return 0
+
+	if os.path.isfile(args.baseline):
+		with open(args.baseline, 'r') as f:
+			baseline = json.load(f)
+		regressions = compare_to_baseline(results, baseline, args.threshold)
+		for size, stage, baseline_seconds, seconds in regressions:
+			print(f'regression: {size} {stage} took {seconds * 1000:.3f} ms (baseline {baseline_seconds * 1000:.3f} ms)')
+		if regressions:
+			return 1
+		print('no regressions against the baseline')
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -2,12 +2,31 @@
 import sys
 import os
 import os.path
+import json
+import time
+import threading
+import subprocess
 import unittest
 import tempfile
+import importlib.util
 from unittest.mock import patch, Mock
-from io import StringIO
+from io import StringIO, BytesIO
+import llm_shell.llm_shell as llm_shell
+import llm_shell.chatgpt_support as chatgpt_support
+import llm_shell.bedrock_support as bedrock_support
+import llm_shell.response_cache as response_cache
+import llm_shell.llm_stats as llm_stats
+import llm_shell.context_cache as context_cache
+import llm_shell.summarizer as summarizer
+import llm_shell.repo_index as repo_index
+import llm_shell.shell_session as shell_session
+import llm_shell.completion as completion
+import llm_shell.candidates as candidates
+import llm_shell.util as llm_shell_util
 from llm_shell.llm_shell import autocomplete_string, handle_command, ask_llm, llm_config
-from llm_shell.util import parse_diff_string, apply_changes
+from llm_shell.mock_server import start_mock_server
+from llm_shell.util import parse_diff_string, apply_changes, estimate_tokens, shorten_output, OutputCapture, search_change_lines, apply_changes_batch, \
+	DiffStreamParser, ChangeSet
 
 # Define a helper context manager to capture stdout
 class CaptureStdout(list):
@@ -154,6 +173,30 @@ class TestLLMShell(unittest.TestCase):
 				# Check if the completion is correct
 				self.assertEqual(completion, correction)
 
+	def test_autocomplete_states_reuse_completions(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			for name in ['zzprog-b', 'zzprog-a', 'zzprog-c', 'other']:
+				open(os.path.join(temp_dir, name), 'w').close()
+			index = completion.ExecutableIndex()
+			with patch.dict(os.environ, {'PATH': temp_dir}), patch('llm_shell.completion.executable_index', index), \
+					patch('readline.get_line_buffer', return_value='zzprog'), \
+					patch.object(index, 'refresh', wraps=index.refresh) as refresh:
+				completions = [ autocomplete_string('zzprog', state) for state in range(4) ]
+				self.assertEqual(completions, ['zzprog-a', 'zzprog-b', 'zzprog-c', None])
+				self.assertEqual(refresh.call_count, 1)
+
+	def test_executable_index_follows_directory_changes(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			open(os.path.join(temp_dir, 'zzprog-a'), 'w').close()
+			index = completion.ExecutableIndex()
+			with patch.dict(os.environ, {'PATH': temp_dir}):
+				self.assertEqual(index.complete('zzprog'), ['zzprog-a'])
+				self.assertFalse(index.refresh())
+				open(os.path.join(temp_dir, 'zzprog-b'), 'w').close()
+				# make sure the directory mtime changes even on coarse timestamp filesystems
+				os.utime(temp_dir, ns=(0, os.stat(temp_dir).st_mtime_ns + 1000000000))
+				self.assertEqual(index.complete('zzprog'), ['zzprog-a', 'zzprog-b'])
+
 	def test_regression_context_reading(self):
 		
 		# Mock glob to return a list of .py files
@@ -418,6 +461,1302 @@ if True:
 
 		os.remove('/tmp/flask.py')
 
+	def test_edit_file_single_line(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			filepath = os.path.join(temp_dir, 'single.py')
+			with open(filepath, 'w') as f:
+				f.write('a = 1\nb = 2\nc = 3')
+			with CaptureStdout():
+				self.assertTrue(apply_changes(filepath, 'b = 2', 'b = 20'))
+			with open(filepath, 'r') as f:
+				# only the matched line is replaced, the line after it is kept
+				self.assertEqual(f.read(), 'a = 1\nb = 20\nc = 3')
+
+	def run_agent_turn(self, backend_responses, stream):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			path = os.path.join(temp_dir, 'a.py')
+			with open(path, 'w') as f:
+				f.write('x = 1\n')
+			contexts = []
+			def backend(context):
+				contexts.append(context)
+				return backend_responses[len(contexts) - 1].replace('a.py', path)
+			with patch.dict(llm_config, { 'llm_backend': 'hello-world', 'llm_stream': stream, 'llm_cache': False,
+						'experimental_llm_agent': True, 'experimental_llm_agent_single_call': True }), \
+					patch.dict(llm_shell.support_llm_backends, {'hello-world': backend}), \
+					patch.dict(llm_shell.support_llm_stream_backends, {'hello-world': lambda context: iter([backend(context)])}):
+				with CaptureStdout() as output:
+					handle_command('# set x to 10')
+			with open(path, 'r') as f:
+				return contexts, output, f.read()
+
+	def test_single_call_agent_applies_blocks_from_the_answer(self):
+		import llm_shell.experimental_llm_agent as experimental_llm_agent
+		answer = 'Setting x to 10:\na.py\n```\n<<<<<<< SEARCH\nx = 1\n=======\nx = 10\n>>>>>>> REPLACE\n```\n'
+		for stream in (False, True):
+			contexts, output, contents = self.run_agent_turn([answer], stream)
+			self.assertEqual(len(contexts), 1)
+			self.assertIn(experimental_llm_agent.llm_single_call_instruction, [ entry['content'] for entry in contexts[0] ])
+			self.assertEqual(contents, 'x = 10')
+			self.assertNotIn('[[edit response:]]', output)
+
+	def test_single_call_agent_falls_back_to_a_diff_request(self):
+		import llm_shell.experimental_llm_agent as experimental_llm_agent
+		diff_response = 'a.py\n```\n<<<<<<< SEARCH\nx = 1\n=======\nx = 10\n>>>>>>> REPLACE\n```\n'
+		for stream in (False, True):
+			contexts, output, contents = self.run_agent_turn(['Change x to 10.', diff_response], stream)
+			self.assertEqual(len(contexts), 2)
+			self.assertEqual(contexts[1][0]['content'], experimental_llm_agent.llm_diff_instruction)
+			self.assertEqual(contexts[1][-1], {'role': 'user', 'content': experimental_llm_agent.llm_diff_request})
+			self.assertIn('[[edit response:]]', output)
+			self.assertEqual(contents, 'x = 10')
+
+class TestSearchChangeLines(unittest.TestCase):
+
+	file_lines = [
+		'class Foo:',
+		'    def bar(self):',
+		'        x = 1',
+		'',
+		'        return x',
+		'    def baz(self):',
+		'        x = 1',
+		'        return x + 1',
+	]
+
+	def test_exact_match_skips_blank_lines(self):
+		self.assertEqual(search_change_lines(self.file_lines, ['    def bar(self):', '        x = 1', '        return x']), (1, 5, 0))
+
+	def test_infers_smallest_indentation(self):
+		self.assertEqual(search_change_lines(self.file_lines, ['x = 1', 'return x + 1']), (6, 8, 8))
+		self.assertEqual(search_change_lines(self.file_lines, ['def baz(self):']), (5, 6, 4))
+
+	def test_odd_or_large_offsets_do_not_match(self):
+		self.assertEqual(search_change_lines(['   x = 1'], ['x = 1']), (-1, -1, 0))
+		self.assertEqual(search_change_lines([' ' * 42 + 'x = 1'], ['x = 1']), (-1, -1, 0))
+		self.assertEqual(search_change_lines([' ' * 40 + 'x = 1'], ['x = 1']), (0, 1, 40))
+
+	def test_missing_and_empty_blocks(self):
+		self.assertEqual(search_change_lines(self.file_lines, ['x = 2']), (-1, -1, 0))
+		self.assertEqual(search_change_lines(self.file_lines, []), (-1, -1, 0))
+
+class TestDiffStreamParser(unittest.TestCase):
+
+	diff_response = '''I'll make two changes:
+a.py
+```python
+<<<<<<< SEARCH
+x = 1
+=======
+x = 10
+>>>>>>> REPLACE
+```
+Then the second one:
+
+```
+<<<<<<< SEARCH
+y = 2
+=======
+y = 20
+>>>>>>> REPLACE
+```
+```
+`b/c.py`
+<<<<<<< SEARCH
+=======
+z = 3
+>>>>>>> REPLACE
+```
+'''
+
+	def test_blocks_are_returned_as_their_replace_line_arrives(self):
+		parser = DiffStreamParser()
+		blocks = []
+		first_block_end = self.diff_response.index('>>>>>>> REPLACE\n') + len('>>>>>>> REPLACE\n')
+		for i in range(0, len(self.diff_response), 5):
+			blocks += parser.feed(self.diff_response[i:i + 5])
+			if i + 5 < first_block_end:
+				self.assertEqual(blocks, [])
+			else:
+				self.assertEqual(blocks[:1], [('a.py', 'x = 1', 'x = 10')])
+		blocks += parser.close()
+		# the second block has no path and goes to the file of the one before it
+		self.assertEqual(blocks, [('a.py', 'x = 1', 'x = 10'), ('a.py', 'y = 2', 'y = 20'), ('b/c.py', '', 'z = 3')])
+		self.assertEqual(parse_diff_string(self.diff_response), blocks)
+
+	def test_unfinished_block_is_not_returned(self):
+		parser = DiffStreamParser()
+		blocks = parser.feed('a.py\n```\n<<<<<<< SEARCH\nx = 1\n=======\nx = 10\n>>>>>>> REPLACE')
+		self.assertEqual(blocks + parser.close(), [])
+
+	def test_false_block_start_is_rescanned(self):
+		# the second fence would start a block with no divider after it, so the block starts at the first one
+		diff_response = 'a.py\n```<<<<<<< SEARCH\n```python\n=======\n<<<<<<< SEARCH\nnew\n>>>>>>> REPLACE\n'
+		self.assertEqual(parse_diff_string(diff_response), [('a.py', '```python', '<<<<<<< SEARCH\nnew')])
+
+	def test_adversarial_responses_parse_in_linear_time(self):
+		for diff_response in [
+			'a.py\n```python\n<<<<<<< SEARCH\n' * 20000,
+			'a.py\n```\n<<<<<<< SEARCH\n=======\n' * 20000,
+			'a.py\n```\n<<<<<<< SEARCH\n' + 'x = 1\n' * 100000,
+			'`' * 100000 + '\n' + '=' * 100000 + '\n',
+		]:
+			start_time = time.time()
+			self.assertEqual(parse_diff_string(diff_response), [])
+			parser = DiffStreamParser()
+			for i in range(0, len(diff_response), 3):
+				parser.feed(diff_response[i:i + 3])
+			self.assertEqual(parser.close(), [])
+			self.assertLess(time.time() - start_time, 5)
+
+	def test_change_set_applies_blocks_as_they_arrive(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			path = os.path.join(temp_dir, 'a.py')
+			with open(path, 'w') as f:
+				f.write('x = 1\ny = 2\n')
+			change_set = ChangeSet()
+			self.assertEqual(change_set.apply(path, 'x = 1', 'x = 10'), 'applied')
+			self.assertEqual(change_set.apply(path, 'z = 3', 'z = 30'), 'not found')
+			# nothing is written before the commit, and a file with a missing block is left untouched
+			with open(path, 'r') as f:
+				self.assertEqual(f.read(), 'x = 1\ny = 2\n')
+			self.assertEqual(change_set.commit(), [(path, 'x = 1', 'rolled back'), (path, 'z = 3', 'not found')])
+			with open(path, 'r') as f:
+				self.assertEqual(f.read(), 'x = 1\ny = 2\n')
+
+	def test_agent_applies_streamed_diff(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			path = os.path.join(temp_dir, 'a.py')
+			with open(path, 'w') as f:
+				f.write('x = 1\ny = 2\n')
+			diff_response = f'{path}\n```\n<<<<<<< SEARCH\nx = 1\n=======\nx = 10\n>>>>>>> REPLACE\n```\n' \
+				f'{path}\n```\n<<<<<<< SEARCH\ny = 2\n=======\ny = 20\n>>>>>>> REPLACE\n```\n'
+			applied = []
+			def backend(context):
+				if context[0]['content'] != experimental_llm_agent.llm_diff_instruction:
+					yield 'set x to 10 and y to 20'
+					return
+				first, second = diff_response.split('```\n' + path)
+				yield first
+				# the first block was applied before the model wrote the second
+				applied.append(len(llm_shell_util.FileChanges.apply.call_args_list))
+				yield '```\n' + path + second
+			import llm_shell.experimental_llm_agent as experimental_llm_agent
+			with patch.dict(llm_config, { 'llm_backend': 'hello-world', 'llm_stream': True, 'llm_cache': False, 'experimental_llm_agent': True }), \
+					patch.dict(llm_shell.support_llm_stream_backends, {'hello-world': backend}), \
+					patch.object(llm_shell_util.FileChanges, 'apply', autospec=True, side_effect=llm_shell_util.FileChanges.apply):
+				with CaptureStdout() as output:
+					handle_command('# change x and y')
+			self.assertEqual(applied, [1])
+			self.assertIn(f'Applying changes to {path}... applied', output)
+			with open(path, 'r') as f:
+				self.assertEqual(f.read(), 'x = 10\ny = 20')
+
+class TestApplyChangesBatch(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.temp_dir.cleanup()
+
+	def write_file(self, name, contents):
+		path = os.path.join(self.temp_dir.name, name)
+		with open(path, 'w') as f:
+			f.write(contents)
+		return path
+
+	def read_file(self, path):
+		with open(path, 'r') as f:
+			return f.read()
+
+	def test_blocks_apply_in_order_with_one_write(self):
+		path = self.write_file('a.py', 'def foo():\n\treturn 1\n\ndef bar():\n\treturn 2\n')
+		blocks = [
+			(path, 'return 1', 'return 10'),
+			(path, 'return 2', 'return 20'),
+			# the third block searches for text the first one wrote
+			(path, 'return 10', 'return 100'),
+		]
+		with patch('llm_shell.util.write_file_atomically', wraps=llm_shell_util.write_file_atomically) as write:
+			results = apply_changes_batch(blocks)
+		self.assertEqual(write.call_count, 1)
+		self.assertEqual([ status for filepath, search_block, status in results ], ['applied', 'applied', 'applied'])
+		self.assertEqual(self.read_file(path), 'def foo():\n    return 100\n\ndef bar():\n    return 20')
+
+	def test_failed_block_leaves_file_untouched(self):
+		path = self.write_file('a.py', 'x = 1\ny = 2\n')
+		results = apply_changes_batch([(path, 'x = 1', 'x = 10'), (path, 'z = 3', 'z = 30')])
+		self.assertEqual([ status for filepath, search_block, status in results ], ['rolled back', 'not found'])
+		self.assertEqual(self.read_file(path), 'x = 1\ny = 2\n')
+
+	def test_files_are_independent(self):
+		path_a = self.write_file('a.py', 'x = 1')
+		path_b = self.write_file('b.py', 'y = 2')
+		os.chmod(path_b, 0o755)
+		path_c = os.path.join(self.temp_dir.name, 'c.py')
+		path_d = self.write_file('d.py', 'w = 4')
+		# four files are applied in parallel
+		results = apply_changes_batch([(path_a, 'missing', 'x'), (path_b, 'y = 2', 'y = 20'), (path_c, '', 'z = 3\n'), (path_d, 'w = 4', 'w = 40')])
+		self.assertEqual([ status for filepath, search_block, status in results ], ['not found', 'applied', 'created', 'applied'])
+		self.assertEqual(self.read_file(path_d), 'w = 40')
+		self.assertEqual(self.read_file(path_a), 'x = 1')
+		self.assertEqual(self.read_file(path_b), 'y = 20')
+		self.assertEqual(os.stat(path_b).st_mode & 0o777, 0o755)
+		self.assertEqual(self.read_file(path_c), 'z = 3\n')
+		self.assertEqual(sorted(os.listdir(self.temp_dir.name)), ['a.py', 'b.py', 'c.py', 'd.py'])
+
+class TestCandidates(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.root = self.temp_dir.name
+		with open(os.path.join(self.root, 'a.py'), 'w') as f:
+			f.write('x = 1\n')
+
+	def tearDown(self):
+		self.temp_dir.cleanup()
+
+	def diff_response(self, replace):
+		return f'a.py\n```\n<<<<<<< SEARCH\nx = 1\n=======\n{replace}\n>>>>>>> REPLACE\n```\n'
+
+	def run_agent(self, responses, **config):
+		# responses are returned in call order, a (seconds, response) pair is returned after a delay
+		responses = iter(responses)
+		lock = threading.Lock()
+		def respond(context):
+			with lock:
+				response = next(responses)
+			if type(response) is tuple:
+				time.sleep(response[0])
+				response = response[1]
+			return response
+		backend = Mock(side_effect=respond)
+		current_dir = os.getcwd()
+		os.chdir(self.root)
+		try:
+			with patch.dict(llm_config, dict({ 'llm_backend': 'hello-world', 'llm_stream': False, 'llm_cache': False, 'experimental_llm_agent': True,
+						'experimental_llm_agent_candidates': 2, 'experimental_verifier_command': 'grep -q "x = 3" a.py' }, **config)), \
+					patch.dict(llm_shell.support_llm_backends, {'hello-world': backend}):
+				with CaptureStdout() as output:
+					handle_command('# set x to 3')
+		finally:
+			os.chdir(current_dir)
+		return output, backend
+
+	def test_first_passing_candidate_wins(self):
+		responses = [ 'No changes needed.', self.diff_response('x = 2').replace('x = 1', 'y = 1'), self.diff_response('x = 2'), self.diff_response('x = 3') ]
+		all_candidates, winner = candidates.run_candidates(responses, 'grep -q "x = 3" a.py', root=self.root)
+		self.assertEqual([ candidate.status for candidate in all_candidates ], ['no changes', 'not applied', 'failed', 'passed'])
+		self.assertIs(winner, all_candidates[3])
+		# the real tree is untouched and the workspaces are gone
+		with open(os.path.join(self.root, 'a.py'), 'r') as f:
+			self.assertEqual(f.read(), 'x = 1\n')
+		self.assertTrue(all(candidate.workspace is None for candidate in all_candidates))
+
+	def test_slower_verifiers_are_cancelled(self):
+		responses = [ self.diff_response('x = "slow"'), self.diff_response('x = "fast"') ]
+		start_time = time.time()
+		all_candidates, winner = candidates.run_candidates(responses, 'grep -q fast a.py || sleep 30', root=self.root)
+		self.assertLess(time.time() - start_time, 10)
+		self.assertIs(winner, all_candidates[1])
+		self.assertEqual(all_candidates[0].status, 'cancelled')
+
+	def test_blocks_outside_the_tree_are_not_applied(self):
+		all_candidates, winner = candidates.run_candidates([ self.diff_response('x = 2').replace('a.py', '../outside.py') ], root=self.root)
+		self.assertIsNone(winner)
+		self.assertEqual(all_candidates[0].status, 'not applied')
+
+	def test_agent_promotes_the_winning_candidate(self):
+		output, backend = self.run_agent([ 'Set x to 3.', self.diff_response('x = 2'), (0.5, self.diff_response('x = 3')) ])
+		self.assertTrue(any(line.startswith('Candidate 2: passed') for line in output))
+		self.assertTrue(any(line.startswith('Candidate 1: failed') for line in output))
+		self.assertIn('Applying changes to a.py... applied', output)
+		with open(os.path.join(self.root, 'a.py'), 'r') as f:
+			self.assertEqual(f.read(), 'x = 3')
+
+	def test_verifier_starts_before_slower_candidates_arrive(self):
+		start_time = time.time()
+		output, backend = self.run_agent([ 'Set x to 3.', self.diff_response('x = 3'), (3, self.diff_response('x = 2')) ])
+		self.assertLess(time.time() - start_time, 2)
+		self.assertTrue(any(line.startswith('Candidate 1: passed') for line in output))
+		self.assertIn('1 candidate request(s) cancelled', output)
+		with open(os.path.join(self.root, 'a.py'), 'r') as f:
+			self.assertEqual(f.read(), 'x = 3')
+
+	def test_workspaces_include_ignored_dependencies(self):
+		# the verifier needs build/ although git ignores it
+		subprocess.run(['git', 'init', '-q', self.root], check=True)
+		with open(os.path.join(self.root, '.gitignore'), 'w') as f:
+			f.write('build/\n')
+		os.mkdir(os.path.join(self.root, 'build'))
+		with open(os.path.join(self.root, 'build', 'dep.txt'), 'w') as f:
+			f.write('built')
+		self.assertEqual(candidates.workspace_size(self.root) - candidates.workspace_size(os.path.join(self.root, '.git')),
+			len('build/\n') + len('built') + len('x = 1\n'))
+		all_candidates, winner = candidates.run_candidates([ self.diff_response('x = 2') ], 'test -f build/dep.txt && grep -q 2 a.py', root=self.root)
+		self.assertIs(winner, all_candidates[0])
+
+	def test_workspaces_share_the_tree_filesystem(self):
+		parent = candidates.workspace_parent(self.root)
+		self.assertEqual(os.stat(parent).st_dev, os.stat(self.root).st_dev)
+		self.assertIsNone(candidates.relocate_path(parent, self.root, self.root))
+
+	def test_large_trees_fall_back_to_a_single_edit(self):
+		with patch('llm_shell.candidates.max_workspace_bytes', 1):
+			output, backend = self.run_agent([ 'Set x to 3.', self.diff_response('x = 3') ])
+		self.assertTrue(any('limit for candidate workspaces' in line for line in output))
+		self.assertEqual(backend.call_count, 2)
+		with open(os.path.join(self.root, 'a.py'), 'r') as f:
+			self.assertEqual(f.read(), 'x = 3')
+
+	def test_candidate_requests_bypass_the_cache(self):
+		with tempfile.TemporaryDirectory() as cache_dir, patch('llm_shell.response_cache.cache_dir', cache_dir):
+			output, backend = self.run_agent([ 'Set x to 3.', self.diff_response('x = 3'), self.diff_response('x = 3') ], llm_cache=True)
+			# only the answer itself was cached, every candidate was a request of its own
+			self.assertEqual(response_cache.cache_stats()['entries'], 1)
+		self.assertEqual(backend.call_count, 3)
+		self.assertEqual(backend.call_args_list[1], backend.call_args_list[2])
+
+class TestOutputCapture(unittest.TestCase):
+
+	def tearDown(self):
+		llm_config['shell_output_spill'] = False
+		llm_shell.history.clear()
+
+	def test_capture_matches_shorten_output(self):
+		for length in (0, 10, 1999, 2000, 2001, 2500, 50000):
+			output = ''.join(chr(ord('a') + i % 26) for i in range(length))
+			for chunk_size in (1, 7, 1000, 65536):
+				capture = OutputCapture()
+				for i in range(0, len(output), chunk_size):
+					capture.write(output[i:i + chunk_size])
+				self.assertEqual(capture.getvalue(), shorten_output(output))
+
+	def test_large_output_is_bounded(self):
+		with CaptureStdout() as output:
+			capture, exit_code = llm_shell.execute_shell_command('seq 1 200000')
+		self.assertEqual(exit_code, 0)
+		self.assertEqual(len(output), 200000)
+		self.assertEqual(capture.length, len('\n'.join(str(i) for i in range(1, 200001))) + 1)
+		self.assertLessEqual(len(capture.head), 2000)
+		self.assertLessEqual(len(capture.tail), 1000)
+		self.assertTrue(capture.getvalue().endswith('199999\n200000\n'))
+
+	def test_history_and_spill(self):
+		llm_config['shell_output_spill'] = True
+		with CaptureStdout():
+			exit_code = llm_shell.process_standard_command('seq 1 5000; exit 3')
+		full_output = ''.join(f'{i}\n' for i in range(1, 5001))
+		self.assertEqual(exit_code, 3)
+		entry = llm_shell.history[-1]['content']
+		self.assertTrue(entry.startswith('$ seq 1 5000; exit 3\n' + shorten_output(full_output)))
+		self.assertTrue(entry.endswith('exit_code: 3'))
+		spill_path = entry.split('(full output saved to ')[1].split(')')[0]
+		with open(spill_path, 'r') as f:
+			self.assertEqual(f.read(), full_output)
+		os.remove(spill_path)
+
+class TestShellSession(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		llm_config['shell_session'] = True
+
+	def tearDown(self):
+		llm_config['shell_session'] = False
+		shell_session.reset_session()
+		os.chdir(self.cwd)
+		llm_shell.history.clear()
+
+	def run_command(self, command):
+		with CaptureStdout():
+			capture, exit_code = llm_shell.execute_shell_command(command)
+		return capture.getvalue(), exit_code
+
+	def test_state_persists_between_commands(self):
+		self.assertEqual(self.run_command('export LLM_SHELL_TEST=hello; greet() { echo "$1 $LLM_SHELL_TEST"; }'), ('', 0))
+		self.assertEqual(self.run_command('greet world'), ('world hello\n', 0))
+		self.assertEqual(self.run_command('printf partial'), ('partial', 0))
+		self.assertEqual(self.run_command('echo failing; exit_code() { return 3; }; exit_code'), ('failing\n', 3))
+
+	def test_working_directory_follows_session(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			temp_dir = os.path.realpath(temp_dir)
+			self.run_command(f'cd {temp_dir}')
+			self.assertEqual(os.getcwd(), temp_dir)
+			# the shell's own cd command moves the session along with it
+			os.chdir(self.cwd)
+			self.assertEqual(self.run_command('pwd'), (self.cwd + '\n', 0))
+
+	def test_marker_split_across_reads(self):
+		with patch('llm_shell.shell_session.read_chunk_size', 3):
+			self.assertEqual(self.run_command('seq 1 5'), ('1\n2\n3\n4\n5\n', 0))
+			self.assertEqual(self.run_command('printf "a\\n\\n"'), ('a\n\n', 0))
+
+	def test_exit_restarts_session(self):
+		self.run_command('export LLM_SHELL_TEST=hello')
+		self.assertEqual(self.run_command('exit 4'), ('', 4))
+		self.assertEqual(self.run_command('echo "[$LLM_SHELL_TEST]"'), ('[]\n', 0))
+
+class TestHttpSession(unittest.TestCase):
+
+	def tearDown(self):
+		chatgpt_support.configure_http_session(pool_size=10, max_retries=2, timeout=120)
+
+	def test_session_is_reused(self):
+		session = chatgpt_support.get_http_session()
+		self.assertIs(chatgpt_support.get_http_session(), session)
+
+	def test_configure_session(self):
+		with CaptureStdout() as output:
+			handle_command('llm-http-pool-size 3')
+			handle_command('llm-http-retries 5')
+			handle_command('llm-http-timeout 7.5')
+		self.assertEqual(chatgpt_support.http_session_config, { 'pool_size': 3, 'max_retries': 5, 'timeout': 7.5 })
+		adapter = chatgpt_support.get_http_session().get_adapter('https://api.openai.com/v1/chat/completions')
+		self.assertEqual(adapter._pool_maxsize, 3)
+		self.assertEqual(adapter.max_retries.total, 5)
+		with CaptureStdout() as output:
+			handle_command('llm-http-pool-size 10')
+			handle_command('llm-http-retries 2')
+			handle_command('llm-http-timeout 120')
+
+	def test_send_uses_session(self):
+		response = Mock()
+		response.status_code = 200
+		response.json.return_value = {
+			'usage': { 'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2 },
+			'choices': [ { 'message': { 'content': ' hi ' } } ],
+		}
+		with patch('llm_shell.chatgpt_support.chatgpt_api_key', 'test-key'), \
+				patch.object(chatgpt_support.get_http_session(), 'post', return_value=response) as mock_post:
+			self.assertEqual(chatgpt_support.send_to_gpt4o([{'role': 'user', 'content': 'hi'}]), 'hi')
+		self.assertEqual(mock_post.call_args.kwargs['timeout'], 120)
+
+# boto3 is an optional dependency, only needed for the bedrock backends
+requires_boto3 = unittest.skipUnless(importlib.util.find_spec('boto3'), 'boto3 is not installed')
+
+class TestBedrockClient(unittest.TestCase):
+
+	def setUp(self):
+		bedrock_support.clear_bedrock_clients()
+
+	def tearDown(self):
+		bedrock_support.clear_bedrock_clients()
+
+	@requires_boto3
+	def test_client_is_cached_per_region(self):
+		client = bedrock_support.get_bedrock_client(region='us-east-1')
+		self.assertIs(bedrock_support.get_bedrock_client(region='us-east-1'), client)
+		self.assertIsNot(bedrock_support.get_bedrock_client(region='us-west-2'), client)
+
+	@requires_boto3
+	def test_send_with_stubber(self):
+		from botocore.stub import Stubber
+		from botocore.response import StreamingBody
+		client = bedrock_support.get_bedrock_client(region='us-east-1')
+		payload = json.dumps({ 'content': [ { 'type': 'text', 'text': ' stubbed answer ' } ] }).encode()
+		with Stubber(client) as stubber:
+			stubber.add_response('invoke_model', {
+				'body': StreamingBody(BytesIO(payload), len(payload)),
+				'contentType': 'application/json',
+				'ResponseMetadata': { 'HTTPStatusCode': 200 },
+			})
+			with patch('llm_shell.bedrock_support.bedrock_region', 'us-east-1'):
+				response = bedrock_support.send_to_claude3haiku([{'role': 'system', 'content': 'sys'}, {'role': 'user', 'content': 'hi'}])
+			stubber.assert_no_pending_responses()
+		self.assertEqual(response, 'stubbed answer')
+
+	def test_prewarm_on_backend_change(self):
+		with patch('llm_shell.bedrock_support.prewarm_bedrock_client') as mock_prewarm, CaptureStdout():
+			handle_command('llm-backend claude-3-haiku')
+			handle_command('llm-backend hello-world')
+		mock_prewarm.assert_called_once()
+
+	@requires_boto3
+	def test_prewarm_builds_client(self):
+		bedrock_support.prewarm_bedrock_client(region='us-east-1').join()
+		self.assertIn(('us-east-1', None, None), bedrock_support.bedrock_clients)
+
+class TestResponseCache(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.patch_dir = patch('llm_shell.response_cache.cache_dir', self.temp_dir.name)
+		self.patch_dir.start()
+		llm_config['llm_backend'] = 'hello-world'
+		llm_config['llm_stream'] = False
+		llm_config['context_file'] = []
+		llm_config['summary_file'] = []
+		llm_config['llm_cache'] = True
+		llm_shell.history.clear()
+
+	def tearDown(self):
+		llm_config['llm_cache'] = False
+		llm_config['llm_stream'] = True
+		self.patch_dir.stop()
+		self.temp_dir.cleanup()
+
+	def test_cache_hit_skips_backend(self):
+		backend = Mock(return_value='cached answer')
+		with patch.dict(llm_shell.support_llm_backends, {'hello-world': backend}):
+			context = [{'role': 'user', 'content': 'question'}]
+			self.assertEqual(llm_shell.send_to_llm(context, show_spinner=False), 'cached answer')
+			self.assertEqual(llm_shell.send_to_llm([{'role': 'user', 'content': ' question\n'}], show_spinner=False), 'cached answer')
+		backend.assert_called_once()
+
+	def test_cache_hit_skips_stream(self):
+		stream = Mock(return_value=iter(['streamed ', 'answer']))
+		with patch.dict(llm_shell.support_llm_stream_backends, {'hello-world': stream}):
+			context = [{'role': 'user', 'content': 'question'}]
+			self.assertEqual(''.join(llm_shell.stream_llm(context)), 'streamed answer')
+			self.assertEqual(''.join(llm_shell.stream_llm(context)), 'streamed answer')
+		stream.assert_called_once()
+
+	def test_cache_key_depends_on_backend(self):
+		context = [{'role': 'user', 'content': 'question'}]
+		self.assertNotEqual(response_cache.cache_key('hello-world', context), response_cache.cache_key('openai-gpt-4o', context))
+
+	def test_cache_eviction_by_size(self):
+		with patch('llm_shell.response_cache.cache_max_bytes', 300):
+			for i in range(5):
+				key = response_cache.cache_key('hello-world', [{'role': 'user', 'content': f'question {i}'}])
+				response_cache.store_cached_response(key, 'hello-world', 'x' * 100)
+			self.assertLessEqual(response_cache.cache_stats()['size'], 300)
+			self.assertIsNotNone(response_cache.get_cached_response(key))
+
+	def test_eviction_is_throttled(self):
+		with patch('llm_shell.response_cache.evict_cache_entries', wraps=response_cache.evict_cache_entries) as evict:
+			for i in range(5):
+				key = response_cache.cache_key('hello-world', [{'role': 'user', 'content': f'question {i}'}])
+				response_cache.store_cached_response(key, 'hello-world', 'answer')
+		# only the first store, which has no size estimate yet, walks the cache
+		self.assertEqual(evict.call_count, 1)
+		self.assertEqual(response_cache.cache_stats()['entries'], 5)
+
+	def test_store_failure_is_ignored(self):
+		key = response_cache.cache_key('hello-world', [{'role': 'user', 'content': 'question'}])
+		with patch('llm_shell.response_cache.os.makedirs', side_effect=PermissionError('read-only')):
+			response_cache.store_cached_response(key, 'hello-world', 'answer')
+		self.assertIsNone(response_cache.get_cached_response(key))
+
+	def test_cache_eviction_by_age(self):
+		key = response_cache.cache_key('hello-world', [{'role': 'user', 'content': 'question'}])
+		response_cache.store_cached_response(key, 'hello-world', 'answer')
+		with patch('llm_shell.response_cache.cache_max_age', -1):
+			self.assertIsNone(response_cache.get_cached_response(key))
+
+	def test_cache_commands(self):
+		key = response_cache.cache_key('hello-world', [{'role': 'user', 'content': 'question'}])
+		response_cache.store_cached_response(key, 'hello-world', 'answer')
+		with CaptureStdout() as output:
+			handle_command('llm-cache stats')
+			handle_command('llm-cache clear')
+			handle_command('llm-cache off')
+		self.assertIn('1 entries', output[0])
+		self.assertIn('cleared 1 cached response(s)', output)
+		self.assertFalse(llm_config['llm_cache'])
+		self.assertEqual(response_cache.cache_stats()['entries'], 0)
+
+class TestContextBudget(unittest.TestCase):
+
+	def setUp(self):
+		llm_config['llm_backend'] = 'hello-world'
+		llm_shell.history.clear()
+
+	def tearDown(self):
+		llm_config['llm_context_budget'] = None
+		llm_shell.history.clear()
+
+	def test_estimate_tokens(self):
+		self.assertEqual(estimate_tokens(''), 0)
+		self.assertEqual(estimate_tokens('hello world'), 4)
+		self.assertEqual(estimate_tokens('a = b(1);'), 7)
+
+	def test_budget_keeps_newest_history(self):
+		llm_config['llm_context_budget'] = 100
+		llm_shell.update_history('user', 'old ' * 200)
+		for i in range(10):
+			llm_shell.update_history('user', f'message {i}')
+		required = [{'role': 'system', 'content': 'instruction'}, {'role': 'user', 'content': 'request'}]
+		with CaptureStdout() as output:
+			context = llm_shell.build_llm_context(required, history_length=11)
+		self.assertEqual(context[0], {'role': 'system', 'content': 'instruction', 'cache': True})
+		self.assertEqual(context[-1], {'role': 'user', 'content': 'request'})
+		self.assertEqual(context[1:-1], llm_shell.history[-10:])
+		self.assertIn('dropped 1 history message(s)', output[0])
+
+	def test_budget_never_sends_more_than_history_length(self):
+		for i in range(60):
+			llm_shell.update_history('user', f'message {i}')
+		context = llm_shell.build_llm_context([{'role': 'user', 'content': 'request'}])
+		self.assertEqual(context[:-1], llm_shell.history[-llm_config['llm_history_length']:])
+
+	def test_budget_drops_large_files(self):
+		llm_config['llm_context_budget'] = 100
+		files = [{'role': 'user', 'content': '$ cat big.py\n' + 'x = 1\n' * 100}, {'role': 'user', 'content': '$ cat small.py\nx = 1'}]
+		with CaptureStdout() as output:
+			context = llm_shell.build_llm_context([{'role': 'user', 'content': 'request'}], files)
+		self.assertEqual(context, [files[1], {'role': 'user', 'content': 'request'}])
+		self.assertIn('$ cat big.py', output[0])
+
+	def test_budget_off_uses_history_length(self):
+		with CaptureStdout():
+			handle_command('llm-context-budget off')
+		self.assertEqual(llm_config['llm_context_budget'], 0)
+		for i in range(10):
+			llm_shell.update_history('user', f'message {i}')
+		context = llm_shell.build_llm_context([{'role': 'user', 'content': 'request'}])
+		self.assertEqual(context[:-1], llm_shell.history[-llm_config['llm_history_length']:])
+		with CaptureStdout():
+			handle_command('llm-context-budget auto')
+		self.assertIsNone(llm_config['llm_context_budget'])
+
+class TestRepoIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.root = os.path.join(self.temp_dir.name, 'repo')
+		os.makedirs(self.root)
+		self.index_dir_patch = patch('llm_shell.repo_index.index_dir', os.path.join(self.temp_dir.name, 'index'))
+		self.index_dir_patch.start()
+		repo_index.loaded_indexes.clear()
+		self.write_file('parser.py', 'def parse_config(path):\n    return load_yaml(path)\n')
+		self.write_file('server.py', 'class HttpServer:\n    def handle_request(self, request):\n        pass\n')
+		self.write_file('notes.txt', 'shopping list: apples, bananas\n')
+
+	def tearDown(self):
+		self.index_dir_patch.stop()
+		repo_index.loaded_indexes.clear()
+		llm_config['llm_context_index'] = False
+		self.temp_dir.cleanup()
+
+	def write_file(self, name, contents):
+		with open(os.path.join(self.root, name), 'w') as f:
+			f.write(contents)
+
+	def test_tokenize_splits_identifiers(self):
+		self.assertEqual(repo_index.tokenize('parseConfig load_yaml'), ['parseconfig', 'parse', 'config', 'load_yaml', 'load', 'yaml'])
+
+	def test_search_ranks_relevant_chunks(self):
+		index, updated = repo_index.build_index(self.root)
+		self.assertEqual(updated, 3)
+		chunks = repo_index.retrieve_chunks('how does the http server handle a request?', 2, 1000, root=self.root)
+		self.assertEqual(chunks[0][:3], ('server.py', 1, 4))
+		self.assertIn('class HttpServer', chunks[0][3])
+
+	def test_incremental_update_and_persistence(self):
+		repo_index.build_index(self.root)
+		repo_index.loaded_indexes.clear()
+		# Reloaded from disk, nothing has changed
+		index, updated = repo_index.build_index(self.root)
+		self.assertEqual((updated, len(index.files)), (0, 3))
+
+		os.remove(os.path.join(self.root, 'notes.txt'))
+		self.write_file('parser.py', 'def parse_toml(path):\n    return load_toml(path)\n')
+		index, updated = repo_index.build_index(self.root)
+		self.assertEqual(updated, 2)
+		self.assertNotIn('notes.txt', index.files)
+		self.assertNotIn('yaml', index.postings)
+		self.assertEqual(index.search('toml', 5)[0][1], index.files['parser.py'][2][0])
+
+	def test_retrieve_respects_budget_and_exclusions(self):
+		self.write_file('big.py', 'def http_request():\n' + '    request = 1\n' * 30)
+		chunks = repo_index.retrieve_chunks('http request', 5, 40, root=self.root)
+		self.assertEqual([ chunk[0] for chunk in chunks ], ['server.py'])
+		chunks = repo_index.retrieve_chunks('http request', 5, 1000, root=self.root, exclude_paths=[os.path.join(self.root, 'server.py')])
+		self.assertNotIn('server.py', [ chunk[0] for chunk in chunks ])
+
+	def test_exclusions_do_not_crowd_out_results(self):
+		# every chunk of the excluded file outranks server.py
+		self.write_file('big.py', 'http_request = 1\n' * 200)
+		chunks = repo_index.retrieve_chunks('http request', 1, 1000, root=self.root, exclude_paths=[os.path.join(self.root, 'big.py')])
+		self.assertEqual([ chunk[0] for chunk in chunks ], ['server.py'])
+
+	def test_git_file_list_is_cached(self):
+		subprocess.run(['git', 'init', '-q', self.root], check=True)
+		subprocess.run(['git', 'add', 'parser.py'], cwd=self.root, check=True)
+		with patch('llm_shell.repo_index.list_repo_paths', wraps=repo_index.list_repo_paths) as list_repo_paths:
+			index, updated = repo_index.build_index(self.root)
+			self.write_file('parser.py', 'def parse_toml(path):\n    return load_toml(path)\n')
+			index, updated = repo_index.build_index(self.root)
+			# changed files are still picked up without listing the tree again
+			self.assertEqual((updated, list_repo_paths.call_count), (1, 1))
+			self.assertIn('toml', index.postings)
+			os.remove(os.path.join(self.root, 'notes.txt'))
+			time.sleep(0.01)
+			subprocess.run(['git', 'add', 'server.py'], cwd=self.root, check=True)
+			index, updated = repo_index.build_index(self.root)
+			self.assertEqual(list_repo_paths.call_count, 2)
+			self.assertNotIn('notes.txt', index.files)
+
+	def test_llm_command_sends_retrieved_chunks(self):
+		cwd = os.getcwd()
+		os.chdir(self.root)
+		try:
+			with CaptureStdout() as output:
+				handle_command('context-index on')
+				handle_command('llm-backend hello-world')
+				handle_command('#where is parse_config defined')
+		finally:
+			os.chdir(cwd)
+		self.assertIn("$ sed -n '1,3p' parser.py", ''.join(output))
+		self.assertNotIn('shopping list', ''.join(output))
+
+class TestAsyncBackends(unittest.TestCase):
+
+	def setUp(self):
+		self.active = 0
+		self.max_active = 0
+		self.calls = 0
+		self.lock = threading.Lock()
+
+	def tearDown(self):
+		llm_config['llm_concurrency'] = 4
+
+	def slow_backend(self, context):
+		with self.lock:
+			self.calls += 1
+			self.active += 1
+			self.max_active = max(self.max_active, self.active)
+		time.sleep(0.1)
+		with self.lock:
+			self.active -= 1
+		return 'answer to ' + context[-1]['content']
+
+	def test_requests_run_concurrently(self):
+		llm_config['llm_concurrency'] = 4
+		contexts = [ [{'role': 'user', 'content': f'q{i}'}] for i in range(4) ]
+		with patch.dict(llm_shell.support_llm_backends, {'hello-world': self.slow_backend}):
+			start = time.time()
+			responses = llm_shell.send_to_llm_concurrently(contexts, backend='hello-world')
+			elapsed = time.time() - start
+		self.assertEqual(responses, ['answer to q0', 'answer to q1', 'answer to q2', 'answer to q3'])
+		self.assertEqual(self.max_active, 4)
+		self.assertLess(elapsed, 0.35)
+
+	def test_concurrency_limit(self):
+		llm_config['llm_concurrency'] = 2
+		contexts = [ [{'role': 'user', 'content': f'q{i}'}] for i in range(5) ]
+		with patch.dict(llm_shell.support_llm_backends, {'hello-world': self.slow_backend}):
+			llm_shell.send_to_llm_concurrently(contexts, backend='hello-world')
+		self.assertEqual(self.max_active, 2)
+
+	def test_requests_arrive_in_completion_order_and_cancel(self):
+		llm_config['llm_concurrency'] = 1
+		contexts = [ [{'role': 'user', 'content': f'q{i}'}] for i in range(3) ]
+		with patch.dict(llm_shell.support_llm_backends, {'hello-world': self.slow_backend}):
+			requests = llm_shell.ConcurrentLLMRequests(contexts, backend='hello-world')
+			self.assertEqual(next(requests), 'answer to q0')
+			requests.cancel()
+			self.assertEqual(list(requests), [])
+			requests.thread.join(1)
+		# the request waiting for the only slot was never sent
+		self.assertFalse(requests.thread.is_alive())
+		self.assertLessEqual(self.calls, 2)
+
+	def test_concurrency_above_default_executor(self):
+		# more slots than the default executor's min(32, cpu + 4) threads
+		count = (os.cpu_count() or 1) + 8
+		llm_config['llm_concurrency'] = count
+		contexts = [ [{'role': 'user', 'content': f'q{i}'}] for i in range(count) ]
+		with patch.dict(llm_shell.support_llm_backends, {'hello-world': self.slow_backend}):
+			start = time.time()
+			llm_shell.send_to_llm_concurrently(contexts, backend='hello-world')
+			elapsed = time.time() - start
+		self.assertEqual(self.max_active, count)
+		self.assertLess(elapsed, 0.35)
+
+class TestPromptCaching(unittest.TestCase):
+
+	context = [
+		{'role': 'system', 'content': 'instruction', 'cache': True},
+		{'role': 'user', 'content': '$ cat a.py\nprint(1)', 'cache': True},
+		{'role': 'user', 'content': '$ cat b.py\nprint(2)', 'cache': True},
+		{'role': 'user', 'content': 'history message'},
+		{'role': 'assistant', 'content': 'history answer'},
+		{'role': 'user', 'content': 'request'},
+	]
+	caching_model = 'us.anthropic.claude-3-7-sonnet-20250219-v1:0'
+
+	def test_body_without_caching(self):
+		with patch('llm_shell.bedrock_support.bedrock_prompt_caching', False):
+			body = json.loads(bedrock_support.build_bedrock_body(self.context))
+		self.assertEqual(body['system'], 'instruction')
+		self.assertNotIn('cache_control', json.dumps(body))
+		self.assertEqual(body['messages'][0]['content'][0]['text'], '$ cat a.py\nprint(1)\n\n\n$ cat b.py\nprint(2)\n\n\nhistory message')
+
+	def test_body_with_cache_breakpoints(self):
+		with patch('llm_shell.bedrock_support.bedrock_prompt_caching', True):
+			body = json.loads(bedrock_support.build_bedrock_body(self.context, self.caching_model))
+		self.assertEqual(body['system'], [{'type': 'text', 'text': 'instruction', 'cache_control': {'type': 'ephemeral'}}])
+		self.assertEqual(body['messages'][0], {'role': 'user', 'content': [
+			{'type': 'text', 'text': '$ cat a.py\nprint(1)'},
+			{'type': 'text', 'text': '$ cat b.py\nprint(2)', 'cache_control': {'type': 'ephemeral'}},
+			{'type': 'text', 'text': 'history message'},
+		]})
+		self.assertEqual([ message['role'] for message in body['messages'] ], ['user', 'assistant', 'user'])
+
+	def test_body_keeps_every_system_entry(self):
+		import llm_shell.experimental_llm_agent as experimental_llm_agent
+		context = [
+			{'role': 'system', 'content': 'instruction', 'cache': True},
+			{'role': 'system', 'content': experimental_llm_agent.llm_single_call_instruction, 'cache': True},
+			{'role': 'user', 'content': 'request'},
+		]
+		with patch('llm_shell.bedrock_support.bedrock_prompt_caching', False):
+			body = json.loads(bedrock_support.build_bedrock_body(context))
+		self.assertEqual(body['system'], 'instruction\n\n' + experimental_llm_agent.llm_single_call_instruction)
+		with patch('llm_shell.bedrock_support.bedrock_prompt_caching', True):
+			body = json.loads(bedrock_support.build_bedrock_body(context, self.caching_model))
+		self.assertEqual(body['system'], [
+			{'type': 'text', 'text': 'instruction'},
+			{'type': 'text', 'text': experimental_llm_agent.llm_single_call_instruction, 'cache_control': {'type': 'ephemeral'}},
+		])
+
+	def test_models_without_caching_get_no_breakpoints(self):
+		with patch('llm_shell.bedrock_support.bedrock_prompt_caching', True):
+			body = json.loads(bedrock_support.build_bedrock_body(self.context, 'anthropic.claude-3-haiku-20240307-v1:0'))
+		self.assertEqual(body['system'], 'instruction')
+		self.assertNotIn('cache_control', json.dumps(body))
+
+	def test_cached_response_reports_no_usage(self):
+		payload = json.dumps({ 'content': [{ 'type': 'text', 'text': 'answer' }],
+			'usage': { 'input_tokens': 5, 'output_tokens': 1, 'cache_read_input_tokens': 2000, 'cache_creation_input_tokens': 0 } }).encode()
+		client = Mock()
+		client.invoke_model.side_effect = lambda **kwargs: { 'ResponseMetadata': { 'HTTPStatusCode': 200 }, 'body': BytesIO(payload) }
+		with tempfile.TemporaryDirectory() as cache_dir, patch('llm_shell.response_cache.cache_dir', cache_dir), \
+				patch('llm_shell.bedrock_support.get_bedrock_client', return_value=client), \
+				patch.dict(llm_config, { 'llm_backend': 'claude-3.7-sonnet', 'llm_prompt_caching': True, 'llm_cache': True }):
+			with CaptureStdout() as output:
+				llm_shell.send_to_llm(self.context, show_spinner=False)
+				llm_shell.report_prompt_cache_usage()
+				llm_shell.send_to_llm(self.context, show_spinner=False)
+				llm_shell.report_prompt_cache_usage()
+		client.invoke_model.assert_called_once()
+		self.assertEqual(output, ['\t(prompt cache: read 2000 tokens, wrote 0 tokens)'])
+
+	def test_cache_usage_is_recorded(self):
+		payload = json.dumps({ 'content': [{ 'type': 'text', 'text': 'answer' }],
+			'usage': { 'input_tokens': 5, 'output_tokens': 1, 'cache_read_input_tokens': 2000, 'cache_creation_input_tokens': 0 } }).encode()
+		client = Mock()
+		client.invoke_model.return_value = { 'ResponseMetadata': { 'HTTPStatusCode': 200 }, 'body': BytesIO(payload) }
+		read_before = bedrock_support.total_cache_read_tokens
+		with patch('llm_shell.bedrock_support.get_bedrock_client', return_value=client):
+			self.assertEqual(bedrock_support.send_to_claude37sonnet(self.context), 'answer')
+		self.assertEqual(bedrock_support.last_usage['cache_read_input_tokens'], 2000)
+		self.assertEqual(bedrock_support.total_cache_read_tokens - read_before, 2000)
+
+	def test_context_files_form_static_prefix(self):
+		llm_config['llm_backend'] = 'hello-world'
+		llm_shell.history.clear()
+		llm_shell.update_history('user', 'earlier message')
+		files = llm_shell.load_context_file_entries([], ['setup.py'])
+		context = llm_shell.build_llm_context([{'role': 'system', 'content': 'instruction'}, {'role': 'user', 'content': 'request'}], files)
+		self.assertEqual([ step.get('cache', False) for step in context ], [True, True, False, False])
+		self.assertTrue(context[1]['content'].startswith('$ cat setup.py'))
+		llm_shell.history.clear()
+
+class TestMockServer(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.server = start_mock_server(responses=['hello from the mock server'], seed=1)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
+
+	def setUp(self):
+		self.patches = [
+			patch('llm_shell.chatgpt_support.chatgpt_api_key', 'mock-key'),
+			patch('llm_shell.chatgpt_support.chatgpt_base_url', self.server.url + '/v1'),
+			patch('llm_shell.bedrock_support.bedrock_endpoint_url', self.server.url),
+			patch('llm_shell.bedrock_support.bedrock_region', 'us-east-1'),
+			patch.dict(os.environ, { 'AWS_ACCESS_KEY_ID': 'mock', 'AWS_SECRET_ACCESS_KEY': 'mock' }),
+		]
+		for p in self.patches:
+			p.start()
+
+	def tearDown(self):
+		for p in self.patches:
+			p.stop()
+		bedrock_support.clear_bedrock_clients()
+
+	def test_chatgpt_against_mock_server(self):
+		context = [{'role': 'system', 'content': 'instruction'}, {'role': 'user', 'content': 'hi'}]
+		self.assertEqual(chatgpt_support.send_to_gpt4o(context), 'hello from the mock server')
+		self.assertEqual(''.join(chatgpt_support.stream_to_gpt4o(context)), 'hello from the mock server')
+		self.assertEqual(chatgpt_support.get_openai_models(), ['mock-model'])
+
+	@requires_boto3
+	def test_bedrock_against_mock_server(self):
+		context = [{'role': 'system', 'content': 'instruction'}, {'role': 'user', 'content': 'hi'}]
+		self.assertEqual(bedrock_support.send_to_claude3haiku(context), 'hello from the mock server')
+		chunks = list(bedrock_support.stream_to_claude3haiku(context))
+		self.assertEqual(chunks, ['hello ', 'from ', 'the ', 'mock ', 'server'])
+
+	def test_error_rate(self):
+		server = start_mock_server(error_rate=1.0)
+		try:
+			with patch('llm_shell.chatgpt_support.chatgpt_base_url', server.url + '/v1'), \
+					patch.dict(chatgpt_support.http_session_config, { 'max_retries': 0 }):
+				chatgpt_support.configure_http_session()
+				response = chatgpt_support.send_to_gpt4o([{'role': 'user', 'content': 'hi'}])
+		finally:
+			chatgpt_support.configure_http_session()
+			server.shutdown()
+			server.server_close()
+		self.assertTrue(response.startswith('Error: 500'))
+
+	def test_client_disconnects_are_not_reported(self):
+		for error, reported in ((BrokenPipeError(), False), (ConnectionResetError(), False), (ValueError('bug'), True)):
+			with patch('sys.stderr', new_callable=StringIO) as stderr:
+				try:
+					raise error
+				except Exception:
+					self.server.handle_error(None, ('127.0.0.1', 12345))
+			self.assertEqual('Traceback' in stderr.getvalue(), reported)
+
+class TestContextCache(unittest.TestCase):
+
+	def setUp(self):
+		context_cache.clear()
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.file_path = os.path.join(self.temp_dir.name, 'module.py')
+		with open(self.file_path, 'w') as f:
+			f.write('def hello():\n\treturn 1\n')
+
+	def tearDown(self):
+		context_cache.clear()
+		self.temp_dir.cleanup()
+
+	def test_unchanged_file_is_not_reread(self):
+		with patch('llm_shell.llm_shell.read_file_contents', wraps=llm_shell.read_file_contents) as mock_read, \
+				patch('llm_shell.llm_shell.summarize_file', wraps=llm_shell.summarize_file) as mock_summarize:
+			first = llm_shell.load_context_file_entries([self.file_path], [self.file_path])
+			second = llm_shell.load_context_file_entries([self.file_path], [self.file_path])
+		self.assertEqual(first, second)
+		self.assertEqual(mock_read.call_count, 2)
+		self.assertEqual(mock_summarize.call_count, 1)
+
+	def test_changed_file_is_reread(self):
+		self.assertEqual(llm_shell.load_context_file(self.file_path, False), 'def hello():\n\treturn 1\n')
+		with open(self.file_path, 'w') as f:
+			f.write('def hello():\n\treturn 2\n')
+		os.utime(self.file_path, ns=(0, 0))
+		self.assertEqual(llm_shell.load_context_file(self.file_path, False), 'def hello():\n\treturn 2\n')
+
+	def test_cache_is_bounded(self):
+		paths = []
+		for i in range(5):
+			path = os.path.join(self.temp_dir.name, f'file{i}.txt')
+			with open(path, 'w') as f:
+				f.write('x' * 100)
+			paths.append(path)
+		with patch('llm_shell.context_cache.context_cache_max_bytes', 250):
+			for path in paths:
+				llm_shell.load_context_file(path, False)
+			self.assertEqual(context_cache.stats()['entries'], 2)
+			self.assertLessEqual(context_cache.stats()['size'], 250)
+
+	def test_cache_can_be_disabled(self):
+		with CaptureStdout():
+			handle_command('llm-context-cache off')
+		try:
+			with patch('llm_shell.llm_shell.read_file_contents', return_value='contents') as mock_read:
+				llm_shell.load_context_file(self.file_path, False)
+				llm_shell.load_context_file(self.file_path, False)
+			self.assertEqual(mock_read.call_count, 2)
+		finally:
+			with CaptureStdout():
+				handle_command('llm-context-cache on')
+
+class TestLLMStats(unittest.TestCase):
+
+	def setUp(self):
+		llm_stats.clear_call_records()
+		llm_config['llm_backend'] = 'hello-world'
+
+	def tearDown(self):
+		llm_stats.clear_call_records()
+
+	def test_percentile(self):
+		values = list(range(1, 101))
+		self.assertEqual(llm_stats.percentile(values, 50), 50)
+		self.assertEqual(llm_stats.percentile(values, 95), 95)
+		self.assertEqual(llm_stats.percentile(values, 99), 99)
+		self.assertEqual(llm_stats.percentile([3], 99), 3)
+		self.assertIsNone(llm_stats.percentile([], 50))
+
+	def test_startup_warmup(self):
+		server = start_mock_server()
+		try:
+			with patch.dict(llm_stats.warmup_timings, clear=True), \
+					patch.dict(llm_config, {'llm_backend': 'openai-gpt-4o'}), \
+					patch('llm_shell.chatgpt_support.chatgpt_api_key', 'mock-key'), \
+					patch('llm_shell.chatgpt_support.chatgpt_base_url', server.url + '/v1'):
+				llm_shell.start_warmup().join()
+				self.assertEqual(set(llm_stats.warmup_timings), { 'executable_index', 'syntax_highlighting', 'context_files', 'http_connection' })
+				with CaptureStdout() as output:
+					handle_command('llm-stats')
+				self.assertTrue(output[-1].startswith('startup warm-up: '))
+				self.assertIn('http_connection', output[-1])
+		finally:
+			server.shutdown()
+			server.server_close()
+
+	def test_warmup_is_quiet_about_missing_files(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			missing_path = os.path.join(temp_dir, 'missing.py')
+			with patch.dict(llm_config, {'llm_backend': 'hello-world', 'llm_context_cache': True, 'context_file': [missing_path], 'summary_file': []}):
+				with CaptureStdout() as output:
+					llm_shell.start_warmup().join()
+				self.assertEqual(output, [])
+				# the request itself still reports the missing file
+				with CaptureStdout() as output:
+					llm_shell.load_context_file_entries(llm_config['summary_file'], llm_config['context_file'])
+				self.assertEqual(output, [f"Error: File '{missing_path}' not found"])
+
+	def test_records_backend_usage(self):
+		def backend(context):
+			llm_stats.report_usage(input_tokens=12, output_tokens=3, cost=0.5)
+			return 'answer'
+		with patch.dict(llm_shell.support_llm_backends, {'hello-world': backend}):
+			llm_shell.send_to_llm([{'role': 'user', 'content': 'question'}], show_spinner=False)
+		records = llm_stats.get_call_records()
+		self.assertEqual(len(records), 1)
+		self.assertEqual(records[0]['backend'], 'hello-world')
+		self.assertEqual((records[0]['input_tokens'], records[0]['output_tokens'], records[0]['cost']), (12, 3, 0.5))
+		self.assertEqual(records[0]['context_chars'], len('question'))
+		self.assertIsNotNone(records[0]['latency'])
+
+	def test_stream_records_time_to_first_token(self):
+		def backend(context):
+			yield 'first'
+			time.sleep(0.05)
+			yield ' second'
+		with patch.dict(llm_shell.support_llm_stream_backends, {'hello-world': backend}):
+			self.assertEqual(''.join(llm_shell.stream_llm([{'role': 'user', 'content': 'question'}])), 'first second')
+		record = llm_stats.get_call_records()[0]
+		self.assertTrue(record['stream'])
+		self.assertLess(record['time_to_first_token'], record['latency'])
+		self.assertGreaterEqual(record['latency'], 0.05)
+
+	def test_errors_are_counted(self):
+		with patch.dict(llm_shell.support_llm_backends, {'hello-world': lambda context: 'Error: 500, oops'}):
+			llm_shell.send_to_llm([{'role': 'user', 'content': 'question'}], show_spinner=False)
+		self.assertEqual(llm_stats.summarize_records(llm_stats.get_call_records())['hello-world']['errors'], 1)
+
+	def test_stats_command_and_export(self):
+		with patch.dict(llm_shell.support_llm_backends, {'hello-world': lambda context: 'answer'}):
+			for i in range(3):
+				llm_shell.send_to_llm([{'role': 'user', 'content': 'question'}], show_spinner=False)
+		with tempfile.TemporaryDirectory() as temp_dir:
+			export_path = os.path.join(temp_dir, 'stats.jsonl')
+			with CaptureStdout() as output:
+				handle_command('llm-stats')
+				handle_command(f'llm-stats export {export_path}')
+			with open(export_path, 'r') as f:
+				records = [ json.loads(line) for line in f ]
+		self.assertIn('hello-world: 3 call(s), 0 error(s), 0 cache hit(s)', output)
+		self.assertTrue(any('latency p50/p95/p99' in line for line in output))
+		self.assertEqual(len(records), 3)
+
+class TestImportTime(unittest.TestCase):
+
+	def test_heavy_modules_load_lazily(self):
+		import subprocess
+		result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import llm_shell.llm_shell'],
+			capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+		self.assertEqual(result.returncode, 0, result.stderr)
+		# -X importtime lines end in '| <indented module name>'
+		imported = set(line.rsplit('|', 1)[1].strip() for line in result.stderr.splitlines() if line.startswith('import time:'))
+		self.assertIn('llm_shell.llm_shell', imported)
+		for module in ('requests', 'urllib3', 'pygments', 'readline', 'asyncio', 'boto3', 'llm_shell.experimental_llm_agent', 'llm_shell.repo_index', 'llm_shell.shell_session'):
+			self.assertNotIn(module, imported)
+
+class TestBenchmark(unittest.TestCase):
+
+	def test_benchmark_stages(self):
+		import run_benchmark
+		results = run_benchmark.run_benchmarks(['small'], 1)
+		self.assertEqual(set(results['small'].keys()), { 'read_context_files', 'summarize_file', 'serialize_request',
+			'summarize_python', 'backend_round_trip', 'apply_syntax_highlighting', 'parse_diff_string', 'apply_changes', 'apply_changes_batch',
+			'apply_changes_one_file', 'apply_changes_batch_one_file' })
+
+	def test_compare_to_baseline(self):
+		import run_benchmark
+		baseline = { 'small': { 'parse_diff_string': 0.01, 'apply_changes': 0.01 } }
+		results = { 'small': { 'parse_diff_string': 0.05, 'apply_changes': 0.015 } }
+		self.assertEqual(run_benchmark.compare_to_baseline(results, baseline, 2.0), [('small', 'parse_diff_string', 0.01, 0.05)])
+
+class TestSummarizer(unittest.TestCase):
+
+	def test_generic_matches_regex_summary(self):
+		import re
+		def regex_summary(text):
+			return re.sub(r'(\t# \.\.\.\n?)+', '\t# ...\n', '\n'.join(line if not re.match(r'^\s+', line) else '\t# ...' for line in text.split('\n') if not re.match(r'^(\s*$|\s*#.*|\s*//.*)', line)))
+		for file_path in ['llm_shell/llm_shell.py', 'llm_shell/util.py', 'README.md', 'run_unittest.py']:
+			with open(file_path, 'r') as f:
+				text = f.read()
+			self.assertEqual(summarizer.summarize(text), regex_summary(text))
+
+	def test_python_keeps_signatures_and_docstrings(self):
+		text = '''"""Module docstring."""
+import os
+
+@decorator
+class Foo(Base):
+    """Foo docstring."""
+    attr = 1
+
+    def method(self,
+            arg):
+        """Method doc
+        spanning lines."""
+        x = """
+def not_a_function():
+"""
+        return x
+
+def bar():
+    # comment
+    pass
+'''
+		self.assertEqual(summarizer.summarize(text, 'module.py'), '''"""Module docstring."""
+import os
+@decorator
+class Foo(Base):
+    """Foo docstring."""
+    ...
+    def method(self,
+            arg):
+        """Method doc
+        spanning lines."""
+        ...
+def bar():
+    ...''')
+
+	def test_braces_keeps_members(self):
+		text = '''// header comment
+import { x } from "./x";
+
+/* block
+   comment */
+export class Foo {
+  constructor(value) {
+    this.value = value;
+    if (value) {
+      console.log("{");
+    }
+  }
+}
+
+function bar() {
+  return 1;
+}
+'''
+		self.assertEqual(summarizer.summarize(text, 'foo.ts'), '''import { x } from "./x";
+export class Foo {
+  constructor(value) {
+	// ...
+  }
+}
+function bar() {
+	// ...
+}''')
+
+	def test_summarize_file_path_streams(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			file_path = os.path.join(temp_dir, 'module.py')
+			text = 'import os\n\ndef foo():\n    return 1\n'
+			with open(file_path, 'w') as f:
+				f.write(text)
+			self.assertEqual(summarizer.summarize_file_path(file_path), summarizer.summarize(text, file_path))
+			self.assertEqual(summarizer.summarize_file_path(file_path), 'import os\ndef foo():\n    ...')
+
+class TestStreaming(unittest.TestCase):
+
+	def mock_sse_response(self, lines):
+		response = Mock()
+		response.status_code = 200
+		response.iter_lines.return_value = iter(line.encode('utf-8') for line in lines)
+		return response
+
+	def test_chatgpt_stream_yields_deltas(self):
+		lines = [
+			'data: {"choices":[{"delta":{"role":"assistant"}}]}',
+			'',
+			'data: {"choices":[{"delta":{"content":"hello"}}]}',
+			'data: {"choices":[{"delta":{"content":" world"}}]}',
+			'data: {"choices":[],"usage":{"prompt_tokens":10,"completion_tokens":2,"total_tokens":12}}',
+			'data: [DONE]',
+		]
+		with patch('llm_shell.chatgpt_support.chatgpt_api_key', 'test-key'), \
+				patch('llm_shell.chatgpt_support.get_http_session') as mock_session:
+			mock_post = mock_session.return_value.post
+			mock_post.return_value = self.mock_sse_response(lines)
+			tokens_before = chatgpt_support.total_tokens_used
+			chunks = list(chatgpt_support.stream_to_gpt4o([{'role': 'user', 'content': 'hi'}]))
+		self.assertEqual(chunks, ['hello', ' world'])
+		self.assertTrue(mock_post.call_args.kwargs['json']['stream'])
+		self.assertEqual(chatgpt_support.total_tokens_used - tokens_before, 12)
+
+	def test_chatgpt_stream_decodes_utf8(self):
+		import requests
+		# a real response whose content type has no charset
+		body = 'data: {"choices":[{"delta":{"content":"héllo ✓"}}]}\n\ndata: [DONE]\n\n'.encode('utf-8')
+		response = requests.models.Response()
+		response.status_code = 200
+		response.headers['Content-Type'] = 'text/event-stream'
+		response.raw = BytesIO(body)
+		with patch('llm_shell.chatgpt_support.chatgpt_api_key', 'test-key'), \
+				patch('llm_shell.chatgpt_support.get_http_session') as mock_session:
+			mock_session.return_value.post.return_value = response
+			chunks = list(chatgpt_support.stream_to_gpt4o([{'role': 'user', 'content': 'hi'}]))
+		self.assertEqual(chunks, ['héllo ✓'])
+
+	def test_chatgpt_stream_error(self):
+		response = Mock()
+		response.status_code = 401
+		response.text = 'unauthorized'
+		with patch('llm_shell.chatgpt_support.chatgpt_api_key', 'test-key'), \
+				patch('llm_shell.chatgpt_support.get_http_session') as mock_session:
+			mock_session.return_value.post.return_value = response
+			chunks = list(chatgpt_support.stream_to_gpt4o([{'role': 'user', 'content': 'hi'}]))
+		self.assertEqual(chunks, ['Error: 401, unauthorized'])
+
+	def test_bedrock_stream_yields_deltas(self):
+		events = [ { 'chunk': { 'bytes': json.dumps(event).encode() } } for event in [
+			{ 'type': 'message_start', 'message': { 'usage': { 'input_tokens': 10 } } },
+			{ 'type': 'content_block_start', 'index': 0, 'content_block': { 'type': 'text', 'text': '' } },
+			{ 'type': 'content_block_delta', 'index': 0, 'delta': { 'type': 'text_delta', 'text': 'hello' } },
+			{ 'type': 'content_block_delta', 'index': 0, 'delta': { 'type': 'text_delta', 'text': ' world' } },
+			{ 'type': 'content_block_stop', 'index': 0 },
+			{ 'type': 'message_delta', 'delta': { 'stop_reason': 'end_turn' }, 'usage': { 'output_tokens': 2 } },
+			{ 'type': 'message_stop' },
+		] ]
+		client = Mock()
+		client.invoke_model_with_response_stream.return_value = { 'ResponseMetadata': { 'HTTPStatusCode': 200 }, 'body': iter(events) }
+		with patch('llm_shell.bedrock_support.get_bedrock_client', return_value=client):
+			chunks = list(bedrock_support.stream_to_claude3haiku([{'role': 'system', 'content': 'sys'}, {'role': 'user', 'content': 'hi'}]))
+		self.assertEqual(chunks, ['hello', ' world'])
+		body = json.loads(client.invoke_model_with_response_stream.call_args.kwargs['body'])
+		self.assertEqual(body['system'], 'sys')
+		self.assertEqual(body['messages'], [{'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}]}])
+
+	def test_handle_llm_command_streams_response(self):
+		llm_config['llm_backend'] = 'hello-world'
+		llm_config['llm_stream'] = True
+		with patch.dict(llm_shell.support_llm_stream_backends, {'hello-world': lambda context: iter(['hello', ' streamed', ' world'])}):
+			with CaptureStdout() as output:
+				handle_command('# hello')
+		self.assertIn('hello streamed world', output)
+		self.assertEqual(llm_shell.history[-1], {'role': 'assistant', 'content': 'hello streamed world'})
+
 class TestAskLLM(unittest.TestCase):
     def setUp(self):
         self.original_stdout = sys.stdout
@@ -426,6 +1765,7 @@ class TestAskLLM(unittest.TestCase):
 
     def tearDown(self):
         sys.stdout = self.original_stdout
+        llm_config['llm_concurrency'] = 4
 
     @patch('llm_shell.llm_shell.handle_llm_command')
     def test_ask_llm_with_topic(self, mock_handle_llm_command):
@@ -456,6 +1796,72 @@ class TestAskLLM(unittest.TestCase):
         self.assertEqual(llm_config['context_file'], ['file1.py', 'file2.py'])
         mock_handle_llm_command.assert_called_with('What is the capital of France?', show_spinner=False)
 
+    def run_batch(self, prompts, *extra_args, raw_lines=()):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            batch_path = os.path.join(temp_dir, 'prompts.jsonl')
+            output_path = os.path.join(temp_dir, 'results.jsonl')
+            with open(batch_path, 'w') as f:
+                f.write('\n'.join([ json.dumps(prompt) for prompt in prompts ] + list(raw_lines)) + '\n')
+            sys.argv = ['ask_llm.py', '--batch', batch_path, '-o', output_path, *extra_args]
+            delays = { 'slow': 0.2, 'slowish': 0.15, 'medium': 0.1, 'fast': 0 }
+            self.starts = []
+            def backend(context):
+                self.starts.append(time.time())
+                time.sleep(delays[context[-1]['content']])
+                return 'answer: ' + context[-1]['content']
+            with patch('llm_shell.llm_shell.load_llm_config_from_file'), \
+                    patch.dict(llm_shell.support_llm_backends, {'hello-world': backend}):
+                llm_config['llm_backend'] = 'hello-world'
+                ask_llm()
+            with open(output_path, 'r') as f:
+                return [ json.loads(line) for line in f ]
+
+    def test_ask_llm_batch_input_order(self):
+        results = self.run_batch([ { 'id': 'a', 'prompt': 'slow' }, 'medium', { 'prompt': 'fast' } ], '-j', '3')
+        self.assertEqual([ result['id'] for result in results ], ['a', 1, 2])
+        self.assertEqual([ result['response'] for result in results ], ['answer: slow', 'answer: medium', 'answer: fast'])
+
+    def test_ask_llm_batch_completion_order(self):
+        results = self.run_batch([ 'slow', 'medium', 'fast' ], '-j', '3', '--order', 'completion')
+        self.assertEqual([ result['response'] for result in results ], ['answer: fast', 'answer: medium', 'answer: slow'])
+
+    def test_ask_llm_batch_rate_limit(self):
+        start = time.time()
+        results = self.run_batch([ 'fast', 'fast', 'fast' ], '-j', '3', '--rate-limit', '10')
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(len(results), 3)
+
+    def test_ask_llm_batch_rate_limit_with_concurrency(self):
+        # both running requests finish at 0.2s, the two queued behind them must still start 0.05s apart
+        results = self.run_batch([ 'slow', 'slowish', 'fast', 'fast' ], '-j', '2', '--rate-limit', '20')
+        self.assertEqual(len(results), 4)
+        starts = sorted(self.starts)
+        self.assertGreaterEqual(starts[2] - starts[0], 0.19)
+        for previous, start in zip(starts, starts[1:]):
+            self.assertGreaterEqual(start - previous, 0.045)
+
+    def test_ask_llm_batch_bad_lines(self):
+        results = self.run_batch([ 'fast', { 'id': 7 }, { 'prompt': 'fast' } ], '-j', '2', raw_lines=['{not json'])
+        self.assertEqual([ result.get('response') for result in results ], ['answer: fast', None, 'answer: fast', None])
+        self.assertEqual(results[1]['id'], 7)
+        self.assertEqual(results[1]['error'], "missing 'prompt'")
+        self.assertTrue(results[3]['error'].startswith('invalid JSON'))
+
+    def test_ask_llm_batch_missing_context_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            batch_path = os.path.join(temp_dir, 'prompts.jsonl')
+            missing_path = os.path.join(temp_dir, 'missing.txt')
+            with open(batch_path, 'w') as f:
+                f.write('"fast"\n')
+            sys.argv = ['ask_llm.py', '--batch', batch_path, '-c', missing_path]
+            with patch('llm_shell.llm_shell.load_llm_config_from_file'), patch.dict(llm_config), \
+                    patch.dict(llm_shell.support_llm_backends, {'hello-world': Mock(return_value='answer')}):
+                llm_config['llm_backend'] = 'hello-world'
+                ask_llm()
+        # stdout carries nothing but the jsonl results
+        results = [ json.loads(line) for line in self.captured_stdout.getvalue().splitlines() ]
+        self.assertEqual(results, [{ 'index': 0, 'id': 0, 'backend': 'hello-world', 'error': f"File '{missing_path}' not found" }])
+
     def test_ask_llm_no_input(self):
         sys.argv = ['ask_llm.py']
         ask_llm()